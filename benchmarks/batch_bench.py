@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+ Throughput against latency of a batching worker for batch sizes B and
+ batch waits T.
+
+ The worker stands in for a model with a fixed cost per forward pass and a
+ small cost per frame (OVERHEAD + PER_FRAME * batch length, slept), which
+ is what makes batching pay. A pipelined client keeps WINDOW requests in
+ flight through a local broker.
+
+ usage: batch_bench.py [requests per run]
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+from worker_api import MajordomoBatchWorker
+from client_api import MajordomoAsyncClient
+from bench_util import percentile, run_broker
+
+ENDPOINT = "tcp://127.0.0.1:5597"
+OVERHEAD = 0.010 					# secs per forward pass
+PER_FRAME = 0.001 				# secs per frame in a pass
+WINDOW = 16 						# requests in flight
+BATCH_SIZES = [1, 2, 4, 8, 16]
+BATCH_WAITS = [0, 5, 20] 		# msecs
+
+class ModelWorker(MajordomoBatchWorker):
+	def batch_request_handler(self, requests):
+		time.sleep(OVERHEAD + PER_FRAME*len(requests))
+		return [["ok"] for request in requests]
+
+def run_worker(service, batch_size, batch_wait):
+	ModelWorker(ENDPOINT, service, batch_size, batch_wait).serve_forever()
+
+def bench(client, batch_size, batch_wait, requests):
+	"""
+	Returns (replies/sec, sorted latencies in secs) for one worker setting.
+	"""
+	# a service per run, the broker still counts on the workers of earlier runs
+	service = "model-%d-%d" % (batch_size, batch_wait)
+	worker = multiprocessing.Process(target=run_worker, args=(service, batch_size, batch_wait))
+	worker.daemon = True
+	worker.start()
+	time.sleep(0.5) # let the worker register
+
+	latencies = []
+	def done(future):
+		if future.reply is not None:
+			latencies.append(time.time() - future.sent_at)
+
+	began = time.time()
+	for i in xrange(requests):
+		client.submit(service, "frame %d" % i).add_done_callback(done)
+	while client.in_flight:
+		client.pump(client.timeout)
+	elapsed = time.time() - began
+
+	worker.terminate()
+	worker.join()
+	latencies.sort()
+	return len(latencies) / elapsed, latencies
+
+def main():
+	requests = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+	broker = multiprocessing.Process(target=run_broker, args=(ENDPOINT,))
+	broker.daemon = True
+	broker.start()
+	client = MajordomoAsyncClient(window=WINDOW, brokers=[ENDPOINT])
+
+	print "pass = %dms + %dms/frame, %d requests in flight" % (1e3*OVERHEAD, 1e3*PER_FRAME, WINDOW)
+	print "%6s %6s %10s %10s %10s" % ("B", "T ms", "req/sec", "p50 ms", "p99 ms")
+	for batch_size in BATCH_SIZES:
+		for batch_wait in BATCH_WAITS:
+			rate, latencies = bench(client, batch_size, batch_wait, requests)
+			if not latencies:
+				print "%6d %6d %10s" % (batch_size, batch_wait, "no replies")
+				continue
+			print "%6d %6d %10.0f %10.1f %10.1f" % (batch_size, batch_wait, rate,
+					1e3*percentile(latencies, 0.5), 1e3*percentile(latencies, 0.99))
+
+	client.ctx.destroy(0)
+	broker.terminate()
+
+if __name__ == '__main__':
+	main()
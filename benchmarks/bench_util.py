@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+"""
+ Pieces shared by the benchmarks: an echo worker, broker and worker entry
+ points for threads or processes, and latency percentiles.
+"""
+
+import os
+import sys
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+from bolt_broker import MajordomoBroker
+from worker_api import MajordomoWorker
+
+class EchoWorker(MajordomoWorker):
+	def client_request_handler(self, request):
+		return request
+
+def run_broker(endpoint, **options):
+	"""
+	Serve a MajordomoBroker on endpoint, options passed on to it.
+	"""
+	MajordomoBroker(endpoint=endpoint, **options).serve_forever()
+
+def run_worker(endpoint, service):
+	EchoWorker(endpoint, service).serve_forever()
+
+def percentile(ordered, q):
+	"""
+	The q quantile of sorted samples, 0.0 if there are none.
+	"""
+	return ordered[int(q*(len(ordered) - 1))] if ordered else 0.0
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+ Micro-benchmark of the openface frame decoding.
+
+ Decodes a JPEG camera frame per resolution with the former getRep steps
+ (io.BytesIO, PIL, fliplr, fresh zeros array, channel by channel copy) and
+ with FrameDecoder, using cv2 if it is installed and PIL otherwise. The
+ convert columns time the mirror + RGB -> BGR step alone on a decoded frame.
+
+ usage: decode_bench.py [decodes per resolution]
+"""
+
+import io
+import os
+import sys
+import time
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+import numpy
+from PIL import Image
+import frame_decoder
+from frame_decoder import FrameDecoder
+
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 720), (1920, 1080)]
+
+def legacy_decode(data):
+	"""
+	getRep's decoding before FrameDecoder, with the size taken from the frame.
+	"""
+	return legacy_convert(numpy.asarray(Image.open(io.BytesIO(data))))
+
+def legacy_convert(rgb):
+	buf = numpy.fliplr(rgb)
+	rgbFrame = numpy.zeros(buf.shape, dtype=numpy.uint8)
+	rgbFrame[:, :, 0] = buf[:, :, 2]
+	rgbFrame[:, :, 1] = buf[:, :, 1]
+	rgbFrame[:, :, 2] = buf[:, :, 0]
+	return rgbFrame
+
+def camera_frame(width, height):
+	"""
+	A JPEG of a smooth gradient with some noise, like a camera would send.
+	"""
+	y, x = numpy.mgrid[0:height, 0:width]
+	rgb = numpy.dstack((x * 255 / width, y * 255 / height, (x + y) * 255 / (width + height)))
+	rgb = rgb + numpy.random.randint(0, 16, rgb.shape)
+	out = io.BytesIO()
+	Image.fromarray(rgb.clip(0, 255).astype(numpy.uint8)).save(out, "JPEG", quality=90)
+	return out.getvalue()
+
+def strided_convert(rgb, out):
+	numpy.copyto(out, rgb[:, ::-1, ::-1])
+
+def msec_per_call(decode, count, *args):
+	start = time.time()
+	for i in xrange(count):
+		decode(*args)
+	return 1e3*(time.time() - start)/count
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	decoder = FrameDecoder()
+	print "FrameDecoder uses %s" % ("cv2" if frame_decoder.cv2 is not None else "PIL")
+	print "%12s %8s %12s %12s %12s %12s" % ("resolution", "jpeg KB",
+			"legacy ms", "decoder ms", "convert ms", "strided ms")
+	for width, height in RESOLUTIONS:
+		data = camera_frame(width, height)
+		# same frame both ways, up to the rounding of different JPEG decoders
+		assert abs(legacy_decode(data).astype(int) - decoder.decode(data)).mean() < 1
+		view = memoryview(data) # as zero_copy workers get it
+		rgb = numpy.asarray(Image.open(io.BytesIO(data)))
+		print "%12s %8.0f %12.2f %12.2f %12.2f %12.2f" % ("%dx%d" % (width, height),
+				len(data)/1024.0,
+				msec_per_call(legacy_decode, count, data),
+				msec_per_call(decoder.decode, count, view),
+				msec_per_call(legacy_convert, count, rgb),
+				msec_per_call(strided_convert, count, rgb, numpy.empty_like(rgb)))
+
+if __name__ == '__main__':
+	main()
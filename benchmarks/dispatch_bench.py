@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+ Micro-benchmark of the broker's queue bookkeeping.
+
+ Times enqueue, dispatch and idle-worker removal at increasing queue depths,
+ and the liveness timers (purge, heartbeats) of a broker wakeup with as many
+ busy workers. Outgoing msgs are swallowed, so only the broker's data
+ structures are timed; the cost per op should stay flat as the depth grows.
+
+ usage: dispatch_bench.py [ops per depth]
+"""
+
+import os
+import sys
+import time
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+import MDP
+
+from collections import OrderedDict
+from bolt_broker import MajordomoBroker
+
+DEPTHS = [100, 1000, 10000, 100000]
+
+class NullSocket(object):
+	"""
+	Swallows outgoing msgs so only the broker bookkeeping is timed.
+	"""
+	def send(self, frame, *args, **kwargs):
+		pass
+
+	def send_multipart(self, msg, *args, **kwargs):
+		pass
+
+def reset(broker):
+	broker.services = {}
+	broker.workers = {}
+	broker.waiting = OrderedDict()
+	broker.busy = OrderedDict()
+	broker.expiries = []
+	broker.heartbeats = []
+
+def usec_per_op(start, ops):
+	return 1e6*(time.time() - start)/ops
+
+def bench_depth(broker, depth, ops):
+	"""
+	Returns (enqueue, dispatch, removal, timers) in usecs per op at the given depth.
+	"""
+	# enqueue: depth requests pile up while there are no workers.
+	reset(broker)
+	start = time.time()
+	for i in xrange(depth):
+		broker.process_client("c%07x" % i, ["echo", "frame"])
+	enqueue = usec_per_op(start, depth)
+
+	# dispatch: each READY takes one request from the front of the deep queue.
+	start = time.time()
+	for i in xrange(min(ops, depth)):
+		broker.process_worker("f%07x" % i, [MDP.W_READY, "echo"])
+	dispatch = usec_per_op(start, min(ops, depth))
+
+	# removal: drop idle workers from the middle of a depth-sized waiting set.
+	reset(broker)
+	for i in xrange(depth):
+		broker.process_worker("f%07x" % i, [MDP.W_READY, "echo"])
+	start = time.time()
+	for i in xrange(depth/2, depth/2 + min(ops, depth/2)):
+		broker.process_worker("f%07x" % i, [MDP.W_DISCONNECT])
+	removal = usec_per_op(start, min(ops, depth/2))
+
+	# timers: wakeups with depth busy workers, none of them expiring.
+	reset(broker)
+	for i in xrange(depth):
+		broker.process_client("c%07x" % i, ["echo", "frame"])
+		broker.process_worker("f%07x" % i, [MDP.W_READY, "echo"])
+	start = time.time()
+	for i in xrange(ops):
+		broker.run_timers()
+	timers = usec_per_op(start, ops)
+
+	return (enqueue, dispatch, removal, timers)
+
+def main():
+	ops = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+	broker = MajordomoBroker(endpoint="inproc://dispatch_bench")
+	broker.socket.close()
+	broker.socket = NullSocket()
+
+	print "%10s %14s %14s %14s %14s" % ("depth", "enqueue us/op", "dispatch us/op",
+			"remove us/op", "timers us/op")
+	for depth in DEPTHS:
+		enqueue, dispatch, removal, timers = bench_depth(broker, depth, ops)
+		print "%10d %14.2f %14.2f %14.2f %14.2f" % (depth, enqueue, dispatch, removal, timers)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+ Load imbalance benchmark of broker federation.
+
+ Starts one broker per node on localhost ports, each node a subprocess
+ with its own workers, and sends every request to the first node, which
+ has the fewest workers. The same load runs with the brokers alone and
+ with them peered, forwarding overflow to each other. Workers sleep
+ SERVICE_TIME per request, like an openface worker busy on a frame.
+
+ usage: federation_bench.py [-h] [--workers N,..] [--requests N] [--window N]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import multiprocessing
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+from bolt_broker import MajordomoBroker
+from worker_api import MajordomoWorker
+from client_api import MajordomoAsyncClient
+from bench_util import percentile
+
+ENDPOINT = "tcp://127.0.0.1:%d"
+BASE_PORT = 5600 					# node i listens on BASE_PORT + i
+SERVICE_TIME = 0.020 			# secs a worker spends on a request
+
+class SlowWorker(MajordomoWorker):
+	def client_request_handler(self, request):
+		time.sleep(SERVICE_TIME)
+		return request
+
+def run_node(endpoint, peers, service, workers):
+	"""
+	Process entry point: a broker and its workers, as threads.
+	"""
+	broker = MajordomoBroker(endpoint=endpoint.replace("127.0.0.1", "*"), peers=peers)
+	for i in xrange(workers):
+		worker = threading.Thread(target=SlowWorker(endpoint, service).serve_forever)
+		worker.daemon = True
+		worker.start()
+	broker.serve_forever()
+
+def bench(run, workers, peered, requests, window):
+	"""
+	Returns (replies/sec, sorted latencies in secs) of one run.
+	"""
+	# fresh ports and service per run, no worker of an earlier run is left
+	base = BASE_PORT + 10*run
+	endpoints = [ENDPOINT % (base + i) for i in xrange(len(workers))]
+	service = "work%d" % run
+	nodes = []
+	for index, count in enumerate(workers):
+		peers = [endpoint for endpoint in endpoints if endpoint != endpoints[index]] if peered else []
+		node = multiprocessing.Process(target=run_node, args=(endpoints[index], peers, service, count))
+		node.daemon = True
+		node.start()
+		nodes.append(node)
+	time.sleep(1.0) # let workers register and peers report their capacity
+
+	client = MajordomoAsyncClient(window=window, brokers=endpoints[:1])
+	client.timeout = 60000
+	latencies = []
+	def done(future):
+		if future.reply is not None:
+			latencies.append(time.time() - future.sent_at)
+
+	began = time.time()
+	for i in xrange(requests):
+		client.submit(service, "frame %d" % i).add_done_callback(done)
+	while client.in_flight:
+		client.pump(client.timeout)
+	elapsed = time.time() - began
+
+	client.ctx.destroy(0)
+	for node in nodes:
+		node.terminate()
+		node.join()
+	latencies.sort()
+	return len(latencies) / elapsed, latencies
+
+def main():
+	parser = argparse.ArgumentParser(description="Throughput of an overloaded broker, alone and peered.")
+	parser.add_argument("--workers", default="1,3,3",
+			help="workers per node, requests all go to the first node (default: 1,3,3)")
+	parser.add_argument("--requests", type=int, default=400, help="requests per run (default: 400)")
+	parser.add_argument("--window", type=int, default=16,
+			help="requests the client keeps in flight (default: 16)")
+	args = parser.parse_args()
+	workers = [int(count) for count in args.workers.split(",")]
+
+	print "%d nodes with %s workers, %dms per request, %d in flight" % (len(workers),
+			args.workers, 1e3*SERVICE_TIME, args.window)
+	print "%10s %10s %10s %10s" % ("brokers", "req/sec", "p50 ms", "p99 ms")
+	for run, peered in enumerate([False, True]):
+		rate, latencies = bench(run, workers, peered, args.requests, args.window)
+		print "%10s %10.0f %10.1f %10.1f" % ("peered" if peered else "alone", rate,
+				1e3*percentile(latencies, 0.5), 1e3*percentile(latencies, 0.99))
+
+if __name__ == '__main__':
+	main()
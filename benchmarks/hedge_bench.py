@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+ Tail latency benchmark of hedged requests.
+
+ One broker with WORKERS workers, each usually taking SERVICE_TIME per
+ request but STALL_TIME for a fraction --stalls of them, like a worker
+ paused by GC or a busy GPU. The same load runs without hedging and with
+ requests hedged after the given quantiles of the recent latencies.
+
+ usage: hedge_bench.py [-h] [--quantiles Q,..] [--stalls F] [--requests N] [--window N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import multiprocessing
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+from bolt_broker import MajordomoBroker
+from worker_api import MajordomoWorker
+from client_api import MajordomoAsyncClient
+from bench_util import percentile
+
+ENDPOINT = "tcp://127.0.0.1:5620"
+SERVICE = "work"
+WORKERS = 4
+SERVICE_TIME = 0.010 			# secs a worker usually spends on a request
+STALL_TIME = 0.300 				# secs it spends on a stalled one
+
+class StallingWorker(MajordomoWorker):
+	stalls = 0.0 				# fraction of requests stalled
+
+	def client_request_handler(self, request):
+		time.sleep(STALL_TIME if random.random() < self.stalls else SERVICE_TIME)
+		return request
+
+def run_node(stalls):
+	"""
+	Process entry point: the broker and its workers, as threads.
+	"""
+	broker = MajordomoBroker(endpoint=ENDPOINT.replace("127.0.0.1", "*"))
+	for i in xrange(WORKERS):
+		worker = StallingWorker(ENDPOINT, SERVICE)
+		worker.stalls = stalls
+		worker = threading.Thread(target=worker.serve_forever)
+		worker.daemon = True
+		worker.start()
+	broker.serve_forever()
+
+def bench(quantile, requests, window):
+	"""
+	Returns (sorted latencies in secs, duplicates sent) of one run.
+	"""
+	client = MajordomoAsyncClient(window=window, brokers=[ENDPOINT])
+	client.timeout = 60000
+	if quantile is not None:
+		client.set_hedging(quantile)
+	latencies = []
+	def done(future):
+		if future.reply is not None:
+			latencies.append(time.time() - future.sent_at)
+
+	for i in xrange(requests):
+		client.submit(SERVICE, "frame %d" % i).add_done_callback(done)
+	while client.in_flight:
+		client.pump(client.timeout)
+	client.ctx.destroy(0)
+	latencies.sort()
+	return latencies, client.hedged
+
+def main():
+	parser = argparse.ArgumentParser(description="Tail latency with and without hedged requests.")
+	parser.add_argument("--quantiles", default="0.99,0.95,0.9",
+			help="latency quantiles to hedge after (default: 0.99,0.95,0.9)")
+	parser.add_argument("--stalls", type=float, default=0.05,
+			help="fraction of requests stalled (default: 0.05)")
+	parser.add_argument("--requests", type=int, default=500, help="requests per run (default: 500)")
+	parser.add_argument("--window", type=int, default=2,
+			help="requests the client keeps in flight (default: 2)")
+	args = parser.parse_args()
+
+	node = multiprocessing.Process(target=run_node, args=(args.stalls,))
+	node.daemon = True
+	node.start()
+	time.sleep(0.5) # let workers register
+
+	print "%d workers, %dms per request, %.0f%% stalled for %dms, %d in flight" % (WORKERS,
+			1e3*SERVICE_TIME, 1e2*args.stalls, 1e3*STALL_TIME, args.window)
+	print "%10s %10s %10s %10s %10s" % ("hedging", "p50 ms", "p99 ms", "p99.9 ms", "extra %")
+	for quantile in [None] + [float(q) for q in args.quantiles.split(",")]:
+		latencies, hedged = bench(quantile, args.requests, args.window)
+		print "%10s %10.1f %10.1f %10.1f %10.1f" % ("off" if quantile is None else "p%g" % (1e2*quantile),
+				1e3*percentile(latencies, 0.5), 1e3*percentile(latencies, 0.99),
+				1e3*percentile(latencies, 0.999), 1e2*hedged/args.requests)
+
+	node.terminate()
+	node.join()
+
+if __name__ == '__main__':
+	main()
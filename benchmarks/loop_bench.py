@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+ Threads vs one event loop for a broker with I/O-bound workers.
+
+ Both runs serve the same load in one process: handlers wait IO_TIME per
+ request (a call out to a model server, a disk read), and a pipelined client
+ keeps --window requests in flight. The threaded run has the broker and
+ --slots MajordomoWorkers on threads of their own; the loop run has the
+ broker, one MajordomoLoopWorker with --slots slots and the client on one
+ bolt_loop.EventLoop, the handler a coroutine. Reports throughput, latency
+ and CPU time per request.
+
+ usage: loop_bench.py [-h] [--slots N] [--window N] [--requests N]
+"""
+
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+from bolt_broker import MajordomoBroker
+from bolt_loop import EventLoop, Return, gather
+from worker_api import MajordomoWorker, MajordomoLoopWorker
+from client_api import MajordomoAsyncClient
+from bench_util import percentile
+
+ENDPOINT = "tcp://127.0.0.1:%d"
+BASE_PORT = 5630 					# run i listens on BASE_PORT + i
+SERVICE = "io"
+IO_TIME = 0.020 					# secs a handler waits per request
+
+class ThreadWorker(MajordomoWorker):
+	def client_request_handler(self, request):
+		time.sleep(IO_TIME)
+		return request
+
+class LoopWorker(MajordomoLoopWorker):
+	def client_request_handler(self, request):
+		yield self.loop.sleep(IO_TIME)
+		raise Return(request)
+
+def cpu_secs():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+def bench_threads(endpoint, slots, window, requests):
+	"""
+	Returns (secs, sorted latencies in secs) of the threaded run.
+	"""
+	broker = MajordomoBroker(endpoint=endpoint)
+	threads = [threading.Thread(target=broker.serve_forever)]
+	for i in xrange(slots):
+		threads.append(threading.Thread(target=ThreadWorker(endpoint, SERVICE).serve_forever))
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	time.sleep(0.5) # let workers register
+
+	client = MajordomoAsyncClient(window=window, brokers=[endpoint])
+	latencies = []
+	def done(future):
+		if future.reply is not None:
+			latencies.append(time.time() - future.sent_at)
+
+	began = time.time()
+	for i in xrange(requests):
+		client.submit(SERVICE, "request %d" % i).add_done_callback(done)
+	while client.in_flight:
+		client.pump(client.timeout)
+	elapsed = time.time() - began
+	latencies.sort()
+	return elapsed, latencies
+
+def bench_loop(endpoint, slots, window, requests):
+	"""
+	Returns (secs, sorted latencies in secs) of the event loop run.
+	"""
+	loop = EventLoop()
+	MajordomoBroker(endpoint=endpoint).attach(loop)
+	LoopWorker(endpoint, SERVICE, loop, slots=slots)
+	client = MajordomoAsyncClient(window=window, brokers=[endpoint])
+	client.attach(loop)
+	latencies = []
+	def done(future):
+		if future.reply is not None:
+			latencies.append(time.time() - future.sent_at)
+
+	def requester(count):
+		for i in xrange(count):
+			future = client.submit(SERVICE, "request %d" % i)
+			future.add_done_callback(done)
+			yield future
+
+	def run():
+		yield loop.sleep(0.5) # let the worker register
+		began = time.time()
+		# window requesters, one request in flight each, as the threaded client keeps
+		yield gather([requester(requests // window) for i in xrange(window)])
+		raise Return(time.time() - began)
+
+	elapsed = loop.run_until_complete(run())
+	latencies.sort()
+	return elapsed, latencies
+
+def main():
+	parser = argparse.ArgumentParser(description="I/O-bound workers on threads or on one event loop.")
+	parser.add_argument("--slots", type=int, default=32,
+			help="worker threads, or slots of the loop worker (default: 32)")
+	parser.add_argument("--window", type=int, default=32,
+			help="requests the client keeps in flight (default: 32)")
+	parser.add_argument("--requests", type=int, default=2000, help="requests per run (default: 2000)")
+	args = parser.parse_args()
+
+	print "%d slots, handlers wait %dms, %d in flight" % (args.slots, 1e3*IO_TIME, args.window)
+	print "%10s %10s %10s %10s %12s" % ("run", "req/sec", "p50 ms", "p99 ms", "cpu us/req")
+	for run, (name, bench) in enumerate([("threads", bench_threads), ("loop", bench_loop)]):
+		cpu = cpu_secs()
+		elapsed, latencies = bench(ENDPOINT % (BASE_PORT + run), args.slots, args.window, args.requests)
+		cpu = cpu_secs() - cpu
+		print "%10s %10.0f %10.1f %10.1f %12.0f" % (name, len(latencies) / elapsed,
+				1e3*percentile(latencies, 0.5), 1e3*percentile(latencies, 0.99),
+				1e6*cpu / args.requests)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+ Load generator and benchmark suite for the MDP stack.
+
+ Starts a MajordomoBroker, N echo workers and M pipelined clients on
+ localhost, as threads of this process or as subprocesses, and sweeps
+ payload sizes, client counts and worker counts. Every point reports
+ throughput and p50/p99/p999 round trip latency. Results can be saved as
+ JSON and compared against an earlier run to catch regressions in broker
+ dispatch or the worker/client APIs.
+
+ usage: mdp_bench.py [-h] [--payloads N,..] [--clients N,..] [--workers N,..]
+                     [--window N] [--requests N] [--processes]
+                     [--output FILE] [--compare FILE] [--tolerance PCT]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import multiprocessing
+import Queue
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+import zmq
+
+from client_api import MajordomoAsyncClient
+from bench_util import percentile, run_broker, run_worker
+
+ENDPOINT = "tcp://127.0.0.1:5596"
+
+def run_client(service, payload, requests, window, start, results):
+	"""
+	Send requests echo requests, window in flight, then put
+	(replies, latencies in secs, secs taken) on results.
+	"""
+	client = MajordomoAsyncClient(window=window, brokers=[ENDPOINT])
+	body = os.urandom(payload)
+	latencies = []
+	def done(future):
+		if future.reply is not None:
+			latencies.append(time.time() - future.sent_at)
+
+	start.wait()
+	began = time.time()
+	for i in xrange(requests):
+		client.submit(service, body).add_done_callback(done)
+	while client.in_flight:
+		client.pump(client.timeout)
+	results.put((len(latencies), latencies, time.time() - began))
+	client.ctx.destroy(0)
+
+def spawn(processes, target, args):
+	"""
+	Start target as a daemon subprocess or thread.
+	"""
+	if processes:
+		runner = multiprocessing.Process(target=target, args=args)
+	else:
+		runner = threading.Thread(target=target, args=args)
+	runner.daemon = True
+	runner.start()
+	return runner
+
+def bench_point(index, payload, clients, workers, window, requests, processes):
+	"""
+	Run one point of the sweep, returns its result dict.
+	"""
+	# a service per point, so no request goes to a worker of an earlier point
+	service = "echo%d" % index
+	worker_runners = [spawn(processes, run_worker, (ENDPOINT, service)) for i in xrange(workers)]
+	time.sleep(0.5) # let the workers register
+
+	if processes:
+		start, results = multiprocessing.Event(), multiprocessing.Queue()
+	else:
+		start, results = threading.Event(), Queue.Queue()
+	for i in xrange(clients):
+		spawn(processes, run_client, (service, payload, requests, window, start, results))
+	time.sleep(0.2) # let the clients connect
+	began = time.time()
+	start.set()
+
+	replies = 0
+	latencies = []
+	for i in xrange(clients):
+		count, client_latencies, elapsed = results.get()
+		replies += count
+		latencies.extend(client_latencies)
+	elapsed = time.time() - began
+
+	if processes:
+		for runner in worker_runners:
+			runner.terminate()
+			runner.join()
+	# worker threads idle until the process ends, their service is never used again
+
+	latencies.sort()
+	return dict(payload=payload, clients=clients, workers=workers, window=window,
+			requests=clients*requests, replies=replies, secs=elapsed,
+			throughput=replies / elapsed, p50=percentile(latencies, 0.5),
+			p99=percentile(latencies, 0.99), p999=percentile(latencies, 0.999))
+
+def point_key(result):
+	return (result["payload"], result["clients"], result["workers"], result["window"])
+
+def compare(results, baseline, tolerance):
+	"""
+	Print each point against the same point of a baseline run.
+
+	Returns the number of points whose throughput dropped, or p99 grew, by
+	more than tolerance percent.
+	"""
+	base = dict((point_key(result), result) for result in baseline["results"])
+	regressions = 0
+	print
+	print "against %s (%s)" % (baseline["meta"]["label"] or "baseline", baseline["meta"]["date"])
+	print "%8s %8s %8s %12s %12s" % ("payload", "clients", "workers", "req/sec", "p99")
+	for result in results:
+		old = base.get(point_key(result))
+		if old is None:
+			continue
+		rate = 100.0*(result["throughput"] / old["throughput"] - 1)
+		p99 = 100.0*(result["p99"] / old["p99"] - 1) if old["p99"] else 0.0
+		worse = rate < -tolerance or p99 > tolerance
+		regressions += worse
+		print "%8d %8d %8d %+11.1f%% %+11.1f%%%s" % (result["payload"], result["clients"],
+				result["workers"], rate, p99, "  REGRESSION" if worse else "")
+	return regressions
+
+def int_list(text):
+	return [int(item) for item in text.split(",")]
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark broker, workers and clients on localhost.")
+	parser.add_argument("--payloads", type=int_list, default=[64, 4096, 65536],
+			help="request sizes in bytes (default: 64,4096,65536)")
+	parser.add_argument("--clients", type=int_list, default=[1, 4, 16],
+			help="concurrent clients (default: 1,4,16)")
+	parser.add_argument("--workers", type=int_list, default=[1, 4],
+			help="echo workers (default: 1,4)")
+	parser.add_argument("--window", type=int, default=1,
+			help="requests each client keeps in flight (default: 1)")
+	parser.add_argument("--requests", type=int, default=500,
+			help="requests per client per point (default: 500)")
+	parser.add_argument("--processes", action="store_true",
+			help="run broker, workers and clients as subprocesses instead of threads")
+	parser.add_argument("--label", default=None, help="name of this run in the JSON output")
+	parser.add_argument("--output", help="save the results as JSON to this file")
+	parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+	parser.add_argument("--tolerance", type=float, default=10.0,
+			help="percent of throughput or p99 change flagged as regression (default: 10)")
+	args = parser.parse_args()
+
+	spawn(args.processes, run_broker, (ENDPOINT,))
+	print "%d cpus, %s, %d requests per client, window %d" % (multiprocessing.cpu_count(),
+			"subprocesses" if args.processes else "threads", args.requests, args.window)
+	print "%8s %8s %8s %10s %10s %10s %10s" % ("payload", "clients", "workers",
+			"req/sec", "p50 ms", "p99 ms", "p999 ms")
+	results = []
+	for payload in args.payloads:
+		for clients in args.clients:
+			for workers in args.workers:
+				result = bench_point(len(results), payload, clients, workers, args.window,
+						args.requests, args.processes)
+				results.append(result)
+				print "%8d %8d %8d %10.0f %10.2f %10.2f %10.2f" % (payload, clients, workers,
+						result["throughput"], 1e3*result["p50"], 1e3*result["p99"],
+						1e3*result["p999"])
+
+	meta = dict(label=args.label, date=time.strftime("%Y-%m-%d %H:%M:%S"),
+			host=platform.node(), cpus=multiprocessing.cpu_count(),
+			python=platform.python_version(), zmq=zmq.zmq_version(), pyzmq=zmq.__version__,
+			processes=args.processes, requests=args.requests, window=args.window)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(dict(meta=meta, results=results), f, indent=1, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as f:
+			if compare(results, json.load(f), args.tolerance):
+				return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+ Simulation of the broker's worker selection policies.
+
+ One service, healthy workers and a few slow ones, Poisson arrivals at a
+ fraction of the total capacity. Requests queue and are dispatched like
+ MajordomoBroker.dispatch() does, picking workers with the schedulers of
+ bolt_sched.py and measuring them with Worker.observe_latency(); time is
+ simulated, so no sockets are involved. Prints request latency (queueing +
+ service) per policy and load.
+
+ usage: sched_bench.py [requests per run]
+"""
+
+import os
+import sys
+import heapq
+import random
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+
+from bolt_broker import Service, Worker
+from bolt_sched import SCHEDULERS
+from bench_util import percentile
+
+# (workers, mean service secs): a healthy pool plus two stragglers
+WORKERS = [(10, 0.050), (2, 0.500)]
+LOADS = [0.5, 0.7, 0.9] 				# arrival rate over total capacity
+POLICIES = ["fifo", "least-latency", "p2c"]
+SEED = 7
+
+def simulate(policy, load, requests):
+	"""
+	Returns the sorted latencies (secs) of requests requests.
+	"""
+	rng = random.Random(SEED)
+	random.seed(SEED) # p2c samples with the module random
+	scheduler = SCHEDULERS[policy]()
+	service = Service("sim")
+	means = {}
+	for count, mean in WORKERS:
+		for i in xrange(count):
+			worker = Worker("w%02d" % len(means), 0)
+			worker.service = service
+			worker.credit = 1
+			service.waiting[worker.worker_id] = worker
+			means[worker.worker_id] = mean
+	rate = load * sum(count/mean for count, mean in WORKERS)
+
+	now = 0.0
+	next_arrival = rng.expovariate(rate)
+	arrived = 0
+	running = [] # (done at, worker, arrived at, started at)
+	latencies = []
+	while arrived < requests or running:
+		if arrived < requests and (not running or next_arrival <= running[0][0]):
+			now = next_arrival
+			service.requests.append(now)
+			arrived += 1
+			next_arrival += rng.expovariate(rate)
+		else:
+			now, worker, arrival, started = heapq.heappop(running)
+			worker.observe_latency(now - started)
+			latencies.append(now - arrival)
+			service.waiting[worker.worker_id] = worker
+
+		while service.waiting and service.requests:
+			worker_id, worker = scheduler.pick(service)
+			del service.waiting[worker_id]
+			arrival = service.requests.popleft()
+			duration = means[worker_id] * rng.uniform(0.5, 1.5)
+			heapq.heappush(running, (now + duration, worker, arrival, now))
+
+	latencies.sort()
+	return latencies
+
+def main():
+	requests = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	print "workers %s, %d requests per run" % (
+			", ".join("%d x %dms" % (count, 1e3*mean) for count, mean in WORKERS), requests)
+	print "%6s %14s %10s %10s %10s" % ("load", "policy", "mean ms", "p50 ms", "p99 ms")
+	for load in LOADS:
+		for policy in POLICIES:
+			latencies = simulate(policy, load, requests)
+			mean = sum(latencies) / len(latencies)
+			print "%6.1f %14s %10.1f %10.1f %10.1f" % (load, policy, 1e3*mean,
+					1e3*percentile(latencies, 0.5), 1e3*percentile(latencies, 0.99))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+ Throughput of the single-loop MajordomoBroker against the ShardedBroker.
+
+ Every run starts a broker, echo workers for several services and clients in
+ separate processes on localhost, then counts round trips per second.
+
+ usage: shard_bench.py [requests per client]
+"""
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+from bolt_broker import MajordomoBroker
+from bolt_shard import ShardedBroker
+from client_api import MajordomoClient
+from bench_util import run_worker
+
+ENDPOINT = "tcp://127.0.0.1:5599"
+SERVICES = 4 						# echo0 .. echo3
+WORKERS_PER_SERVICE = 2
+CLIENTS = 8
+# (label, shards, processes); shards == 0 means the single-loop broker
+MODES = [
+	("single", 0, False),
+	("2 shards/threads", 2, False),
+	("2 shards/procs", 2, True),
+	("4 shards/procs", 4, True),
+]
+
+def run_broker(shards, processes):
+	# exit cleanly on terminate() so shard processes are reaped with us
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	if shards:
+		broker = ShardedBroker(shards, batch_size=64, endpoint=ENDPOINT, processes=processes)
+	else:
+		broker = MajordomoBroker(endpoint=ENDPOINT)
+	try:
+		broker.serve_forever()
+	finally:
+		# reap shard processes; shard threads die with this process
+		if processes:
+			broker.destroy()
+
+def run_client(index, requests, start, results):
+	client = MajordomoClient(brokers=[ENDPOINT])
+	service = "echo%d" % (index % SERVICES)
+	start.wait()
+	done = 0
+	for i in xrange(requests):
+		client.send(service, "frame %d" % i)
+		if client.recv() is None:
+			break
+		done += 1
+	results.put(done)
+
+def bench(shards, processes, requests):
+	"""
+	Returns round trips per second for one broker mode.
+	"""
+	# not a daemon: a daemon process may not fork shard processes
+	broker = multiprocessing.Process(target=run_broker, args=(shards, processes))
+	broker.start()
+	procs = []
+	for service in xrange(SERVICES):
+		for i in xrange(WORKERS_PER_SERVICE):
+			procs.append(multiprocessing.Process(target=run_worker, args=(ENDPOINT, "echo%d" % service)))
+
+	start = multiprocessing.Event()
+	results = multiprocessing.Queue()
+	clients = [multiprocessing.Process(target=run_client, args=(i, requests, start, results))
+			for i in xrange(CLIENTS)]
+	for proc in procs + clients:
+		proc.daemon = True
+		proc.start()
+
+	time.sleep(1.0) # let workers register
+	began = time.time()
+	start.set()
+	done = sum(results.get() for i in xrange(CLIENTS))
+	elapsed = time.time() - began
+
+	for proc in clients + procs + [broker]:
+		proc.terminate()
+		proc.join()
+	return done / elapsed
+
+def main():
+	requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	print "%d cpus, %d services x %d workers, %d clients x %d requests" % (
+			multiprocessing.cpu_count(), SERVICES, WORKERS_PER_SERVICE, CLIENTS, requests)
+	print "%20s %12s" % ("broker", "req/sec")
+	for label, shards, processes in MODES:
+		print "%20s %12.0f" % (label, bench(shards, processes, requests))
+
+if __name__ == '__main__':
+	main()
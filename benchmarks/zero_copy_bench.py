@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+ Round trips through broker and echo worker for payloads of 1 KB to 4 MB,
+ with every frame copied into Python strings against the zero-copy path
+ (broker copy_threshold, worker zero_copy).
+
+ usage: zero_copy_bench.py [MB sent per payload size]
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+fileDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(fileDir, "../bolt"))
+sys.path.append(os.path.join(fileDir, "../samples/python"))
+
+from bolt_broker import MajordomoBroker
+from worker_api import MajordomoWorker
+from client_api import MajordomoClient
+from bench_util import run_broker
+
+ENDPOINT = "tcp://127.0.0.1:5598"
+SIZES = [1 << 10, 16 << 10, 256 << 10, 1 << 20, 4 << 20]
+
+class SizeWorker(MajordomoWorker):
+	"""
+	Replies with the payload size, so only the request path carries the payload.
+	"""
+	def client_request_handler(self, request):
+		return [str(len(request[0]))]
+
+def run_worker(zero_copy):
+	worker = SizeWorker(ENDPOINT, "echo")
+	worker.zero_copy = zero_copy
+	worker.serve_forever()
+
+def bench(zero_copy, megabytes):
+	"""
+	Returns [(payload size, round trips/sec, MB/sec)] for one mode.
+	"""
+	procs = [multiprocessing.Process(target=run_broker, args=(ENDPOINT,),
+				kwargs=dict(copy_threshold=MajordomoBroker.COPY_THRESHOLD if zero_copy else None)),
+			multiprocessing.Process(target=run_worker, args=(zero_copy,))]
+	for proc in procs:
+		proc.daemon = True
+		proc.start()
+	time.sleep(1.0) # let the worker register
+
+	client = MajordomoClient(brokers=[ENDPOINT])
+	results = []
+	for size in SIZES:
+		payload = os.urandom(size)
+		requests = max(20, (megabytes << 20) / size)
+		began = time.time()
+		for i in xrange(requests):
+			client.send("echo", payload)
+			assert client.recv() == [str(size)]
+		elapsed = time.time() - began
+		results.append((size, requests / elapsed, requests*size / elapsed / (1 << 20)))
+
+	client.ctx.destroy(0)
+	for proc in procs:
+		proc.terminate()
+		proc.join()
+	return results
+
+def main():
+	megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+	copied = bench(False, megabytes)
+	zero = bench(True, megabytes)
+	print "%10s %14s %14s %14s %14s" % ("payload", "copy req/s", "copy MB/s", "0-copy req/s", "0-copy MB/s")
+	for (size, copy_rate, copy_mb), (size, zero_rate, zero_mb) in zip(copied, zero):
+		print "%9dK %14.0f %14.1f %14.0f %14.1f" % (size >> 10, copy_rate, copy_mb, zero_rate, zero_mb)
+
+if __name__ == '__main__':
+	main()
@@ -2,6 +2,34 @@
 #  This is the version of MDP/Client we implement
 C_CLIENT = "MDPC01"
 
+#  MDP/Client with request headers: the service name is followed by header
+#  frames up to an empty frame, then the body. Broker and worker carry the
+#  headers in the reply envelope and hand them back unchanged in the reply.
+C_CLIENT_H = "MDPC01H"
+
+#  Request header frames, a one-byte tag followed by the value
+H_CORRELATION   =   "c"     # correlation id, matches a reply to its request
+H_STATUS        =   "s"     # status code of a reply the broker answered itself
+H_CREDIT        =   "k"     # free room left in a bounded service queue
+H_DEADLINE      =   "d"     # time.time() after which nobody waits for the reply
+                            # (broker and worker hosts need synced clocks)
+H_DISPATCH      =   "r"     # reserved for the broker: tags a request in flight
+                            # on a worker, the worker echoes it in the reply
+H_TRACE         =   "t"     # trace id and timestamps of a sampled request, must be
+                            # the first request header (see bolt_trace.py)
+H_FORWARD       =   "f"     # forward id of a request a peer broker forwarded, which
+                            # is never forwarded again
+
+#  Status codes, sent in a status header, or as the reply body to plain
+#  MDPC01 clients (like the 8/MMI return codes)
+S_OVERLOADED    =   "503"   # service queue full, request rejected or dropped
+S_EXPIRED       =   "504"   # deadline passed before a worker got to it
+S_LOST          =   "502"   # the worker died with the request, not redelivered
+S_BAD_REQUEST   =   "400"   # malformed request the worker couldn't parse
+S_FAILED        =   "500"   # the worker's handler failed on the request
+S_SUPERSEDED    =   "409"   # replaced in the queue by a newer request of the same
+                            # client (the "latest" overflow policy)
+
 #  This is the version of MDP/Worker we implement
 W_WORKER = "MDPW01"
 
@@ -13,3 +41,17 @@ W_HEARTBEAT     =   "\004"
 W_DISCONNECT    =   "\005"
 
 commands = [None, "READY", "REQUEST", "REPLY", "HEARTBEAT", "DISCONNECT"]
+
+def header(frames, tag, start=0):
+	"""
+	Returns the value of the first header frame with tag, or None.
+
+	Scans frames from start up to the first empty frame.
+	"""
+	for i in xrange(start, len(frames)):
+		frame = frames[i]
+		if not frame:
+			break
+		if frame[:1] == tag:
+			return frame[1:]
+	return None
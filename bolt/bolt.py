@@ -1,36 +1,103 @@
 #!/usr/bin/env python
 
-import SocketServer
+import argparse
 import threading
 import sys
-import time
 
-from bolt_broker import MajordomoBroker
-from bolt_discovery import UDPReceivedHandler
+from bolt_broker import MajordomoBroker, OVERFLOW_POLICIES, OVERFLOW_REJECT
+from bolt_shard import ShardedBroker
+from bolt_sched import SCHEDULERS
+from bolt_metrics import serve_metrics
+from bolt_spill import FSYNC_MODES, FSYNC_NEVER
+from bolt_discovery import DiscoveryServer
+from bolt_loop import EventLoop, add_server
 
-def main(): 
-	broker_server = MajordomoBroker()
-	discovery_server = SocketServer.UDPServer(("0.0.0.0", 5555), UDPReceivedHandler)
+def parse_cache(spec):
+	"""
+	SERVICE=TTL -> (service name, ttl secs)
+	"""
+	name, sep, ttl = spec.rpartition("=")
+	try:
+		if name and float(ttl) > 0:
+			return name, float(ttl)
+	except ValueError:
+		pass
+	raise argparse.ArgumentTypeError("want SERVICE=TTL, got %r" % spec)
 
-	broker_server_thread = threading.Thread(target=broker_server.serve_forever)
-	discovery_server_thread = threading.Thread(target=discovery_server.serve_forever)
+def main(): 
+	parser = argparse.ArgumentParser(description="Bolt broker and discovery server.")
+	parser.add_argument("--shards", type=int, default=1,
+			help="number of dispatch shards, each owning a subset of services (default: 1, unsharded)")
+	parser.add_argument("--processes", action="store_true",
+			help="run shards as processes instead of threads")
+	parser.add_argument("--queue-limit", type=int, default=0,
+			help="max queued requests per service (default: 0, unbounded)")
+	parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=OVERFLOW_REJECT,
+			help="what a full service queue does with a request (default: reject)")
+	parser.add_argument("--idempotent", action="append", default=[], metavar="SERVICE",
+			help="redeliver requests of SERVICE lost with their worker (repeatable)")
+	parser.add_argument("--max-retries", type=int, default=MajordomoBroker.MAX_RETRIES,
+			help="redeliveries of a lost request (default: %d)" % MajordomoBroker.MAX_RETRIES)
+	parser.add_argument("--scheduler", choices=sorted(SCHEDULERS), default="fifo",
+			help="how a request picks among waiting workers (default: fifo)")
+	parser.add_argument("--cache", action="append", default=[], type=parse_cache, metavar="SERVICE=TTL",
+			help="answer repeated requests of SERVICE from a reply cache for TTL secs (repeatable)")
+	parser.add_argument("--cache-bytes", type=int, default=MajordomoBroker.CACHE_BYTES,
+			help="byte budget of the reply cache (default: %d)" % MajordomoBroker.CACHE_BYTES)
+	parser.add_argument("--metrics-port", type=int, default=0,
+			help="serve Prometheus metrics on http://0.0.0.0:PORT/metrics (default: off)")
+	parser.add_argument("--spill-dir", default=None,
+			help="spill service queues past --spill-bytes to journals in this directory, "
+			"resumed on restart (default: off)")
+	parser.add_argument("--spill-bytes", type=int, default=MajordomoBroker.SPILL_BYTES,
+			help="bytes of requests a service queues in memory before spilling (default: %d)"
+			% MajordomoBroker.SPILL_BYTES)
+	parser.add_argument("--peer", action="append", default=[], metavar="ENDPOINT",
+			help="forward overflow to the peer broker at ENDPOINT, e.g. tcp://node2:5555 (repeatable)")
+	parser.add_argument("--fsync", choices=FSYNC_MODES, default=FSYNC_NEVER,
+			help="when spilled requests are synced to disk (default: never, left to the OS)")
+	parser.add_argument("--copy-threshold", type=int, default=0,
+			help="forward frames larger than this many bytes zero-copy, worth it for payloads of "
+			"several hundred KB, e.g. %d (default: 0, copy all)" % MajordomoBroker.COPY_THRESHOLD)
+	args = parser.parse_args()
+	if args.metrics_port and args.shards > 1 and args.processes:
+		# shard processes keep their stats to themselves
+		parser.error("--metrics-port needs shards running as threads")
+	if args.peer and args.shards > 1:
+		# a peer's capacity query would only reach one shard
+		parser.error("--peer needs an unsharded broker")
 
-	broker_server_thread.daemon = True
-	discovery_server_thread.daemon = True
+	options = dict(queue_limit=args.queue_limit, overflow=args.overflow,
+			idempotent=args.idempotent, max_retries=args.max_retries,
+			scheduler=args.scheduler, cache_bytes=args.cache_bytes,
+			cache_ttls=dict(args.cache), spill_dir=args.spill_dir,
+			spill_bytes=args.spill_bytes, fsync=args.fsync, peers=args.peer,
+			copy_threshold=args.copy_threshold or None)
+	# the broker, discovery and metrics servers share one thread and loop,
+	# but for the front-end of a sharded broker, which has a thread of its own.
+	loop = EventLoop()
+	if args.shards > 1:
+		broker_server = ShardedBroker(args.shards, processes=args.processes, **options)
+		broker_server_thread = threading.Thread(target=broker_server.serve_forever)
+		broker_server_thread.daemon = True
+		broker_server_thread.start()
+	else:
+		broker_server = MajordomoBroker(**options)
+		broker_server.attach(loop)
+	if args.metrics_port:
+		serve_metrics(broker_server.shards if args.shards > 1 else [broker_server],
+				args.metrics_port, loop=loop)
+	discovery_server = DiscoveryServer(load=broker_server.load)
+	add_server(loop, discovery_server)
 
 	exit_status = 1
 
 	try:
-		broker_server_thread.start()
-		discovery_server_thread.start()
-
-		while True:
-			time.sleep(100)
-	except Exception as e:
-		sys.stderr.write(str(e))
-	except KeyboardInterrupt as e:
+		loop.run_forever() # until KeyboardInterrupt
 		sys.stdout.write("Exit by user\n")
 		exit_status = 0
+	except Exception as e:
+		sys.stderr.write(str(e))
 	#finally:
 		#if broker_server is not None:
 		#	broker_server.terminate()
@@ -8,41 +8,131 @@
 """
 
 import logging
+import os
 import sys
 import time
 import zmq
 import binascii
+import heapq
+import json
 import SocketServer
+from collections import deque, OrderedDict
 
 import MDP
-from zhelpers import dump
+from zhelpers import dump, unpack_frames
 from bolt_discovery import UDPReceivedHandler
+from bolt_sched import SCHEDULERS
+from bolt_cache import ResultCache, request_key
+from bolt_metrics import Histogram
+from bolt_spill import Journal, FSYNC_NEVER, frames_size
+import bolt_trace
+
+# What a bounded service queue does with a request once it is full
+OVERFLOW_REJECT = "reject" 				# answer the client with MDP.S_OVERLOADED
+OVERFLOW_DROP_OLDEST = "drop-oldest" 	# drop the request at the head of the queue
+OVERFLOW_DROP_NEWEST = "drop-newest" 	# drop the incoming request
+OVERFLOW_LATEST = "latest" 				# keep only the latest request per client,
+												# then drop the oldest if still full
+# dropped requests of header clients are answered with MDP.S_OVERLOADED,
+# or MDP.S_SUPERSEDED if a newer one took their place.
+OVERFLOW_POLICIES = [OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_LATEST]
 
 class Service(object):
 	"""
 	a single Service
 	"""
 	name = None 			# Service name
-	requests = None 		# List of client requests
-	waiting = None 		# List of waiting workers's id
+	requests = None 		# Queue of [queued at, client request], mutable for OVERFLOW_LATEST
+	waiting = None 		# Waiting workers, worker_id -> Worker, oldest first
+	max_requests = 0 		# queue limit, 0 for unbounded
+	overflow = OVERFLOW_REJECT 	# what to do once max_requests are queued
+	latest = None 			# client -> its entry in requests, for OVERFLOW_LATEST
+	dropped = 0 			# requests dropped by the overflow policy
+	rejected = 0 			# requests rejected by the overflow policy
+	expired = 0 			# requests dropped for a passed deadline
+	idempotent = False 	# requests may run twice, so lost ones are redelivered
+	redelivered = 0 		# requests requeued after their worker died
+	lost = 0 				# requests lost with their worker
+	forwarded = 0 			# requests forwarded to a peer broker
+	cache_ttl = 0 			# secs replies are cached by request body, 0 for no caching
+	cache_hits = 0 		# requests answered from the reply cache
+	cache_misses = 0 		# requests of a cached service that went to a worker
+	received = 0 			# requests received
+	stats_received = 0 	# received at the last stats tick
+	request_rate = 0.0 	# requests/sec over the last STATS_INTERVAL
+	wait_time = None 		# Histogram of secs requests waited for a worker
+	service_time = None 	# Histogram of secs from REQUEST to REPLY
+	journal = None 		# bolt_spill.Journal of the requests past spill_bytes, None to keep all in RAM
+	spill_bytes = 0 		# memory budget of the queue, in bytes of frames
+	queued_bytes = 0 		# bytes of the requests queued in RAM, counted with a journal only
 
-	def __init__(self, name):
+	def __init__(self, name, max_requests=0, overflow=OVERFLOW_REJECT, idempotent=False):
+		assert overflow in OVERFLOW_POLICIES
 		self.name = name
-		self.requests = []
-		self.waiting = []
+		self.wait_time = Histogram()
+		self.service_time = Histogram()
+		self.idempotent = idempotent
+		self.requests = deque()
+		self.waiting = OrderedDict()
+		self.max_requests = max_requests
+		self.overflow = overflow
+		self.latest = {}
+
+	def queued(self):
+		"""
+		Requests waiting for a worker, in RAM and spilled.
+		"""
+		return len(self.requests) + (len(self.journal) if self.journal is not None else 0)
 
 
 class Worker(object):
 	"""
 	a Worker, idle or active
 	"""
-	worker_id = None 					# hex Identity of worker, can be used as address
+	worker_id = None 					# raw Identity of worker, used as address
 	service = None 					# Owning service, if known
-	expiry = None 						# expires at this point, unless heartbeat
+	expiry = None 						# expires at this point, unless it sends us anything
+	heartbeat_at = None 				# gets a HEARTBEAT at this point, unless sent a request
+	heartbeat_queued = False 		# in the broker's heartbeats heap
+	slots = 1 							# concurrent requests the worker advertised
+	credit = 0 							# free slots, the worker is waiting while > 0
+	requests = None 					# dispatch tag -> (request, dispatched at), oldest first
+	latency = 0.0 						# EWMA of secs from REQUEST to REPLY, 0 until measured
+
+	EWMA_ALPHA = 0.3 					# weight of the newest latency sample
 
 	def __init__(self, worker_id, lifetime):
 		self.worker_id = worker_id
 		self.expiry = time.time() + 1e-3*lifetime
+		self.requests = OrderedDict()
+
+	def observe_latency(self, sample):
+		"""
+		Fold one REQUEST to REPLY time (secs) into the latency EWMA.
+		"""
+		if self.latency:
+			self.latency += self.EWMA_ALPHA * (sample - self.latency)
+		else:
+			self.latency = sample
+
+
+class Peer(object):
+	"""
+	a peer broker, taking the requests our workers can't
+	"""
+	endpoint = None 					# its broker endpoint
+	socket = None 						# DEALER connected to it, we are one of its clients
+	alive = False 						# it answered since we (re)connected
+	heard_at = 0.0 					# when it last answered
+	capacity = None 					# service name -> free worker slots, as it last reported
+	forwarded = None 					# forward id -> (service name, request, queued at, forwarded at),
+											# oldest first
+
+	def __init__(self, endpoint, now):
+		self.endpoint = endpoint
+		self.heard_at = now
+		self.capacity = {}
+		self.forwarded = OrderedDict()
 
 
 class MajordomoBroker(object):
@@ -55,102 +145,412 @@ class MajordomoBroker(object):
 	HEARTBEAT_LIVENESS = 3 				# 3-5 is reasonable
 	HEARTBEAT_INTERVAL = 2500 			# msecs
 	HEARTBEAT_EXPIRY = HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+	STATS_INTERVAL = 5000 				# msecs, how often the msg rate is recomputed
+	PEER_INTERVAL = 250 					# msecs, how often peers are asked for their capacity
+	PEER_EXPIRY = 3000 					# msecs of silence before a peer is given up on
+	FORWARD_TIMEOUT = 30000 			# msecs a peer has to reply to a forwarded request
+	BATCH_SIZE = 64 						# max msgs drained per poll wakeup
+	MAX_RETRIES = 2 						# redeliveries of a request whose worker died
+	COPY_THRESHOLD = zmq.COPY_THRESHOLD 	# bytes (64K), a copy_threshold for large payloads
+	CACHE_BYTES = 64 << 20 				# byte budget of the reply cache
+	SPILL_BYTES = 16 << 20 				# memory budget of a service queue with spill_dir
 
 	ctx = None 								# Our context
 	socket = None 							# Socket for clients & workers
 	poller = None 							# our Poller
 
-	heartbeat_at = None					# When to send HEARTBEAT
+	stats_at = None 						# When to recompute msg_rate
+	peer_at = None 						# When to ask peers for their capacity
 	services = None 						# known services
 	workers = None 						# known workers
-	waiting = None 						# idle workers
+	waiting = None 						# idle workers, worker_id -> Worker, oldest first
+	busy = None 							# workers with requests in flight, worker_id -> Worker
+	expiries = None 						# heap of (expiry, worker_id, Worker), one per worker
+	heartbeats = None 					# heap of (heartbeat_at, worker_id, Worker), one per waiting worker
+	dispatch_seq = 0 						# numbers the dispatch tags
+	peers = None 							# Peer brokers overflow is forwarded to
+	forward_seq = 0 						# numbers the forward ids
+
+	batch_size = BATCH_SIZE 			# max msgs drained per poll wakeup
+	copy_threshold = None 				# larger frames stay zmq.Frame, None to copy all
+	msg_count = 0 							# msgs received since start
+	msg_rate = 0.0 						# msgs/sec over the last STATS_INTERVAL
+	stats_count = 0 						# msg_count at the last stats tick
+
+	queue_limit = 0 						# max_requests of new services, 0 for unbounded
+	overflow = OVERFLOW_REJECT 			# overflow policy of new services
+	idempotent = None 					# names of the services whose requests are redelivered
+	max_retries = MAX_RETRIES 			# redeliveries of a request whose worker died
+	scheduler = None 						# picks the waiting worker of a request, see bolt_sched.py
+	cache = None 							# ResultCache of the services with a cache_ttl
+	cache_ttls = None 					# service name -> cache_ttl of new services
+	spill_dir = None 						# directory of the service journals, None for no spilling
+	spill_bytes = SPILL_BYTES 			# memory budget of each service queue
+	fsync = FSYNC_NEVER 					# when journals are synced to disk, see bolt_spill.py
+	journals = None 						# journals of the services
+	loop = None 							# bolt_loop.EventLoop serving the broker, see attach()
+	timer = None 							# loop Timer of the next run_timers()
 
 	verbose = False 						# Print activity to stdout
 
-	
-	def __init__(self, verbose=False):
+
+	def __init__(self, verbose=False, batch_size=BATCH_SIZE, endpoint="tcp://*:5555",
+			ctx=None, socket_type=zmq.ROUTER, queue_limit=0, overflow=OVERFLOW_REJECT,
+			copy_threshold=None, idempotent=(), max_retries=MAX_RETRIES,
+			scheduler="fifo", cache_ttls=None, cache_bytes=CACHE_BYTES,
+			spill_dir=None, spill_bytes=SPILL_BYTES, fsync=FSYNC_NEVER, peers=()):
 		"""
 		Initialize broker state.
+
+		ctx and socket_type let a broker run as a shard behind a front-end
+		(see bolt_shard.py): it then shares the front-end's context and talks
+		to it over a DEALER socket, with frames still routed by identity.
+
+		queue_limit and overflow bound the request queue of every service,
+		see also set_queue_limit().
+
+		Frames larger than copy_threshold bytes (image payloads) are received
+		with copy=False and forwarded as zmq.Frame, never copied into Python
+		strings; None (the default) receives every frame as a copy. Receiving
+		with copy=False costs 10-20% below a few hundred KB (see
+		zero_copy_bench.py), so it only pays off for large payloads.
+
+		Requests in flight on a worker that dies are redelivered up to
+		max_retries times if their service is named in idempotent (see also
+		set_idempotent()), else the client is answered with MDP.S_LOST.
+
+		scheduler names the policy picking a service's worker for each request
+		(a key of bolt_sched.SCHEDULERS), or is a scheduler object.
+
+		cache_ttls maps service names to the secs their replies are cached,
+		keyed by request body, within cache_bytes (see also set_cache_ttl()).
+
+		With a spill_dir, requests queued past spill_bytes on a service are
+		spilled to a journal under it (see bolt_spill.py) and read back in
+		order as workers free up; fsync is a bolt_spill.FSYNC_MODES mode.
+		Journals left by an earlier broker are resumed, their requests are
+		run, though replies to clients of that broker have nowhere to go.
+		Requests still in RAM die with the broker, spill_bytes 0 journals
+		them all. Services with OVERFLOW_LATEST never spill.
+
+		peers are the endpoints of peer brokers. Each is asked for its free
+		worker slots per service every PEER_INTERVAL, and requests queued
+		here while no worker of their service is waiting are forwarded to
+		the peer with the most free slots for it. Replies come back through
+		this broker. Forwarded requests a peer takes down with it are
+		redelivered or lost like those of a dead worker.
 		"""
+		assert batch_size >= 1
+		assert overflow in OVERFLOW_POLICIES
 		self.verbose = verbose
+		self.batch_size = batch_size
+		self.queue_limit = queue_limit
+		self.overflow = overflow
+		self.copy_threshold = copy_threshold
+		self.idempotent = set(idempotent)
+		self.max_retries = max_retries
+		self.scheduler = SCHEDULERS[scheduler]() if isinstance(scheduler, basestring) else scheduler
+		self.cache = ResultCache(cache_bytes)
+		self.cache_ttls = dict(cache_ttls or {})
+		self.spill_dir = spill_dir
+		self.spill_bytes = spill_bytes
+		self.fsync = fsync
+		self.journals = []
 		self.services = {}
 		self.workers = {}
-		self.waiting = []
-		self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
-		self.ctx = zmq.Context()
-		self.socket = self.ctx.socket(zmq.ROUTER)
+		self.waiting = OrderedDict()
+		self.busy = OrderedDict()
+		self.expiries = []
+		self.heartbeats = []
+		now = time.time()
+		self.stats_at = now + 1e-3*self.STATS_INTERVAL
+		self.peer_at = now
+		self.ctx = ctx or zmq.Context()
+		self.socket = self.ctx.socket(socket_type)
 		self.socket.linger = 0
 		self.poller = zmq.Poller()
 		self.poller.register(self.socket, zmq.POLLIN)
+		self.peers = []
+		for peer_endpoint in peers:
+			peer = Peer(peer_endpoint, now)
+			self.connect_peer(peer)
+			self.peers.append(peer)
 		logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S",level=logging.INFO)
-		self.bind("tcp://*:5555")
+		if spill_dir is not None and os.path.isdir(spill_dir):
+			# journals of an earlier broker, named by hex service name
+			for name in sorted(os.listdir(spill_dir)):
+				try:
+					service = self.get_service(binascii.unhexlify(name))
+				except TypeError:
+					continue # not a journal
+				if service.journal is not None and len(service.journal):
+					logging.info("I: service %s: %d spilled requests recovered",
+							service.name, len(service.journal))
+		self.bind(endpoint)
 
-	def serve_forever(self):
+	def serve_forever(self, stop=None):
 		"""
 		Main broker work happens here
 		Wait for the msgs from client & worker, then process them.
+
+		stop is an optional socket, any msg on it ends the loop (how a
+		front-end stops a shard thread, see bolt_shard.py).
 		"""
 		logging.info("Bolt Broker started.")
+		if stop is not None:
+			self.poller.register(stop, zmq.POLLIN)
 
 		while True:
 			try:
-				items = self.poller.poll(self.HEARTBEAT_INTERVAL)
+				items = self.poller.poll(self.next_timeout())
 			except KeyboardInterrupt:
 				break # Interrupted
-				
-			# received a msg.
+
+			# received msgs, drain everything that is ready (up to batch_size).
 			if items:
-				msg = self.socket.recv_multipart()
-				#if self.verbose:
-				#	logging.info("I: received message:")
-				#	dump(msg)
-
-				# handle the received msg.
-				#print msg
-				self.msg_handler(msg)
-			
-			self.purge_workers()
-			self.send_heartbeats()
-      	#self.purge_workers()
-      	#self.send_heartbeats()    
+				if self.peers or stop is not None:
+					items = dict(items)
+					if stop in items:
+						break # Stopped
+					for peer in self.peers:
+						if peer.socket in items:
+							self.recv_peer(peer)
+					if self.socket in items:
+						self.recv_batch()
+				else:
+					self.recv_batch()
+
+			# timers run once per wakeup, not once per msg.
+			self.run_timers()
+
+	def attach(self, loop):
+		"""
+		Serve on loop (see bolt_loop.py) instead of serve_forever(), on one
+		thread with the discovery and metrics servers, workers and clients
+		attached to it. As in serve_forever(), the timers run once per wakeup.
+		"""
+		self.loop = loop
+		loop.add_reader(self.socket, self.on_readable, self.recv_batch)
+		for peer in self.peers:
+			loop.add_reader(peer.socket, self.on_readable, self.recv_peer, peer)
+		self.arm_timer()
+		logging.info("Bolt Broker started on the event loop.")
+
+	def on_readable(self, recv, *args):
+		recv(*args)
+		self.run_timers()
+		self.arm_timer()
+
+	def on_timer(self):
+		self.timer = None
+		self.run_timers()
+		self.arm_timer()
+
+	def arm_timer(self):
+		"""
+		Have the loop call run_timers() by next_timeout(), unless it does already.
+		"""
+		due = time.time() + 1e-3*self.next_timeout()
+		if self.timer is not None:
+			if self.timer.due <= due:
+				return
+			self.timer.cancel()
+		self.timer = self.loop.call_at(due, self.on_timer)
+
+	def recv_batch(self):
+		"""
+		Drain up to batch_size ready msgs from the socket without blocking.
+
+		Returns the number of msgs handled.
+		"""
+		count = 0
+		copy_threshold = self.copy_threshold
+		while count < self.batch_size:
+			try:
+				if copy_threshold is None:
+					msg = self.socket.recv_multipart(zmq.NOBLOCK)
+				else:
+					# envelope & headers as bytes, large payloads as zmq.Frame
+					msg = unpack_frames(self.socket.recv_multipart(zmq.NOBLOCK, copy=False),
+							copy_threshold)
+			except zmq.Again:
+				break # socket drained
+			#if self.verbose:
+			#	logging.info("I: received message:")
+			#	dump(msg)
+
+			# handle the received msg.
+			self.msg_handler(msg)
+			count += 1
+
+		self.msg_count += count
+		return count
+
+	def next_timeout(self):
+		"""
+		msecs until the earliest timer is due, used as the poll timeout.
+		"""
+		due = self.stats_at
+		if self.expiries:
+			due = min(due, self.expiries[0][0])
+		if self.heartbeats:
+			due = min(due, self.heartbeats[0][0])
+		if self.peers:
+			due = min(due, self.peer_at)
+		return max(0, int(1e3*(due - time.time())))
+
+	def run_timers(self):
+		"""
+		Fire the broker timers (purge, heartbeat, stats) that are due.
+		"""
+		now = time.time()
+		self.purge_workers(now)
+		self.send_heartbeats(now)
+		if now >= self.stats_at:
+			self.update_stats(now)
+		if self.peers and now >= self.peer_at:
+			self.poll_peers(now)
+		# requests spilled during this wakeup go to disk in one batch
+		for journal in self.journals:
+			journal.flush(now)
+
+	def update_stats(self, now):
+		"""
+		Recompute msg_rate (msgs/sec) since the previous stats tick.
+		"""
+		elapsed = now - (self.stats_at - 1e-3*self.STATS_INTERVAL)
+		if elapsed > 0:
+			self.msg_rate = (self.msg_count - self.stats_count) / elapsed
+			for service in self.services.itervalues():
+				service.request_rate = (service.received - service.stats_received) / elapsed
+				service.stats_received = service.received
+		self.stats_count = self.msg_count
+		self.stats_at = now + 1e-3*self.STATS_INTERVAL
+		if self.verbose:
+			logging.info("I: %.1f msgs/sec (%d total)", self.msg_rate, self.msg_count)
+			for name, (depth, limit, dropped, rejected, expired) in self.queue_gauges().iteritems():
+				logging.info("I: service %s: %d/%d queued, %d dropped, %d rejected, %d expired",
+						name, depth, limit, dropped, rejected, expired)
+			for service in self.services.itervalues():
+				if service.cache_ttl:
+					logging.info("I: service %s: %d cache hits, %d misses", service.name,
+							service.cache_hits, service.cache_misses)
+			logging.info("I: reply cache: %d entries, %d bytes, %d evicted",
+					len(self.cache.entries), self.cache.size, self.cache.evicted)
+
+	def queue_gauges(self):
+		"""
+		Returns {service name: (queue depth, queue limit, dropped, rejected, expired)}.
+		"""
+		return dict((service.name, (service.queued(), service.max_requests,
+				service.dropped, service.rejected, service.expired))
+				for service in self.services.itervalues())
+
+	def load(self):
+		"""
+		Requests queued or in flight per worker slot, advertised to clients
+		by discovery (see bolt_discovery.py), which calls it from its thread.
+		"""
+		workers = self.workers.values()
+		pending = sum(len(worker.requests) for worker in workers)
+		pending += sum(service.queued() for service in self.services.values())
+		return float(pending) / max(sum(worker.slots for worker in workers), 1)
 
 	def msg_handler(self,msg):
 		#print msg
-		sender = msg.pop(0)	# where this msg from.
-		sender_id = binascii.hexlify(sender) # get the string of hex.
-		empty = msg.pop(0)
-		if empty != '':
+		if len(msg) < 3 or msg[1] != '':
 			return # error msg
-      	
-		header = msg.pop(0)
+
+		sender = msg[0]	# where this msg from, raw identity bytes.
+		header = msg[2]
+		del msg[:3]
 		if (MDP.C_CLIENT == header): 
 			# msg from a client
-			self.process_client(sender_id, msg)
+			self.process_client(sender, msg)
+		elif (MDP.C_CLIENT_H == header):
+			# msg from a client, with request headers
+			self.process_client(sender, msg, True)
 		elif (MDP.W_WORKER == header):
 			# msg from a worker
-			self.process_worker(sender_id, msg)
+			self.process_worker(sender, msg)
 		else:
 			#logging.error("E: invalid message:")
 			#dump(msg)
 			pass # error msg
 			
-	def process_client(self, client_id, msg):
+	def process_client(self, client_id, msg, headers=False):
 		"""
 		Just 1 kind of msg:
 			REQUEST
 			
 		Process a request coming from a client.
+
+		The queued request is [client, header..., '', body], the headers
+		(if any) riding in the reply envelope.
 		"""
 		assert len(msg) >= 2 # Service name + body
-		service = msg.pop(0)
-		
-		client_address = binascii.unhexlify(client_id)
-		msg = [client_address,''] + msg  # Set reply return address to client sender
-		
+		service = msg[0]
+
+		# Set reply return address to client sender, in place
+		if headers:
+			if '' not in msg[1:]:
+				return # error msg, no end of headers
+			# [service, header..., '', body] -> [client, header..., '', body]
+			msg[0] = client_id
+			bolt_trace.mark(msg, 1, "r")
+		else:
+			# [service, body] -> [client, '', body]
+			msg[0] = ''
+			msg.insert(0, client_id)
+
 		if service.startswith(self.INTERNAL_SERVICE_PREFIX):
 			self.service_internal(service, msg)
+			return
+
+		service = self.get_service(service)
+		service.received += 1
+		if service.cache_ttl and self.reply_from_cache(service, msg):
+			return
+		self.dispatch(service, msg)
+
+	def reply_from_cache(self, service, msg):
+		"""
+		Answer request [client, header..., '', body] from the reply cache.
+
+		Returns True if it was answered, the headers go back as sent.
+		"""
+		try:
+			empty = msg.index('', 1)
+		except ValueError:
+			return False # no body, the dispatch path drops it
+		reply = self.cache.get(request_key(service.name, msg[empty + 1:]), time.time())
+		if reply is None:
+			service.cache_misses += 1
+			return False
+		service.cache_hits += 1
+		msg[empty + 1:] = reply
+		self.send_reply_to_client(service.name, msg)
+		return True
+
+	def cache_reply(self, service, request, reply):
+		"""
+		Cache the body of reply [client, tag, header..., '', body] to
+		request [client, tag, header..., '', body], unless it is a status.
+		"""
+		if MDP.header(reply, MDP.H_STATUS, 1) is not None or '' not in reply:
+			return
+		key = request_key(service.name, request[request.index('', 1) + 1:])
+		self.cache.put(key, reply[reply.index('', 1) + 1:], service.cache_ttl, time.time())
+
+	def set_cache_ttl(self, service_name, ttl):
+		"""
+		Cache the replies of a service for ttl secs, 0 to stop caching.
+		"""
+		if ttl:
+			self.cache_ttls[service_name] = ttl
 		else:
-			self.dispatch(self.get_service(service), msg)
+			self.cache_ttls.pop(service_name, None)
+		self.get_service(service_name).cache_ttl = ttl
 			
 	def service_internal(self, service, msg):
 		"""
@@ -160,31 +560,507 @@ class MajordomoBroker(object):
 		if "mmi.service" == service:
 			name = msg[-1]
 			returncode = "200" if name in self.services else "404"
+		elif "mmi.queue" == service:
+			# queue depth of the named service
+			name = msg[-1]
+			returncode = str(self.services[name].queued()) if name in self.services else "404"
+		elif "mmi.stats" == service:
+			# json stats of the named service, or of all with "*"
+			name = msg[-1]
+			if name == "*":
+				returncode = json.dumps(self.service_stats())
+			elif name in self.services:
+				returncode = json.dumps(self.service_stats([self.services[name]])[0])
+			else:
+				returncode = "404"
+		elif "mmi.workers" == service:
+			# json list of the workers of the named service
+			name = msg[-1]
+			returncode = json.dumps(self.worker_stats(name)) if name in self.services else "404"
+		elif "mmi.capacity" == service:
+			# json {service name: free worker slots} of the services with any, for peers
+			returncode = json.dumps(self.capacity())
 
 		msg[-1] = returncode
-
-		# insert the protocol header and service name after the routing envelope ([client, ''])
-		msg = msg[:2] + [MDP.C_CLIENT, service] + msg[2:]
-		self.socket.send_multipart(msg)
+		self.send_reply_to_client(service, msg)
 		
+	def service_stats(self, services=None):
+		"""
+		Returns a dict of counters, gauges and latency summaries for each
+		of services (all by default).
+		"""
+		services = self.services.values() if services is None else services
+		idle = dict((service.name, 0) for service in services)
+		busy = dict(idle)
+		for worker in self.workers.values():
+			if worker.service is not None and worker.service.name in idle:
+				counts = busy if worker.requests else idle
+				counts[worker.service.name] += 1
+
+		return [dict(name=service.name, queued=service.queued(),
+				spilled=len(service.journal) if service.journal is not None else 0,
+				limit=service.max_requests, idle_workers=idle[service.name],
+				busy_workers=busy[service.name], received=service.received,
+				request_rate=service.request_rate, dropped=service.dropped,
+				rejected=service.rejected, expired=service.expired,
+				redelivered=service.redelivered, lost=service.lost, forwarded=service.forwarded,
+				cache_hits=service.cache_hits, cache_misses=service.cache_misses,
+				wait_time=service.wait_time.summary(),
+				service_time=service.service_time.summary())
+				for service in services]
+
+	def worker_stats(self, service_name):
+		"""
+		Returns a dict for each worker of a service.
+		"""
+		now = time.time()
+		return [dict(id=binascii.hexlify(worker.worker_id), slots=worker.slots,
+				credit=worker.credit, in_flight=len(worker.requests),
+				latency=worker.latency, expires_in=worker.expiry - now)
+				for worker in self.workers.values()
+				if worker.service is not None and worker.service.name == service_name]
+
 	def dispatch(self, service, msg):
 		"""
 		Dispatch requests to waiting workers as possible
 		"""
 		assert (service is not None)
 		
+		# expired workers are purged by run_timers(), not on every dispatch.
+		now = time.time()
 		if msg is not None:# Queue message if any
-			service.requests.append(msg)
-		
-		self.purge_workers()
-		
-		while service.waiting and service.requests:
-			msg = service.requests.pop(0)
-			worker_id = service.waiting.pop(0)
-			#worker = self.get_worker(worker_id)
-			self.waiting.remove(worker_id)
+			self.enqueue(service, msg, now)
+
+		while service.waiting and (service.requests
+				or service.journal is not None and self.unspill(service)):
+			queued_at, msg = self.pop_request(service)
+			if msg[1] != '' and self.is_expired(msg, now):
+				# the client stopped waiting, don't waste a worker on it
+				service.expired += 1
+				self.send_status_to_client(service.name, msg, MDP.S_EXPIRED)
+				continue
+			service.wait_time.record(now - queued_at)
+			worker_id, worker = self.scheduler.pick(service)
+			del service.waiting[worker_id]
+			worker.credit -= 1
+			if worker.credit > 0:
+				# pooled worker with free slots, rotate it to the back
+				service.waiting[worker_id] = worker
+			else:
+				del self.waiting[worker_id]
+			self.track(worker, msg, now)
+			bolt_trace.mark(msg, 2, "d") # right after the dispatch tag
 			self.send_to_worker(worker_id, MDP.W_REQUEST, msg)
+
+		if self.peers and not service.waiting and service.queued():
+			self.forward(service, now)
+
+	def pop_request(self, service):
+		"""
+		Take (queued at, request) off the head of service's queue.
+		"""
+		queued_at, msg = service.requests.popleft()
+		if service.journal is not None:
+			service.queued_bytes -= frames_size(msg)
+		if service.latest:
+			service.latest.pop(msg[0], None)
+		return queued_at, msg
+
+	def unspill(self, service):
+		"""
+		Move the oldest spilled requests of service back to its queue, up to
+		half its memory budget. Returns how many.
+		"""
+		entries = service.journal.read(service.spill_bytes // 2)
+		for queued_at, msg in entries:
+			service.queued_bytes += frames_size(msg)
+			service.requests.append([queued_at, msg])
+		return len(entries)
+
+	def track(self, worker, msg, now):
+		"""
+		Remember a request as in flight on worker until it replies, tagged
+		with an MDP.H_DISPATCH header right after the client address:
+		[client, r<seq>.<retries>, header..., '', body].
+		"""
+		tag = msg[1]
+		if tag[:1] == MDP.H_DISPATCH:
+			# redelivered, retag it keeping the retry count
+			retries = tag[tag.index('.'):]
+			self.dispatch_seq += 1
+			msg[1] = tag = MDP.H_DISPATCH + ("%x" % self.dispatch_seq) + retries
+		else:
+			self.dispatch_seq += 1
+			tag = MDP.H_DISPATCH + ("%x.0" % self.dispatch_seq)
+			msg.insert(1, tag)
+		worker.requests[tag] = (msg, now)
+		self.busy[worker.worker_id] = worker
+		# a full lifetime to get the job done before we give up on it
+		worker.expiry = now + 1e-3*self.HEARTBEAT_EXPIRY
+		# the request tells the worker we're alive as well as a heartbeat
+		worker.heartbeat_at = now + 1e-3*self.HEARTBEAT_INTERVAL
+
+	def redeliver(self, worker):
+		"""
+		Requeue the requests a dead worker had in flight at the front of its
+		service queue, in order. Requests of services that aren't idempotent,
+		out of retries, or superseded by a newer frame (OVERFLOW_LATEST) are
+		answered with MDP.S_LOST.
+		"""
+		service = worker.service
+		requests = worker.requests.values()
+		worker.requests = OrderedDict()
+		now = time.time()
+		for msg, dispatched_at in reversed(requests):
+			tag = msg[1]
+			retries = int(tag[tag.index('.') + 1:])
+			if (not service.idempotent or retries >= self.max_retries
+					or msg[0] in service.latest):
+				service.lost += 1
+				self.send_status_to_client(service.name, msg, MDP.S_LOST)
+				continue
+			msg[1] = tag[:tag.index('.') + 1] + str(retries + 1)
+			service.redelivered += 1
+			entry = [now, msg]
+			service.requests.appendleft(entry)
+			if service.journal is not None:
+				service.queued_bytes += frames_size(msg)
+			if service.overflow == OVERFLOW_LATEST:
+				service.latest[msg[0]] = entry
+
+		logging.info("I: worker %s lost %d requests, %d redelivered so far",
+				binascii.hexlify(worker.worker_id), len(requests), service.redelivered)
+		self.dispatch(service, None)
+
+	def capacity(self):
+		"""
+		Returns {service name: free worker slots} of the services with slots
+		left once their queue is served, as told to peers.
+		"""
+		capacity = {}
+		for service in self.services.itervalues():
+			if service.waiting:
+				free = sum(worker.credit for worker in service.waiting.itervalues()) - service.queued()
+				if free > 0:
+					capacity[service.name] = free
+		return capacity
+
+	def pick_peer(self, service_name):
+		"""
+		The peer with the most free slots for a service, None if none has any.
+		"""
+		best = None
+		most = 0
+		for peer in self.peers:
+			free = peer.capacity.get(service_name, 0)
+			if free > most:
+				best, most = peer, free
+		return best
+
+	def forward(self, service, now):
+		"""
+		Forward requests queued on service, oldest first, while peers have
+		free slots for them. Requests a peer forwarded here stay here.
+		"""
+		while True:
+			peer = self.pick_peer(service.name)
+			if peer is None or not (service.requests
+					or service.journal is not None and self.unspill(service)):
+				return
+			queued_at, msg = service.requests[0]
+			if MDP.header(msg, MDP.H_FORWARD, 1) is not None:
+				return # the requests behind it wait for our workers too
+			if msg[1] != '' and self.is_expired(msg, now):
+				# the client stopped waiting, don't waste a peer's worker on it
+				self.pop_request(service)
+				service.expired += 1
+				self.send_status_to_client(service.name, msg, MDP.S_EXPIRED)
+				continue
+
+			# [client, header..., '', body] -> ['', MDPC01H, service, header..., f<id>, '', body]
+			empty = msg.index('', 1)
+			headers = msg[1:empty]
+			if headers and headers[0][:1] == MDP.H_DISPATCH:
+				headers = headers[1:] # our tag of a redelivered request
+			self.forward_seq += 1
+			forward_id = "%x" % self.forward_seq
+			try:
+				peer.socket.send_multipart(['', MDP.C_CLIENT_H, service.name] + headers
+						+ [MDP.H_FORWARD + forward_id] + msg[empty:], zmq.NOBLOCK, copy=False)
+			except zmq.Again:
+				peer.capacity = {} # backed up, wait for its next report
+				continue
+
+			self.pop_request(service)
+			service.wait_time.record(now - queued_at)
+			service.forwarded += 1
+			peer.capacity[service.name] -= 1
+			peer.forwarded[forward_id] = (service.name, msg, queued_at, now)
+
+	def connect_peer(self, peer):
+		"""
+		Connect to peer on a fresh socket, dropping what the old one still queued.
+		"""
+		if peer.socket is not None:
+			self.poller.unregister(peer.socket)
+			if self.loop is not None:
+				self.loop.remove_reader(peer.socket)
+			peer.socket.close()
+		peer.socket = self.ctx.socket(zmq.DEALER)
+		peer.socket.linger = 0
+		peer.socket.connect(peer.endpoint)
+		self.poller.register(peer.socket, zmq.POLLIN)
+		if self.loop is not None:
+			self.loop.add_reader(peer.socket, self.on_readable, self.recv_peer, peer)
+
+	def poll_peers(self, now):
+		"""
+		Ask every peer for its capacity, giving up on the silent ones and on
+		the requests a live one sat on too long.
+		"""
+		for peer in self.peers:
+			if now - peer.heard_at > 1e-3*self.PEER_EXPIRY:
+				self.lose_peer(peer, now)
+			elif peer.forwarded:
+				self.expire_forwarded(peer, now)
+			try:
+				peer.socket.send_multipart(['', MDP.C_CLIENT, "mmi.capacity", ''], zmq.NOBLOCK)
+			except zmq.Again:
+				pass # still connecting
+		self.peer_at = now + 1e-3*self.PEER_INTERVAL
+
+	def lose_peer(self, peer, now):
+		"""
+		Reconnect to a silent peer. Requests forwarded to it are taken back,
+		see take_back().
+		"""
+		if peer.alive:
+			logging.warn("W: peer %s is silent, %d forwarded requests back",
+					peer.endpoint, len(peer.forwarded))
+		forwarded = peer.forwarded.values()
+		peer.alive = False
+		peer.heard_at = now
+		peer.capacity = {}
+		peer.forwarded = OrderedDict()
+		self.connect_peer(peer)
+		self.take_back(forwarded)
+
+	def expire_forwarded(self, peer, now):
+		"""
+		Stop waiting for the replies to requests forwarded to a live peer:
+		those past their deadline are answered with MDP.S_EXPIRED, those
+		unanswered for FORWARD_TIMEOUT, which the peer's overflow policy may
+		have dropped, are taken back, see take_back().
+		"""
+		timed_out = []
+		for forward_id, forwarded in peer.forwarded.items():
+			service_name, msg, queued_at, forwarded_at = forwarded
+			if msg[1] != '' and self.is_expired(msg, now):
+				del peer.forwarded[forward_id]
+				self.get_service(service_name).expired += 1
+				self.send_status_to_client(service_name, msg, MDP.S_EXPIRED)
+			elif now - forwarded_at > 1e-3*self.FORWARD_TIMEOUT:
+				del peer.forwarded[forward_id]
+				timed_out.append(forwarded)
+		if timed_out:
+			logging.warn("W: peer %s sat on %d forwarded requests, taken back",
+					peer.endpoint, len(timed_out))
+			self.take_back(timed_out)
+
+	def take_back(self, forwarded):
+		"""
+		Requeue forwarded requests [(service name, request, queued at,
+		forwarded at)], oldest first, at the front of their service queue if
+		idempotent, else answer them with MDP.S_LOST.
+		"""
+		services = set()
+		for service_name, msg, queued_at, forwarded_at in reversed(forwarded):
+			service = self.get_service(service_name)
+			services.add(service)
+			if not service.idempotent or msg[0] in service.latest:
+				service.lost += 1
+				self.send_status_to_client(service.name, msg, MDP.S_LOST)
+				continue
+			service.redelivered += 1
+			entry = [queued_at, msg]
+			service.requests.appendleft(entry)
+			if service.journal is not None:
+				service.queued_bytes += frames_size(msg)
+			if service.overflow == OVERFLOW_LATEST:
+				service.latest[msg[0]] = entry
+		for service in services:
+			self.dispatch(service, None)
+
+	def recv_peer(self, peer):
+		"""
+		Drain up to batch_size ready msgs from a peer without blocking.
+		"""
+		for i in xrange(self.batch_size):
+			try:
+				if self.copy_threshold is None:
+					msg = peer.socket.recv_multipart(zmq.NOBLOCK)
+				else:
+					msg = unpack_frames(peer.socket.recv_multipart(zmq.NOBLOCK, copy=False),
+							self.copy_threshold)
+			except zmq.Again:
+				break
+			self.process_peer(peer, msg)
+
+	def process_peer(self, peer, msg):
+		"""
+		Handle a msg from a peer, as its client: a capacity report, or the
+		reply to a forwarded request, sent on to the client that made it.
+		"""
+		# ['', MDPC01(H), service, ...]
+		if len(msg) < 4 or msg[0] != '':
+			return # error msg
+		now = time.time()
+		peer.heard_at = now
+		peer.alive = True
+
+		if msg[1] == MDP.C_CLIENT:
+			if msg[2] == "mmi.capacity":
+				try:
+					peer.capacity = json.loads(msg[3])
+				except ValueError:
+					return
+				# saturated services can use the new slots now
+				for service_name in peer.capacity:
+					service = self.services.get(service_name)
+					if service is not None and not service.waiting and service.queued():
+						self.forward(service, now)
+			return
+
+		if msg[1] != MDP.C_CLIENT_H or '' not in msg[3:]:
+			return # error msg
+		forwarded = peer.forwarded.pop(MDP.header(msg, MDP.H_FORWARD, 3), None)
+		if forwarded is None:
+			return # given up on it already
+		service_name, request, queued_at, forwarded_at = forwarded
+		status = MDP.header(msg, MDP.H_STATUS, 3)
+		if status == MDP.S_OVERLOADED:
+			# the peer filled up meanwhile, the request goes back to our queue
+			service = self.get_service(service_name)
+			service.requests.appendleft([queued_at, request])
+			if service.journal is not None:
+				service.queued_bytes += frames_size(request)
+			self.dispatch(service, None)
+			return
+		if status is not None:
+			self.send_status_to_client(service_name, request, status)
+			return
+
+		# the reply freed the peer's slot until its next report says otherwise
+		peer.capacity[service_name] = peer.capacity.get(service_name, 0) + 1
+		empty = msg.index('', 3)
+		if request[1 + (request[1][:1] == MDP.H_DISPATCH)] == '':
+			# plain client: [client, '', body]
+			reply = [request[0], ''] + msg[empty + 1:]
+		else:
+			# the client's headers as the peer sent them back, without ours or its credit
+			reply = ([request[0]] + [frame for frame in msg[3:empty]
+					if frame[:1] not in (MDP.H_FORWARD, MDP.H_CREDIT)] + msg[empty:])
+		self.send_reply_to_client(service_name, reply)
+		service = self.services[service_name]
+		if not service.waiting and service.queued():
+			self.forward(service, now)
+
+	def set_idempotent(self, service_name, idempotent=True):
+		"""
+		Mark a service idempotent: requests lost with a worker are redelivered.
+		"""
+		if idempotent:
+			self.idempotent.add(service_name)
+		else:
+			self.idempotent.discard(service_name)
+		self.get_service(service_name).idempotent = idempotent
 			
+	def is_expired(self, msg, now):
+		"""
+		True if request [client, header..., '', body] has a deadline before now.
+		"""
+		deadline = MDP.header(msg, MDP.H_DEADLINE, 1)
+		try:
+			return deadline is not None and float(deadline) < now
+		except ValueError:
+			return False # malformed deadline, treat as none
+
+	def enqueue(self, service, msg, now):
+		"""
+		Queue a request [client, header..., '', body] received at now on
+		service, applying its overflow policy once max_requests are queued.
+		"""
+		client = msg[0]
+		if service.overflow == OVERFLOW_LATEST:
+			entry = service.latest.get(client)
+			if entry is not None:
+				# the client's newer frame takes over the older one's place,
+				# queued now, and its retry count if it was redelivered
+				queued = entry[1]
+				if queued[1][:1] == MDP.H_DISPATCH:
+					msg.insert(1, queued[1])
+				if service.journal is not None:
+					service.queued_bytes += frames_size(msg) - frames_size(queued)
+				entry[:] = [now, msg]
+				self.drop(service, queued, MDP.S_SUPERSEDED)
+				return
+
+		if service.max_requests and service.queued() >= service.max_requests:
+			if service.overflow == OVERFLOW_REJECT:
+				service.rejected += 1
+				self.send_status_to_client(service.name, msg, MDP.S_OVERLOADED)
+				return
+			elif service.overflow == OVERFLOW_DROP_NEWEST:
+				self.drop(service, msg, MDP.S_OVERLOADED)
+				return
+			else:
+				if not service.requests:
+					self.unspill(service)
+				queued_at, oldest = service.requests.popleft()
+				if service.latest:
+					service.latest.pop(oldest[0], None)
+				if service.journal is not None:
+					service.queued_bytes -= frames_size(oldest)
+				self.drop(service, oldest, MDP.S_OVERLOADED)
+
+		if service.journal is not None:
+			size = frames_size(msg)
+			if service.overflow != OVERFLOW_LATEST and (len(service.journal)
+					or service.queued_bytes + size > service.spill_bytes):
+				# past the memory budget, or behind requests that were
+				service.journal.append(now, msg)
+				return
+			service.queued_bytes += size
+		entry = [now, msg]
+		service.requests.append(entry)
+		if service.overflow == OVERFLOW_LATEST:
+			service.latest[client] = entry
+
+	def drop(self, service, msg, status):
+		"""
+		Drop a request [client, header..., '', body] by the overflow policy.
+		Header clients are answered with status to free its slot; plain
+		clients can't tell which request it answers, they time out.
+		"""
+		service.dropped += 1
+		if msg[1 + (msg[1][:1] == MDP.H_DISPATCH)] != '':
+			self.send_status_to_client(service.name, msg, status)
+
+	def set_queue_limit(self, service_name, max_requests, overflow=OVERFLOW_REJECT):
+		"""
+		Bound the request queue of a service, 0 for unbounded.
+		"""
+		assert overflow in OVERFLOW_POLICIES
+		service = self.get_service(service_name)
+		service.max_requests = max_requests
+		if overflow != service.overflow:
+			# rebuild the client index for (or drop it with) OVERFLOW_LATEST
+			service.latest = {}
+			if overflow == OVERFLOW_LATEST:
+				for entry in service.requests:
+					service.latest[entry[1][0]] = entry
+		service.overflow = overflow
+
 	def send_to_worker(self, worker_id, command, msg=None):
 		"""
 		Send message to worker.
@@ -192,20 +1068,32 @@ class MajordomoBroker(object):
 		If message is provided, sends that message.
 		 """
 
-		if msg is None:
-			msg = []
-		elif not isinstance(msg, list):
+		if msg is not None and not isinstance(msg, list):
 			msg = [msg]
 
-		# Stack routing and protocol envelopes to start of message
-		# and routing envelope
-		address = binascii.unhexlify(worker_id)
-		msg = [address, '', MDP.W_WORKER, command] + msg
-
 		#if self.verbose:
 		#	logging.info("I: sending %r to worker", command)
 		#	dump(msg)
 
+		# Stack routing and protocol envelopes to start of message
+		self.send_frames((worker_id, '', MDP.W_WORKER, command), msg)
+
+	def send_frames(self, envelope, msg=None):
+		"""
+		Send envelope frames followed by msg frames as one multipart msg.
+
+		The envelope goes out frame by frame with SNDMORE, so no concatenated
+		list is built for every outgoing msg.
+		"""
+		send = self.socket.send
+		if not msg:
+			for frame in envelope[:-1]:
+				send(frame, zmq.SNDMORE)
+			send(envelope[-1])
+			return
+
+		for frame in envelope:
+			send(frame, zmq.SNDMORE)
 		self.socket.send_multipart(msg)
     
 	def process_worker(self, worker_id, msg):
@@ -216,6 +1104,7 @@ class MajordomoBroker(object):
 			REPLY
 			HEARTBEAT
 			DISCONNECT
+		Any msg of a known worker counts as a heartbeat.
 		Args:
 			worker_id - the id of the worker
 			msg - the msg.
@@ -224,34 +1113,66 @@ class MajordomoBroker(object):
 
 		command = msg.pop(0)
 
+		now = time.time()
 		is_worker_existed = worker_id in self.workers
 		worker = self.get_worker(worker_id)
+		if is_worker_existed:
+			# moves it in self.expiries only once the old expiry is due
+			worker.expiry = now + 1e-3*self.HEARTBEAT_EXPIRY
 		
 		if (MDP.W_READY == command): # Ready
-			# register a service
+			# register a service, optionally followed by the number of
+			# concurrent slots of a pooled worker (default 1).
 			assert len(msg) >= 1 # At least, a service name
 			service = msg.pop(0)
+			slots = msg.pop(0) if msg else "1"
 			
-			if (is_worker_existed or service.startswith(self.INTERNAL_SERVICE_PREFIX)):
+			if (is_worker_existed or service.startswith(self.INTERNAL_SERVICE_PREFIX)
+					or not slots.isdigit() or int(slots) < 1):
 				# error msg
-				# register for more than once, or register the reserved service.
+				# register for more than once, or register the reserved service,
+				# or a bad slot count.
 				self.delete_worker(worker_id, True)
 			else:
-				# Attach worker to service and mark as idle
+				# Attach worker to service and mark as idle, one credit per slot
 				worker.service = self.get_service(service)
+				worker.slots = worker.credit = int(slots)
 				self.add_worker_to_waiting_list(worker_id)	
 		elif (MDP.W_REPLY == command): # Reply		
 			if (is_worker_existed):
+				tracked = worker.requests.pop(msg[1], None) if len(msg) >= 2 else None
+				if tracked is None:
+					# not in flight here: a duplicate of a request redelivered
+					# after this worker was given up on, or a bad reply.
+					return
+				if MDP.header(msg, MDP.H_STATUS, 2) is None:
+					# a status (the deadline passed before the handler ran)
+					# says nothing about how long the worker takes
+					elapsed = now - tracked[1]
+					worker.observe_latency(elapsed)
+					worker.service.service_time.record(elapsed)
+				if worker.service.cache_ttl:
+					self.cache_reply(worker.service, tracked[0], msg)
+				del msg[1] # the dispatch tag
+				bolt_trace.mark(msg, 1, "p")
+				if not worker.requests:
+					self.busy.pop(worker_id, None)
+
 				# Remove & save client return envelope and insert the
 				# protocol header and service name, then rewrap envelope.
-				self.send_reply_to_client(worker.service.name,msg)
+				service = worker.service
+				if service.max_requests and len(msg) > 1 and msg[1] != '':
+					# tell header clients how much room is left in the queue
+					room = max(0, service.max_requests - service.queued())
+					msg.insert(1, MDP.H_CREDIT + str(room))
+				self.send_reply_to_client(service.name,msg)
+				# a reply frees one slot
+				worker.credit = min(worker.credit + 1, worker.slots)
 				self.add_worker_to_waiting_list(worker_id)
 			else:
 				self.delete_worker(worker_id, True)
 		elif (MDP.W_HEARTBEAT == command): # Heartbeat
-			if (is_worker_existed):
-				worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
-			else:
+			if (not is_worker_existed):
 				self.delete_worker(worker_id, True)
 		elif (MDP.W_DISCONNECT == command): # Disconnect
 			self.delete_worker(worker_id, False)
@@ -271,9 +1192,13 @@ class MajordomoBroker(object):
 			self.send_to_worker(worker_id, MDP.W_DISCONNECT, None)
 
 		if worker.service is not None:
-			worker.service.waiting.remove(worker_id)
-			
+			worker.service.waiting.pop(worker_id, None)
+		self.waiting.pop(worker_id, None)
+		self.busy.pop(worker_id, None)
+
 		self.workers.pop(worker_id)
+		if worker.requests:
+			self.redeliver(worker)
 
 	def get_worker(self, worker_id):
 		"""
@@ -284,7 +1209,9 @@ class MajordomoBroker(object):
 		worker = self.workers.get(worker_id)
 		if (worker is None): # this worker registers for first time 
 			worker = Worker(worker_id, self.HEARTBEAT_EXPIRY)
+			worker.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
 			self.workers[worker_id] = worker
+			heapq.heappush(self.expiries, (worker.expiry, worker_id, worker))
 			#if self.verbose:
 			#	logging.info("I: registering new worker: %s", identity)
 
@@ -298,60 +1225,120 @@ class MajordomoBroker(object):
 		
 		service = self.services.get(service_name)
 		if (service is None):
-			service = Service(service_name)
+			service = Service(service_name, self.queue_limit, self.overflow,
+					service_name in self.idempotent)
+			service.cache_ttl = self.cache_ttls.get(service_name, 0)
+			if self.spill_dir is not None:
+				self.open_journal(service)
 			self.services[service_name] = service
 
 		return service
 
+	def open_journal(self, service):
+		"""
+		Give service its spill journal, or keep its queue in RAM if the
+		journal can't be opened.
+		"""
+		path = os.path.join(self.spill_dir, binascii.hexlify(service.name))
+		try:
+			service.journal = Journal(path, fsync=self.fsync)
+		except (IOError, OSError) as e:
+			logging.warn("W: service %s won't spill, can't open %s: %s", service.name, path, e)
+			return
+		service.spill_bytes = self.spill_bytes
+		self.journals.append(service.journal)
+
 	def add_worker_to_waiting_list(self, worker_id):
 		"""
 		This worker is now waiting for work.
 		"""
-		# Queue to broker and service waiting lists
- 		self.waiting.append(worker_id)
- 		worker = self.get_worker(worker_id)
-		worker.service.waiting.append(worker_id)
-		worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+		# Queue to the back of broker and service waiting sets
+		worker = self.get_worker(worker_id)
+		self.waiting.pop(worker_id, None)
+		self.waiting[worker_id] = worker
+		worker.service.waiting.pop(worker_id, None)
+		worker.service.waiting[worker_id] = worker
 		self.dispatch(worker.service, None)
+		if not worker.heartbeat_queued and worker_id in self.waiting:
+			# still waiting once the queue is dispatched, it may need heartbeats
+			worker.heartbeat_queued = True
+			heapq.heappush(self.heartbeats, (worker.heartbeat_at, worker_id, worker))
 
 	def send_reply_to_client(self, service_name, msg):
-		client = msg.pop(0)
-		empty = msg.pop(0)
-		if empty != '':
+		"""
+		Send a reply [client, header..., '', body] to the client, insert
+		the protocol header and service name after the routing envelope.
+		"""
+		if len(msg) < 2:
 			return # error msg.
-				
-		msg = [client, '', MDP.C_CLIENT, service_name] + msg
-		
-		#print msg
-		self.socket.send_multipart(msg)
 
+		client = msg[0]
+		if msg[1] == '':
+			del msg[:2]
+			self.send_frames((client, '', MDP.C_CLIENT, service_name), msg)
+		else:
+			# headers go back as sent: [header..., '', body]
+			del msg[0]
+			self.send_frames((client, '', MDP.C_CLIENT_H, service_name), msg)
 
-	def purge_workers(self):
+
+	def send_status_to_client(self, service_name, msg, status):
+		"""
+		Answer a request [client, header..., '', body] with a status code
+		instead of a worker reply.
+		"""
+		if msg[1][:1] == MDP.H_DISPATCH:
+			del msg[1] # the broker's own tag of a redelivered request
+		if msg[1] == '':
+			# plain clients get the code as the body, like 8/MMI
+			msg[2:] = [status]
+		else:
+			empty = msg.index('', 1)
+			msg[empty + 1:] = []
+			msg.insert(1, MDP.H_STATUS + status)
+		self.send_reply_to_client(service_name, msg)
+
+	def purge_workers(self, now):
 		"""
 		Look for & kill expired workers.
 
-		Workers are oldest to most recent, so we stop at the first alive worker.
-		 """
-		while self.waiting:	
-			worker_id = self.waiting[0]
-			worker = self.get_worker(worker_id)
-			if worker.expiry < time.time():
-				logging.info("I: deleting expired worker: %s", worker_id)
-				self.delete_worker(worker_id,False)
-				self.waiting.pop(0)
-			else:
-				break
-		
-	def send_heartbeats(self):
+		self.expiries is lazy: a worker heard from since its entry was pushed
+		is pushed again at its new expiry when the old one comes up, so a
+		wakeup costs O(log n) per entry due, not a scan of the workers.
+		Busy workers' requests are redelivered.
 		"""
-		Send heartbeats to idle workers if it's time
+		expiries = self.expiries
+		while expiries and expiries[0][0] <= now:
+			expiry, worker_id, worker = heapq.heappop(expiries)
+			if self.workers.get(worker_id) is not worker:
+				continue # deleted since
+			if worker.expiry > now:
+				heapq.heappush(expiries, (worker.expiry, worker_id, worker))
+				continue
+			logging.info("I: deleting expired %sworker: %s", "busy " if worker.requests else "",
+					binascii.hexlify(worker_id))
+			self.delete_worker(worker_id, False)
+
+	def send_heartbeats(self, now):
+		"""
+		Send heartbeats to the waiting workers we haven't sent a request to
+		for HEARTBEAT_INTERVAL. Lazy like self.expiries, see purge_workers();
+		workers with no free slot don't expect heartbeats and leave the heap
+		until they wait again.
 		"""
-		if (time.time() > self.heartbeat_at):
-			for worker_id in self.waiting:
+		heartbeats = self.heartbeats
+		while heartbeats and heartbeats[0][0] <= now:
+			heartbeat_at, worker_id, worker = heapq.heappop(heartbeats)
+			if self.workers.get(worker_id) is not worker:
+				continue # deleted since
+			if worker_id not in self.waiting:
+				worker.heartbeat_queued = False
+				continue
+			if worker.heartbeat_at <= now:
 				self.send_to_worker(worker_id, MDP.W_HEARTBEAT, None)
-				
-			self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
-			
+				worker.heartbeat_at = now + 1e-3*self.HEARTBEAT_INTERVAL
+			heapq.heappush(heartbeats, (worker.heartbeat_at, worker_id, worker))
+
 	def bind(self, endpoint):
 		"""
 		Bind broker to endpoint, can call this multiple times.
@@ -361,13 +1348,30 @@ class MajordomoBroker(object):
 		self.socket.bind(endpoint)
 		#logging.info("I: MDP broker/0.1.1 is active at %s", endpoint)
 			
+	def close(self):
+		"""
+		Disconnect all workers, close our sockets but leave the context,
+		which may be shared with other shards.
+		"""
+		while self.workers:
+			self.delete_worker(next(iter(self.workers)), True)
+		for journal in self.journals:
+			journal.close()
+		sockets = [self.socket] + [peer.socket for peer in self.peers]
+		if self.loop is not None:
+			for socket in sockets:
+				self.loop.remove_reader(socket)
+			if self.timer is not None:
+				self.timer.cancel()
+		for socket in sockets:
+			socket.close(0)
+
 	def destroy(self):
 		"""
 		Disconnect all workers, destroy context.
 		"""
-		while self.workers:
-			self.delete_worker(self.workers.values()[0], True)
-			self.ctx.destroy(0)
+		self.close()
+		self.ctx.destroy(0)
 
 def run():
     """create and start new broker"""
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+ Reply cache of the Majordomo broker.
+
+ Replies of services with a cache TTL are kept by (service name, sha1 of the
+ request body), so a client resending the same frame is answered without a
+ worker. Only opt in services whose replies depend on the body alone.
+"""
+
+import hashlib
+import zmq
+from collections import OrderedDict
+
+def request_key(service_name, body):
+	"""
+	Cache key of a request: service name and sha1 of its body frames.
+	"""
+	digest = hashlib.sha1()
+	for frame in body:
+		if isinstance(frame, zmq.Frame):
+			frame = frame.buffer # hash large payloads without copying them
+		digest.update("%d:" % len(frame))
+		digest.update(frame)
+	return service_name + ":" + digest.digest()
+
+
+class ResultCache(object):
+	"""
+	LRU of reply bodies bounded by their total size in bytes.
+	"""
+	max_bytes = 0 					# byte budget, least recently used go first
+	size = 0 						# bytes of the cached reply bodies
+	entries = None 				# key -> (expires at, reply frames, bytes), oldest first
+	evicted = 0 					# entries dropped to stay within max_bytes
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+
+	def get(self, key, now):
+		"""
+		Returns the reply frames cached for key, or None if missing or expired.
+		"""
+		entry = self.entries.pop(key, None)
+		if entry is None:
+			return None
+		if entry[0] < now:
+			self.size -= entry[2]
+			return None
+		self.entries[key] = entry # most recently used
+		return entry[1]
+
+	def put(self, key, frames, ttl, now):
+		"""
+		Cache reply frames for ttl secs, evicting the least recently used.
+		"""
+		nbytes = sum(len(frame) for frame in frames)
+		if nbytes > self.max_bytes:
+			return # would evict everything else
+		old = self.entries.pop(key, None)
+		if old is not None:
+			self.size -= old[2]
+		self.entries[key] = (now + ttl, frames, nbytes)
+		self.size += nbytes
+		while self.size > self.max_bytes:
+			key, entry = self.entries.popitem(last=False)
+			self.size -= entry[2]
+			self.evicted += 1
@@ -1,23 +1,211 @@
 #!/usr/bin/env python
 
+"""
+ Bolt Discovery Protocol: clients find brokers over UDP.
+
+ A client sends BDP02REQ by broadcast, to a multicast group and unicast to
+ known hosts, all at once, and every broker that hears it answers
+ BDP02REP <broker port> <load>, load being requests queued or in flight
+ per worker slot ("-" if unknown). The client picks the least loaded
+ broker, the fastest to answer among equals, and caches the brokers it
+ heard in a file for CACHE_TTL secs, so most clients start without asking.
+
+ BDP01REQ, from older clients, is still answered with a bare BDP01REP.
+"""
+
 import SocketServer
+import errno
+import json
+import logging
+import os
+import socket
+import struct
+import time
+
+DISCOVERY_PORT = 5555
+BROKER_PORT = 5555 							# of a BDP01REP, which doesn't tell
+MULTICAST_GROUP = "239.255.55.55" 		# administratively scoped
+BROADCAST = "255.255.255.255"
+DEFAULT_BROKER = "tcp://localhost:5555" 	# when nothing else is known
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".bolt_brokers.json")
+CACHE_TTL = 60.0 							# secs the cached brokers are trusted
+TIMEOUT = 0.2 								# secs a query waits for a first reply
+GRACE = 0.02 								# secs it waits for more after the first
+ATTEMPTS = 2 								# queries before giving up
+BROKERS_ENV = "BOLT_BROKERS" 			# static broker endpoints, comma separated
+HOSTS_ENV = "BOLT_DISCOVERY_HOSTS" 	# hosts also queried by unicast, comma separated
 
 class UDPReceivedHandler(SocketServer.BaseRequestHandler):
 	def handle(self):
 		data = self.request[0].strip()
 		socket = self.request[1]
 
-		if data == "BDP01REQ":
+		if data == "BDP02REQ":
+			load = getattr(self.server, "load", None)
+			load = load() if load is not None else None
+			port = getattr(self.server, "broker_port", BROKER_PORT)
+			socket.sendto("BDP02REP %d %s" % (port, "-" if load is None else "%.3f" % load),
+					self.client_address)
+		elif data == "BDP01REQ":
 			print self.client_address
 			socket.sendto("BDP01REP", self.client_address)
 		else:
 			print data
-        
+
+
+class DiscoveryServer(SocketServer.UDPServer):
+	"""
+	UDP server answering discovery requests for a broker, by broadcast,
+	multicast to MULTICAST_GROUP or unicast.
+	"""
+	allow_reuse_address = True
+	load = None 							# returns the advertised load, or None
+	broker_port = BROKER_PORT 			# port of the advertised broker
+
+	def __init__(self, host="0.0.0.0", port=DISCOVERY_PORT, load=None, broker_port=BROKER_PORT):
+		SocketServer.UDPServer.__init__(self, (host, port), UDPReceivedHandler)
+		self.load = load
+		self.broker_port = broker_port
+		try:
+			membership = struct.pack("4sl", socket.inet_aton(MULTICAST_GROUP), socket.INADDR_ANY)
+			self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+		except socket.error as e:
+			# no multicast route: broadcast and unicast still work
+			logging.warn("W: discovery not joining %s: %s", MULTICAST_GROUP, e)
+
+
+def env_list(name):
+	return [item.strip() for item in os.environ.get(name, "").split(",") if item.strip()]
+
+def parse_reply(data, address, rtt):
+	"""
+	A discovery reply -> {endpoint, host, load, rtt}, None if it isn't one.
+	"""
+	fields = data.split()
+	if fields == ["BDP01REP"]:
+		port, load = BROKER_PORT, None
+	elif len(fields) == 3 and fields[0] == "BDP02REP":
+		try:
+			port = int(fields[1])
+			load = None if fields[2] == "-" else float(fields[2])
+		except ValueError:
+			return None
+	else:
+		return None
+	return dict(endpoint="tcp://%s:%d" % (address[0], port), host=address[0], load=load, rtt=rtt)
+
+def rank(brokers):
+	"""
+	Brokers best first: advertised load (to 0.1), then round trip time.
+	"""
+	return sorted(brokers, key=lambda broker: (broker["load"] is None,
+			round(broker["load"] or 0.0, 1), broker["rtt"]))
+
+def query(hosts=(), timeout=TIMEOUT, attempts=ATTEMPTS, port=DISCOVERY_PORT):
+	"""
+	Ask brokers by broadcast, multicast and unicast to hosts at once.
+
+	Collects replies until GRACE secs after the first one; an attempt
+	heard by none is repeated after timeout secs, in case a packet dropped.
+	Returns the brokers that replied, ranked.
+	"""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+	sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+	brokers = {}
+	try:
+		for attempt in xrange(attempts):
+			sent_at = time.time()
+			for target in [BROADCAST, MULTICAST_GROUP] + list(hosts):
+				try:
+					sock.sendto("BDP02REQ", (target, port))
+				except socket.error:
+					pass # no route to this one, the others may do
+			deadline = sent_at + timeout
+			while True:
+				wait = deadline - time.time()
+				if wait <= 0:
+					break
+				sock.settimeout(wait)
+				try:
+					data, address = sock.recvfrom(1024)
+				except socket.timeout:
+					break
+				except socket.error as e:
+					if e.errno == errno.EINTR:
+						continue
+					break # e.g. ICMP unreachable from a unicast host
+				broker = parse_reply(data, address, time.time() - sent_at)
+				# a broker hearing us several ways answers each, the first is the fastest
+				if broker is not None and broker["endpoint"] not in brokers:
+					brokers[broker["endpoint"]] = broker
+					deadline = min(deadline, time.time() + GRACE)
+			if brokers:
+				break
+	finally:
+		sock.close()
+	return rank(brokers.values())
+
+def load_cache(path=CACHE_PATH):
+	"""
+	Returns (time written, cached brokers), (0, []) if there are none.
+	"""
+	try:
+		with open(path) as f:
+			cache = json.load(f)
+		return float(cache["time"]), list(cache["brokers"])
+	except (IOError, ValueError, KeyError, TypeError):
+		return 0, []
+
+def save_cache(brokers, path=CACHE_PATH):
+	"""
+	Write the cache atomically, concurrent clients read either version.
+	"""
+	tmp = "%s.%d" % (path, os.getpid())
+	try:
+		with open(tmp, "w") as f:
+			json.dump(dict(time=time.time(), brokers=brokers), f)
+		os.rename(tmp, path)
+	except (IOError, OSError) as e:
+		logging.warn("W: can't cache brokers in %s: %s", path, e)
+
+def forget(endpoint, path=CACHE_PATH):
+	"""
+	Drop an unreachable broker from the cache, the next discover() asks again.
+	"""
+	written, cached = load_cache(path)
+	if any(broker["endpoint"] == endpoint for broker in cached):
+		save_cache([broker for broker in cached if broker["endpoint"] != endpoint], path)
+
+def discover(static=None, hosts=None, path=CACHE_PATH, ttl=CACHE_TTL, timeout=TIMEOUT):
+	"""
+	Returns broker endpoints, best first, [] if none is known.
+
+	static endpoints (or $BOLT_BROKERS) are returned as they are. Otherwise
+	brokers cached less than ttl secs ago are, and only then are brokers
+	queried: by broadcast, multicast and unicast to hosts ($BOLT_DISCOVERY_HOSTS)
+	and to the hosts of the stale cache. If none answers, the stale cache
+	is still returned.
+	"""
+	static = list(static or env_list(BROKERS_ENV))
+	if static:
+		return static
+
+	written, cached = load_cache(path)
+	if cached and 0 <= time.time() - written < ttl:
+		return [broker["endpoint"] for broker in cached]
+
+	hosts = list(hosts or env_list(HOSTS_ENV))
+	hosts += [broker["host"] for broker in cached if broker["host"] not in hosts]
+	brokers = query(hosts, timeout)
+	if brokers:
+		save_cache(brokers, path)
+		return [broker["endpoint"] for broker in brokers]
+	return [broker["endpoint"] for broker in cached]
+
 if __name__ == "__main__":
 	try:
-		HOST, PORT = "0.0.0.0", 5555
-		server = SocketServer.UDPServer((HOST, PORT), UDPReceivedHandler)
+		server = DiscoveryServer()
 		server.serve_forever()
 	except KeyboardInterrupt as e:
 		pass
-
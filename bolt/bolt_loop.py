@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""
+ Single-threaded event loop shared by brokers, workers, clients and servers.
+
+ The Python 2 stand-in for asyncio on zmq.asyncio: one zmq.Poller watches
+ zmq sockets and plain sockets (anything with fileno()) for every
+ component attached to the loop, and timers are kept in a heap.
+
+ Coroutines are generator functions, as in trollius and tornado: they
+ yield a Future (or anything with add_done_callback() and result(), like a
+ MajordomoAsyncClient's ReplyFuture, or another coroutine) to wait for it,
+ get its result back from the yield, and end with raise Return(value):
+
+	def handler(self, request):
+		reply = yield client.submit("face", request)
+		yield loop.sleep(0.01)
+		raise Return(reply)
+
+ Callbacks run on the loop's thread and must not block.
+"""
+
+import heapq
+import logging
+import time
+import types
+import zmq
+from collections import deque
+
+class Return(Exception):
+	"""
+	Ends a coroutine with value as its result.
+	"""
+	def __init__(self, value=None):
+		Exception.__init__(self, value)
+		self.value = value
+
+
+class Future(object):
+	"""
+	A result that isn't there yet.
+	"""
+	finished = False 			# result or exception set
+	value = None 				# the result
+	error = None 				# the exception, if it failed
+	callbacks = None 			# called with this future once finished
+
+	def __init__(self):
+		self.callbacks = []
+
+	def done(self):
+		return self.finished
+
+	def result(self):
+		assert self.finished, "result of a pending Future"
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+	def exception(self):
+		return self.error
+
+	def add_done_callback(self, fn):
+		if self.finished:
+			fn(self)
+		else:
+			self.callbacks.append(fn)
+
+	def set_result(self, value):
+		self.value = value
+		self.finish()
+
+	def set_exception(self, error):
+		self.error = error
+		self.finish()
+
+	def finish(self):
+		self.finished = True
+		callbacks, self.callbacks = self.callbacks, None
+		for fn in callbacks:
+			fn(self)
+
+
+class Task(Future):
+	"""
+	Runs a coroutine (a generator) up to its first yield right away, then on
+	as each future it yields finishes. The task's result is the coroutine's.
+	"""
+	coro = None 				# the generator
+
+	def __init__(self, coro):
+		super(Task, self).__init__()
+		self.coro = coro
+		self.step(None, None)
+
+	def step(self, value, error):
+		# loop while the yielded futures are finished already
+		while True:
+			try:
+				if error is not None:
+					yielded = self.coro.throw(error)
+				else:
+					yielded = self.coro.send(value)
+			except StopIteration:
+				self.set_result(None)
+				return
+			except Return as e:
+				self.set_result(e.value)
+				return
+			except Exception as e:
+				self.set_exception(e)
+				return
+
+			future = spawn(yielded)
+			if not future.done():
+				future.add_done_callback(self.wake)
+				return
+			value, error = outcome(future)
+
+	def wake(self, future):
+		self.step(*outcome(future))
+
+
+def outcome(future):
+	"""
+	(result, None) of a finished future, or (None, exception).
+	"""
+	error = future.exception() if hasattr(future, "exception") else None
+	if error is not None:
+		return None, error
+	return future.result(), None
+
+def spawn(value):
+	"""
+	value as a Future: a coroutine runs as a Task, a future is returned as
+	it is, anything else is a finished Future of that value.
+	"""
+	if isinstance(value, types.GeneratorType):
+		return Task(value)
+	if hasattr(value, "add_done_callback"):
+		return value
+	future = Future()
+	future.set_result(value)
+	return future
+
+def gather(values):
+	"""
+	Future of the list of results of values (futures or coroutines), the
+	first exception if one fails.
+	"""
+	futures = [spawn(value) for value in values]
+	gathered = Future()
+	pending = [len(futures)]
+	def done(future):
+		if gathered.done():
+			return
+		value, error = outcome(future)
+		if error is not None:
+			gathered.set_exception(error)
+			return
+		pending[0] -= 1
+		if not pending[0]:
+			gathered.set_result([outcome(future)[0] for future in futures])
+	if not futures:
+		gathered.set_result([])
+	for future in futures:
+		future.add_done_callback(done)
+	return gathered
+
+
+class Timer(object):
+	"""
+	A callback due at a point in time, see EventLoop.call_at().
+	"""
+	due = 0.0 					# time.time() it runs at
+	callback = None
+	args = ()
+	cancelled = False
+
+	def __init__(self, due, callback, args):
+		self.due = due
+		self.callback = callback
+		self.args = args
+
+	def cancel(self):
+		"""
+		Don't run. The timer leaves the heap when it comes due.
+		"""
+		self.cancelled = True
+
+
+class EventLoop(object):
+	"""
+	Runs the callbacks of ready sockets, due timers and call_soon(), one
+	wakeup at a time.
+	"""
+	poller = None 				# zmq.Poller of the watched sockets
+	readers = None 			# socket key -> (callback, args) when it has something to read
+	writers = None 			# socket key -> (callback, args) when it can be written
+	timers = None 				# heap of (due, seq, Timer)
+	timer_seq = 0 				# orders timers due at the same time
+	ready = None 				# (callback, args) to run at the next wakeup
+	running = False 			# run_forever() goes on
+
+	def __init__(self):
+		self.poller = zmq.Poller()
+		self.readers = {}
+		self.writers = {}
+		self.timers = []
+		self.ready = deque()
+
+	def time(self):
+		return time.time()
+
+	def key(self, socket):
+		"""
+		What the poller reports socket as ready by: a zmq socket itself, the
+		file descriptor of anything else.
+		"""
+		if isinstance(socket, zmq.Socket) or isinstance(socket, int):
+			return socket
+		return socket.fileno()
+
+	def watch(self, key):
+		"""
+		Poll a socket for what its reader and writer wait on.
+		"""
+		flags = (zmq.POLLIN if key in self.readers else 0) | (
+				zmq.POLLOUT if key in self.writers else 0)
+		if flags:
+			self.poller.register(key, flags)
+		else:
+			self.poller.unregister(key)
+
+	def add_reader(self, socket, callback, *args):
+		key = self.key(socket)
+		self.readers[key] = (callback, args)
+		self.watch(key)
+
+	def remove_reader(self, socket):
+		"""
+		Stop reading socket, before it is closed.
+		"""
+		key = self.key(socket)
+		if self.readers.pop(key, None) is not None:
+			self.watch(key)
+
+	def add_writer(self, socket, callback, *args):
+		key = self.key(socket)
+		self.writers[key] = (callback, args)
+		self.watch(key)
+
+	def remove_writer(self, socket):
+		key = self.key(socket)
+		if self.writers.pop(key, None) is not None:
+			self.watch(key)
+
+	def call_at(self, due, callback, *args):
+		"""
+		Run callback(*args) at time.time() due, returns its Timer.
+		"""
+		timer = Timer(due, callback, args)
+		self.timer_seq += 1
+		heapq.heappush(self.timers, (due, self.timer_seq, timer))
+		return timer
+
+	def call_later(self, delay, callback, *args):
+		"""
+		Run callback(*args) in delay secs, returns its Timer.
+		"""
+		return self.call_at(time.time() + delay, callback, *args)
+
+	def call_soon(self, callback, *args):
+		self.ready.append((callback, args))
+
+	def sleep(self, delay, value=None):
+		"""
+		Future of value, finished in delay secs.
+		"""
+		future = Future()
+		self.call_later(delay, future.set_result, value)
+		return future
+
+	def run(self, callback, args):
+		try:
+			callback(*args)
+		except Exception:
+			# like asyncio's default handler: log it, keep the loop going
+			logging.exception("E: callback %r failed", callback)
+
+	def run_once(self):
+		"""
+		Wait for a socket or the next timer, then run what is due.
+		"""
+		if self.ready:
+			timeout = 0
+		elif self.timers:
+			timeout = max(0, int(1e3*(self.timers[0][0] - time.time())) + 1)
+		else:
+			timeout = None
+
+		for key, event in self.poller.poll(timeout):
+			# an earlier callback may have removed this one
+			if event & zmq.POLLIN and key in self.readers:
+				self.run(*self.readers[key])
+			if event & zmq.POLLOUT and key in self.writers:
+				self.run(*self.writers[key])
+
+		now = time.time()
+		while self.timers and self.timers[0][0] <= now:
+			due, seq, timer = heapq.heappop(self.timers)
+			if not timer.cancelled:
+				self.run(timer.callback, timer.args)
+
+		# not the ones these add, they run at the next wakeup
+		for i in xrange(len(self.ready)):
+			self.run(*self.ready.popleft())
+
+	def run_forever(self):
+		"""
+		Run until stop() or KeyboardInterrupt.
+		"""
+		self.running = True
+		try:
+			while self.running:
+				self.run_once()
+		except KeyboardInterrupt:
+			pass # interrupted
+		self.running = False
+
+	def run_until_complete(self, value):
+		"""
+		Run until value (a future or coroutine) finishes, returns its result.
+		"""
+		future = spawn(value)
+		future.add_done_callback(lambda future: self.stop())
+		if not future.done():
+			self.run_forever()
+		return future.result()
+
+	def stop(self):
+		self.running = False
+
+def add_server(loop, server):
+	"""
+	Serve a SocketServer server (UDP or TCP) on loop, one request per
+	wakeup. Its handler runs on the loop, so it must answer promptly: fine
+	for discovery and metrics, not for a streaming response.
+	"""
+	server.timeout = 0
+	loop.add_reader(server.socket, server.handle_request)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+ Broker metrics: latency histograms and the Prometheus text endpoint.
+
+ Histograms are recorded by the broker loop itself, a few integer ops per
+ sample, so they stay on in production. Everything else is computed when
+ mmi.stats / mmi.workers or the endpoint is queried.
+"""
+
+import logging
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from bolt_loop import add_server
+
+def quantile_key(q):
+	"""
+	0.5 -> "p50", 0.999 -> "p999"
+	"""
+	return "p" + str(q)[2:].ljust(2, "0")
+
+class Histogram(object):
+	"""
+	Log-linear histogram of durations, HDR style.
+
+	Values are counted in usecs, with 2**SUB_BITS buckets per power of two,
+	so a percentile is off by at most 1/2**SUB_BITS (12.5%) of its value.
+	Memory is fixed, whatever the number of samples.
+	"""
+	SUB_BITS = 3
+	SUB_BUCKETS = 1 << SUB_BITS
+	BUCKETS = 256 						# up to ~2**34 usecs, ~4.8 hours
+	QUANTILES = [0.5, 0.9, 0.99, 0.999]
+
+	counts = None 						# samples per bucket
+	count = 0 							# samples recorded
+	total = 0.0 						# sum of the samples, secs
+	max = 0.0 							# largest sample, secs
+
+	def __init__(self):
+		self.counts = [0] * self.BUCKETS
+
+	def record(self, secs):
+		usecs = int(secs * 1e6)
+		if usecs < 2*self.SUB_BUCKETS:
+			index = max(usecs, 0)
+		else:
+			shift = usecs.bit_length() - self.SUB_BITS - 1
+			index = min((shift << self.SUB_BITS) + (usecs >> shift), self.BUCKETS - 1)
+		self.counts[index] += 1
+		self.count += 1
+		self.total += secs
+		if secs > self.max:
+			self.max = secs
+
+	def lowest(self, index):
+		"""
+		Smallest usecs counted in bucket index.
+		"""
+		if index < 2*self.SUB_BUCKETS:
+			return index
+		shift = (index >> self.SUB_BITS) - 1
+		return (index - (shift << self.SUB_BITS)) << shift
+
+	def percentile(self, q):
+		"""
+		Secs that a fraction q of the samples didn't exceed, 0 if empty.
+		"""
+		rank = q * self.count
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= rank:
+				return min(1e-6*(self.lowest(index + 1) - 1), self.max)
+		return self.max
+
+	def summary(self):
+		"""
+		{count, mean, p50, p90, p99, p999, max}, in secs.
+		"""
+		summary = dict((quantile_key(q), self.percentile(q)) for q in self.QUANTILES)
+		summary.update(count=self.count, max=self.max,
+				mean=self.total / self.count if self.count else 0.0)
+		return summary
+
+
+# service_stats() keys exported as counters and gauges:
+# (key, prometheus name, type, help)
+SERVICE_METRICS = [
+	("received", "bolt_requests_total", "counter", "Requests received."),
+	("queued", "bolt_queue_depth", "gauge", "Requests waiting for a worker."),
+	("spilled", "bolt_spilled_requests", "gauge", "Queued requests spilled to the disk journal."),
+	("idle_workers", "bolt_idle_workers", "gauge", "Workers with no request in flight."),
+	("busy_workers", "bolt_busy_workers", "gauge", "Workers with requests in flight."),
+	("dropped", "bolt_dropped_total", "counter", "Requests dropped by the overflow policy."),
+	("rejected", "bolt_rejected_total", "counter", "Requests rejected by the overflow policy."),
+	("expired", "bolt_expired_total", "counter", "Requests dropped for a passed deadline."),
+	("redelivered", "bolt_redelivered_total", "counter", "Requests requeued after their worker died."),
+	("lost", "bolt_lost_total", "counter", "Requests lost with their worker."),
+	("forwarded", "bolt_forwarded_total", "counter", "Requests forwarded to a peer broker."),
+	("cache_hits", "bolt_cache_hits_total", "counter", "Requests answered from the reply cache."),
+	("cache_misses", "bolt_cache_misses_total", "counter", "Requests of a cached service sent to a worker."),
+]
+# (key, prometheus name, help) of the histograms, exported as summaries
+SERVICE_HISTOGRAMS = [
+	("wait_time", "bolt_dispatch_wait_seconds", "Time requests waited in the queue."),
+	("service_time", "bolt_service_time_seconds", "Time from REQUEST to REPLY on a worker."),
+]
+
+def metrics_text(brokers):
+	"""
+	Prometheus text exposition of the services of brokers (shards get a
+	shard label).
+	"""
+	rows = []
+	for index, broker in enumerate(brokers):
+		labels = 'shard="%d",' % index if len(brokers) > 1 else ''
+		for stats in broker.service_stats():
+			rows.append(('%sservice="%s"' % (labels, stats["name"].replace('"', '\\"')), stats))
+
+	lines = []
+	for key, name, kind, help in SERVICE_METRICS:
+		lines.append("# HELP %s %s" % (name, help))
+		lines.append("# TYPE %s %s" % (name, kind))
+		for labels, stats in rows:
+			lines.append("%s{%s} %s" % (name, labels, stats[key]))
+	for key, name, help in SERVICE_HISTOGRAMS:
+		lines.append("# HELP %s %s" % (name, help))
+		lines.append("# TYPE %s summary" % name)
+		for labels, stats in rows:
+			summary = stats[key]
+			for q in Histogram.QUANTILES:
+				lines.append('%s{%s,quantile="%s"} %.6f' % (name, labels, q, summary[quantile_key(q)]))
+			lines.append("%s_sum{%s} %.6f" % (name, labels, summary["mean"] * summary["count"]))
+			lines.append("%s_count{%s} %d" % (name, labels, summary["count"]))
+	return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	"""
+	GET /metrics
+	"""
+	def do_GET(self):
+		if self.path.split("?")[0] != "/metrics":
+			self.send_error(404)
+			return
+		body = metrics_text(self.server.brokers)
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass # scraped every few secs, not worth a log line
+
+
+def serve_metrics(brokers, port, host="0.0.0.0", loop=None):
+	"""
+	Serve the Prometheus endpoint of brokers from a daemon thread, or on
+	loop (a bolt_loop.EventLoop) if given.
+
+	The broker loop isn't paused: a scrape reads its counters as they are.
+	On the loop the broker is attached to, a scrape runs between its
+	wakeups instead, and sees them all at one point in time.
+	"""
+	server = HTTPServer((host, port), MetricsHandler)
+	server.brokers = brokers
+	if loop is not None:
+		add_server(loop, server)
+	else:
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+	logging.info("I: metrics on http://%s:%d/metrics", host, port)
+	return server
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+ Worker selection policies of the Majordomo broker.
+
+ A scheduler picks which waiting worker of a service gets the next request.
+ The latency aware ones only look at the `window` workers waiting longest,
+ so a pick costs O(window), not O(waiting workers).
+"""
+
+import random
+from itertools import islice
+
+def expected_time(worker):
+	"""
+	Expected secs for worker to finish one more request: EWMA of its service
+	time, times its queue (requests in flight + this one) over its slots.
+	0 for workers not measured yet, so they get tried first.
+	"""
+	return worker.latency * (len(worker.requests) + 1) / worker.slots
+
+
+class FifoScheduler(object):
+	"""
+	The worker waiting longest, as 7/MDP does.
+	"""
+	name = "fifo"
+
+	def pick(self, service):
+		"""
+		Returns (worker_id, worker) from service.waiting.
+		"""
+		return next(service.waiting.iteritems())
+
+
+class LeastLatencyScheduler(object):
+	"""
+	The worker with the least expected_time() among the window waiting longest.
+	"""
+	name = "least-latency"
+	window = 16
+
+	def pick(self, service):
+		return min(islice(service.waiting.iteritems(), self.window),
+				key=lambda item: expected_time(item[1]))
+
+
+class PowerOfTwoScheduler(object):
+	"""
+	Two random workers among the window waiting longest, the one with the
+	least expected_time() wins.
+	"""
+	name = "p2c"
+	window = 16
+
+	def pick(self, service):
+		candidates = list(islice(service.waiting.iteritems(), self.window))
+		if len(candidates) <= 2:
+			return min(candidates, key=lambda item: expected_time(item[1]))
+		a, b = random.sample(candidates, 2)
+		return a if expected_time(a[1]) <= expected_time(b[1]) else b
+
+
+SCHEDULERS = dict((cls.name, cls) for cls in
+		(FifoScheduler, LeastLatencyScheduler, PowerOfTwoScheduler))
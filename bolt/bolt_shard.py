@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+"""
+ Sharded Majordomo Protocol broker
+
+ A thin front-end ROUTER forwards frames to N dispatcher shards. Each shard is
+ a MajordomoBroker owning a disjoint subset of services (crc32 of the service
+ name), running in its own thread (inproc) or process (ipc). Shards send their
+ replies back through the front-end, so clients and workers still see one
+ broker endpoint.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import zlib
+import zmq
+
+import MDP
+from bolt_broker import MajordomoBroker
+from zhelpers import unpack_frames
+
+def shard_of(service_name, shards):
+	"""
+	Index of the shard owning a service, stable across processes.
+	"""
+	return (zlib.crc32(service_name) & 0xffffffff) % shards
+
+def run_shard(endpoint, verbose, batch_size, options):
+	"""
+	Process entry point: serve one shard behind the front-end.
+	"""
+	shard = MajordomoBroker(verbose, batch_size, endpoint, socket_type=zmq.DEALER, **options)
+	shard.serve_forever()
+
+
+class ShardedBroker(object):
+	"""
+	Front-end of a sharded broker.
+
+	Client requests are routed by service name. Worker msgs are routed by the
+	shard their READY went to, so a worker stays with the shard that owns its
+	service. Frames coming back from a shard already carry the routing
+	identity and go out of the front-end unchanged.
+	"""
+
+	THREAD_ENDPOINT = "inproc://bolt-shard-%d" 				# shard index
+	STOP_ENDPOINT = "inproc://bolt-shard-stop-%d" 		# shard index
+	PROCESS_ENDPOINT = "ipc:///tmp/bolt-shard-%d-%d" 	# front-end pid, shard index
+
+	ctx = None 								# Our context
+	frontend = None 						# ROUTER for clients & workers
+	backends = None 						# DEALER to each shard, by shard index
+	poller = None 							# our Poller
+
+	shards = None 							# MajordomoBroker (threads) or Process, by index
+	threads = None 						# Thread of each MajordomoBroker shard, by index
+	stops = None 							# PAIR to each shard thread, a msg stops it
+	endpoints = None 						# shard endpoints, by index
+	processes = False 					# True if shards run as processes
+	worker_shards = None 				# worker identity -> shard index
+	stats_queries = None 				# client identity -> list of (shards yet to answer, stats)
+											# of its mmi.stats "*" queries, oldest first
+	batch_size = MajordomoBroker.BATCH_SIZE 	# max msgs drained per poll wakeup
+	copy_threshold = None 				# larger frames are forwarded zero-copy, None to copy all
+
+	verbose = False 						# Print activity to stdout
+
+	def __init__(self, shards=2, verbose=False, batch_size=MajordomoBroker.BATCH_SIZE,
+			endpoint="tcp://*:5555", processes=False, **options):
+		"""
+		Start the shards and bind the front-end.
+
+		options are passed on to each shard's MajordomoBroker (queue_limit,
+		overflow, ...). A spill_dir gets a subdirectory per shard, which
+		keeps its journals as long as the number of shards stays the same.
+		"""
+		assert shards >= 1
+		self.verbose = verbose
+		self.batch_size = batch_size
+		self.processes = processes
+		self.worker_shards = {}
+		self.stats_queries = {}
+		self.shards = []
+		self.threads = []
+		self.stops = []
+		self.copy_threshold = options.get("copy_threshold")
+
+		self.endpoints = endpoints = []
+		if processes:
+			# fork the shards before this process owns a zmq context.
+			for index in xrange(shards):
+				shard_endpoint = self.PROCESS_ENDPOINT % (os.getpid(), index)
+				shard = multiprocessing.Process(target=run_shard,
+						args=(shard_endpoint, verbose, batch_size, self.shard_options(options, index)))
+				shard.daemon = True
+				shard.start()
+				self.shards.append(shard)
+				endpoints.append(shard_endpoint)
+
+		self.ctx = zmq.Context()
+		if not processes:
+			for index in xrange(shards):
+				shard_endpoint = self.THREAD_ENDPOINT % index
+				shard = MajordomoBroker(verbose, batch_size, shard_endpoint,
+						ctx=self.ctx, socket_type=zmq.DEALER, **self.shard_options(options, index))
+				self.shards.append(shard)
+				endpoints.append(shard_endpoint)
+				stop = self.ctx.socket(zmq.PAIR)
+				stop.linger = 0
+				stop.bind(self.STOP_ENDPOINT % index)
+				self.stops.append(stop)
+
+		self.poller = zmq.Poller()
+		self.backends = []
+		for shard_endpoint in endpoints:
+			backend = self.ctx.socket(zmq.DEALER)
+			backend.linger = 0
+			backend.connect(shard_endpoint)
+			self.poller.register(backend, zmq.POLLIN)
+			self.backends.append(backend)
+
+		self.frontend = self.ctx.socket(zmq.ROUTER)
+		self.frontend.linger = 0
+		self.frontend.bind(endpoint)
+		self.poller.register(self.frontend, zmq.POLLIN)
+		logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S",level=logging.INFO)
+
+	def shard_options(self, options, index):
+		"""
+		MajordomoBroker options of shard index.
+		"""
+		if options.get("spill_dir") is None:
+			return options
+		return dict(options, spill_dir=os.path.join(options["spill_dir"], "shard%d" % index))
+
+	def serve_forever(self):
+		"""
+		Start the shard threads, then shuttle frames between front-end and shards.
+		"""
+		if not self.processes:
+			for index, shard in enumerate(self.shards):
+				shard_thread = threading.Thread(target=self.serve_shard, args=(shard, index))
+				shard_thread.daemon = True
+				shard_thread.start()
+				self.threads.append(shard_thread)
+
+		logging.info("Bolt Broker started with %d shards.", len(self.shards))
+
+		while True:
+			try:
+				items = dict(self.poller.poll())
+			except KeyboardInterrupt:
+				break # Interrupted
+
+			if self.frontend in items:
+				self.route_batch()
+
+			for backend in self.backends:
+				if backend in items:
+					self.reply_batch(backend)
+
+	def serve_shard(self, shard, index):
+		"""
+		Thread entry point: serve a shard until destroy() stops it, then
+		close its sockets from this thread, which owns them.
+		"""
+		stop = self.ctx.socket(zmq.PAIR)
+		stop.linger = 0
+		stop.connect(self.STOP_ENDPOINT % index)
+		try:
+			shard.serve_forever(stop)
+		finally:
+			shard.close()
+			stop.close()
+
+	def load(self):
+		"""
+		Mean load of the shards (see MajordomoBroker.load()), None when
+		they run as processes and keep it to themselves.
+		"""
+		if self.processes:
+			return None
+		return sum(shard.load() for shard in self.shards) / len(self.shards)
+
+	def route_batch(self):
+		"""
+		Drain up to batch_size msgs from the front-end and pass each to its shard.
+		"""
+		for i in xrange(self.batch_size):
+			try:
+				msg = self.recv(self.frontend)
+			except zmq.Again:
+				break # socket drained
+
+			if self.is_stats_query(msg):
+				# every shard has some of the services
+				self.stats_queries.setdefault(msg[0], []).append((set(self.backends), []))
+				for backend in self.backends:
+					backend.send_multipart(msg)
+				continue
+
+			index = self.route(msg)
+			if index is not None:
+				self.backends[index].send_multipart(msg)
+
+	def reply_batch(self, backend):
+		"""
+		Drain up to batch_size msgs from a shard and send them out unchanged.
+		"""
+		for i in xrange(self.batch_size):
+			try:
+				msg = self.recv(backend)
+			except zmq.Again:
+				break # socket drained
+
+			# the shard dropped this worker, so forget its shard too.
+			if len(msg) == 4 and msg[3] == MDP.W_DISCONNECT and msg[2] == MDP.W_WORKER:
+				self.worker_shards.pop(msg[0], None)
+			elif msg[0] in self.stats_queries and self.is_stats_query(msg):
+				msg = self.gather_stats(backend, msg)
+				if msg is None:
+					continue # more shards to hear from
+			self.frontend.send_multipart(msg)
+
+	def recv(self, socket):
+		"""
+		Receive a msg without blocking, large payloads stay zmq.Frame.
+		"""
+		if self.copy_threshold is None:
+			return socket.recv_multipart(zmq.NOBLOCK)
+		return unpack_frames(socket.recv_multipart(zmq.NOBLOCK, copy=False), self.copy_threshold)
+
+	def is_stats_query(self, msg):
+		"""
+		True if msg is a client's mmi.stats "*" query, or a shard's answer
+		to one: a json list, where the stats of a named service are a dict.
+		"""
+		if len(msg) <= 4 or msg[3] != "mmi.stats" or msg[2] not in (MDP.C_CLIENT, MDP.C_CLIENT_H):
+			return False
+		if isinstance(msg[-1], zmq.Frame):
+			msg[-1] = msg[-1].bytes # a long answer, received zero-copy
+		return msg[-1] == "*" or msg[-1][:1] == "["
+
+	def gather_stats(self, backend, msg):
+		"""
+		Add a shard's answer to the client's oldest mmi.stats "*" query it
+		hasn't answered yet (a shard answers in order). Returns the answer
+		with the stats of every shard once all answered, else None.
+		"""
+		queries = self.stats_queries[msg[0]]
+		for i, (pending, stats) in enumerate(queries):
+			if backend in pending:
+				break
+		else:
+			return msg # not ours
+		pending.remove(backend)
+		stats.extend(json.loads(msg[-1]))
+		if pending:
+			return None
+		del queries[i]
+		if not queries:
+			del self.stats_queries[msg[0]]
+		msg[-1] = json.dumps(stats)
+		return msg
+
+	def route(self, msg):
+		"""
+		Returns the index of the shard that should get msg, or None to drop it.
+
+		msg is [identity, '', header, ...] as received by the front-end.
+		"""
+		if len(msg) < 4 or msg[1] != '':
+			return None # error msg
+
+		header = msg[2]
+		if MDP.C_CLIENT == header or MDP.C_CLIENT_H == header:
+			service = msg[3]
+			if service.startswith(MajordomoBroker.INTERNAL_SERVICE_PREFIX) and len(msg) > 4:
+				# mmi queries are answered by the shard owning the named service
+				service = msg[-1]
+			return shard_of(service, len(self.backends))
+		elif MDP.W_WORKER == header:
+			sender = msg[0]
+			command = msg[3]
+			if MDP.W_READY == command and len(msg) > 4:
+				index = shard_of(msg[4], len(self.backends))
+				self.worker_shards[sender] = index
+				return index
+			# unregistered workers go to shard 0, which disconnects them.
+			# Workers a shard expires silently stay mapped until they reconnect
+			# under a new identity; the entry is a few bytes.
+			if MDP.W_DISCONNECT == command:
+				return self.worker_shards.pop(sender, 0)
+			return self.worker_shards.get(sender, 0)
+		return None # error msg
+
+	def destroy(self):
+		"""
+		Stop the shards, destroy context.
+
+		Shard threads share our context, so they close their sockets and
+		exit before it is destroyed.
+		"""
+		for stop, shard_thread in zip(self.stops, self.threads):
+			stop.send("")
+			shard_thread.join()
+		if self.processes:
+			for shard in self.shards:
+				shard.terminate()
+				shard.join()
+			# terminated shards never close their ipc sockets
+			for shard_endpoint in self.endpoints:
+				path = shard_endpoint[len("ipc://"):]
+				if os.path.exists(path):
+					os.remove(path)
+		self.ctx.destroy(0)
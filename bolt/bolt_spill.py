@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""
+ Disk spill journal of a service queue.
+
+ Requests past the memory budget of a service queue are appended to a
+ journal of memory-mapped segment files and read back in order as workers
+ get to them. Appends are buffered and written once per broker wakeup,
+ reads take a batch of requests at a time. A record is
+
+	length (4)  crc32 (4)  queued at (8)  frame count (2)  frame lengths (4 each)  frames
+
+ with its length and crc written last, so a torn record reads as the end
+ of its segment. Read progress is kept in a head file, so a restarted
+ broker resumes the journal where it stopped. fsync modes:
+
+	never 		writeback is left to the OS: survives a broker crash, not a host crash
+	interval 	segment and head are synced every SYNC_INTERVAL secs
+	batch 		synced after every batch written
+"""
+
+import os
+import mmap
+import struct
+import zlib
+from collections import deque
+
+FSYNC_NEVER = "never"
+FSYNC_INTERVAL = "interval"
+FSYNC_BATCH = "batch"
+FSYNC_MODES = [FSYNC_NEVER, FSYNC_INTERVAL, FSYNC_BATCH]
+
+SEGMENT_BYTES = 16 << 20 			# size of a segment file, larger for a larger record
+SYNC_INTERVAL = 1.0 					# secs between syncs with FSYNC_INTERVAL
+
+RECORD = struct.Struct("<II") 	# length, crc32 of the entry that follows
+ENTRY = struct.Struct("<dH") 		# queued at, frame count
+HEAD = struct.Struct("<QQ") 		# segment, offset of the next record to read
+
+def frames_size(frames):
+	"""
+	Bytes in frames, str or zmq.Frame.
+	"""
+	return sum(len(frame) for frame in frames)
+
+def encode(queued_at, frames):
+	"""
+	(queued at, frames) -> record string
+	"""
+	# zmq.Frame payloads, as the broker keeps large ones
+	frames = [getattr(frame, "bytes", frame) for frame in frames]
+	entry = (ENTRY.pack(queued_at, len(frames))
+			+ struct.pack("<%dI" % len(frames), *[len(frame) for frame in frames])
+			+ "".join(frames))
+	return RECORD.pack(len(entry), zlib.crc32(entry) & 0xffffffff) + entry
+
+def decode(entry):
+	"""
+	entry string -> (queued at, frames)
+	"""
+	queued_at, count = ENTRY.unpack_from(entry)
+	offset = ENTRY.size + 4*count
+	frames = []
+	for length in struct.unpack_from("<%dI" % count, entry, ENTRY.size):
+		frames.append(entry[offset:offset + length])
+		offset += length
+	return queued_at, frames
+
+
+class Journal(object):
+	"""
+	FIFO of (queued at, frames) entries in segment files under path.
+	"""
+	path = None 				# directory of the segments and head file
+	segment_bytes = SEGMENT_BYTES 	# size of new segments
+	fsync = FSYNC_NEVER 		# when written data is synced to disk
+	pending = None 			# entries appended since the last flush()
+	count = 0 					# entries written and not read yet
+	read_seq = 0 				# segment being read
+	read_offset = 0 			# of the next record in it
+	read_map = None 			# mmap of the read segment
+	write_seq = 0 				# segment being written
+	write_offset = 0 			# of the next record in it
+	write_map = None 			# mmap of the write segment
+	head = None 				# file of the read position
+	dirty = False 				# written since the last sync
+	sync_at = 0.0 				# next sync with FSYNC_INTERVAL
+
+	def __init__(self, path, segment_bytes=SEGMENT_BYTES, fsync=FSYNC_NEVER):
+		"""
+		Open the journal at path, recovering the entries left unread.
+		"""
+		assert fsync in FSYNC_MODES
+		self.path = path
+		self.segment_bytes = segment_bytes
+		self.fsync = fsync
+		self.pending = deque()
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		head_path = os.path.join(path, "head")
+		self.head = open(head_path, "r+b" if os.path.exists(head_path) else "w+b")
+		data = self.head.read(HEAD.size)
+		if len(data) == HEAD.size:
+			self.read_seq, self.read_offset = HEAD.unpack(data)
+
+		segments = []
+		for name in sorted(os.listdir(path)):
+			if name.endswith(".seg"):
+				seq = int(name[:-len(".seg")], 16)
+				if seq < self.read_seq or not os.path.getsize(self.segment_path(seq)):
+					# read before the head, or created by a rotate the broker died in
+					os.remove(self.segment_path(seq))
+				else:
+					segments.append(seq)
+		if not segments or segments[0] != self.read_seq:
+			# the head segment is gone, start at the first one left
+			self.read_seq = segments[0] if segments else self.read_seq
+			self.read_offset = 0
+
+		# recovered records are counted, new ones go to a new segment
+		for seq in segments:
+			self.read_map = self.map_segment(seq)
+			offset = self.read_offset if seq == self.read_seq else 0
+			while True:
+				entry, offset = self.record_at(self.read_map, offset)
+				if entry is None:
+					break
+				self.count += 1
+			self.read_map.close()
+		self.read_map = None
+		self.write_seq = segments[-1] + 1 if segments else self.read_seq
+
+	def __len__(self):
+		return self.count + len(self.pending)
+
+	def segment_path(self, seq):
+		return os.path.join(self.path, "%016x.seg" % seq)
+
+	def map_segment(self, seq, size=0):
+		"""
+		mmap of segment seq, created with size bytes if size is given.
+		"""
+		with open(self.segment_path(seq), "r+b" if not size else "w+b") as f:
+			if size:
+				f.truncate(size)
+			return mmap.mmap(f.fileno(), 0)
+
+	def record_at(self, segment, offset):
+		"""
+		Returns (entry string, next offset), entry None at the end of segment.
+		"""
+		if offset + RECORD.size > len(segment):
+			return None, offset
+		length, crc = RECORD.unpack_from(segment, offset)
+		start = offset + RECORD.size
+		if not length or start + length > len(segment):
+			return None, offset
+		entry = segment[start:start + length]
+		if zlib.crc32(entry) & 0xffffffff != crc:
+			return None, offset # torn write
+		return entry, start + length
+
+	def append(self, queued_at, frames):
+		"""
+		Queue an entry, written to disk by the next flush().
+		"""
+		self.pending.append((queued_at, frames))
+
+	def flush(self, now):
+		"""
+		Write the pending entries in one batch, then sync as fsync says.
+		"""
+		if self.pending:
+			for queued_at, frames in self.pending:
+				self.write(encode(queued_at, frames))
+			self.count += len(self.pending)
+			self.pending.clear()
+			self.dirty = True
+			if self.fsync == FSYNC_BATCH:
+				self.sync()
+		if self.fsync == FSYNC_INTERVAL and now >= self.sync_at:
+			self.sync()
+			self.sync_at = now + SYNC_INTERVAL
+
+	def write(self, record):
+		if self.write_map is None or self.write_offset + len(record) > len(self.write_map):
+			self.rotate(len(record))
+		offset = self.write_offset
+		# entry first, length and crc last
+		self.write_map[offset + RECORD.size:offset + len(record)] = record[RECORD.size:]
+		self.write_map[offset:offset + RECORD.size] = record[:RECORD.size]
+		self.write_offset += len(record)
+
+	def rotate(self, size):
+		"""
+		Start a new write segment with room for a record of size bytes.
+		"""
+		if self.write_map is not None:
+			if self.fsync != FSYNC_NEVER:
+				self.write_map.flush()
+			self.write_map.close()
+			self.write_seq += 1
+		self.write_map = self.map_segment(self.write_seq, max(self.segment_bytes, size))
+		self.write_offset = 0
+
+	def read(self, max_bytes):
+		"""
+		Returns the oldest entries as (queued at, frames), in order: at least
+		one if any, else as many as fit in max_bytes.
+		"""
+		entries = []
+		size = 0
+		while self.count and (not entries or size < max_bytes):
+			if self.read_map is None:
+				self.read_map = self.map_segment(self.read_seq)
+			entry, offset = self.record_at(self.read_map, self.read_offset)
+			if entry is None:
+				# end of a segment the writer is done with
+				self.read_map.close()
+				self.read_map = None
+				os.remove(self.segment_path(self.read_seq))
+				self.read_seq += 1
+				self.read_offset = 0
+				continue
+			self.read_offset = offset
+			self.count -= 1
+			entries.append(decode(entry))
+			size += len(entry)
+		if entries:
+			self.head.seek(0)
+			self.head.write(HEAD.pack(self.read_seq, self.read_offset))
+			self.head.flush() # to the OS, as the mmap'ed segments are
+			self.dirty = True
+
+		# entries not written yet come after all the written ones
+		while self.pending and (not entries or size < max_bytes):
+			queued_at, frames = self.pending.popleft()
+			entries.append((queued_at, frames))
+			size += frames_size(frames)
+		return entries
+
+	def sync(self):
+		"""
+		Sync the write segment and the head file to disk.
+		"""
+		if self.dirty:
+			if self.write_map is not None:
+				self.write_map.flush()
+			os.fsync(self.head.fileno())
+			self.dirty = False
+
+	def close(self):
+		self.flush(0.0)
+		if self.fsync != FSYNC_NEVER:
+			self.sync()
+		self.head.close()
+		for segment in (self.read_map, self.write_map):
+			if segment is not None:
+				segment.close()
+		self.read_map = self.write_map = None
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+ Request tracing across client, broker and worker.
+
+ A sampled request carries an MDP.H_TRACE header as its first request
+ header: t<trace id>;s<client send>. Broker and worker append a timestamp
+ to it as the request passes, the reply brings it back to the client:
+
+	s	client send 			r	broker receive 		d	dispatch to a worker
+	w	worker start 			e	worker end 				p	broker receive of the reply
+	c	client receive
+
+ Requests without the header cost each hop one frame test. Timestamps are
+ time.time() of each host, so hosts need synced clocks, as for deadlines.
+"""
+
+import json
+import os
+import random
+import time
+import threading
+
+import MDP
+
+# (span name, from point, to point) of the spans of a trace
+SPANS = [
+	("request", "s", "c"),
+	("client to broker", "s", "r"),
+	("queue", "r", "d"),
+	("broker to worker", "d", "w"),
+	("handler", "w", "e"),
+	("worker to broker", "e", "p"),
+	("broker to client", "p", "c"),
+]
+
+def new_trace():
+	"""
+	A trace header for a request sent now.
+	"""
+	return "%s%016x;s%.6f" % (MDP.H_TRACE, random.getrandbits(64), time.time())
+
+def mark(frames, index, point):
+	"""
+	Append a timestamp for point to frames[index] if it is a trace header.
+
+	Returns True if it was.
+	"""
+	if len(frames) > index and isinstance(frames[index], str) and frames[index][:1] == MDP.H_TRACE:
+		frames[index] += ";%s%.6f" % (point, time.time())
+		return True
+	return False
+
+def parse(header):
+	"""
+	t<id>;s<time>;... -> (trace id, [(point, time)])
+	"""
+	fields = header[1:].split(";")
+	return fields[0], [(field[:1], float(field[1:])) for field in fields[1:] if field]
+
+
+class TraceWriter(object):
+	"""
+	Writes the spans of traces to a file in the Trace Event Format, as
+	complete events, one per line; load it in chrome://tracing or Perfetto.
+	"""
+	path = None 				# the trace file
+	file = None 				# open for append
+	lock = None 				# one line at a time from any thread
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.file = open(path, "a")
+		if self.file.tell() == 0:
+			# the format allows the array to stay unterminated
+			self.file.write("[\n")
+
+	def write(self, service, header):
+		"""
+		Export the spans of a finished trace header of a service request.
+		"""
+		trace_id, points = parse(header)
+		# a redelivered request has several dispatches, spans use the last
+		times = dict(points)
+		lines = []
+		for name, start, end in SPANS:
+			if start in times and end in times:
+				lines.append(json.dumps(dict(name=name, cat=service, ph="X", pid=os.getpid(),
+						tid=int(trace_id[-8:], 16), ts=int(1e6*times[start]),
+						dur=max(0, int(1e6*(times[end] - times[start]))),
+						args=dict(trace=trace_id))) + ",\n")
+		with self.lock:
+			self.file.write("".join(lines))
+			self.file.flush()
+
+	def close(self):
+		self.file.close()
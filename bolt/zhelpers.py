@@ -35,6 +35,16 @@ def dump(msg_or_socket):
             print(r"0x%s" % (binascii.hexlify(part).decode('ascii')))
 
 
+def unpack_frames(frames, threshold):
+    """Turn the zmq.Frame parts of a message received with copy=False into
+    bytes, in place, except parts larger than threshold. Those stay zmq.Frame
+    so they can be forwarded or read without copying the payload."""
+    for i, frame in enumerate(frames):
+        if len(frame) <= threshold:
+            frames[i] = frame.bytes
+    return frames
+
+
 def set_id(zsocket):
     """Set simple random printable identity on socket"""
     identity = u"%04x-%04x" % (randint(0, 0x10000), randint(0, 0x10000))
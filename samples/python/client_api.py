@@ -9,11 +9,16 @@
 """
 
 import logging
+import random
 import zmq
 import socket
 import sys
+import time
+from collections import deque, OrderedDict
 
 import MDP
+import bolt_discovery
+import bolt_trace
 from zhelpers import dump
 
 class MajordomoClient(object):
@@ -22,14 +27,24 @@ class MajordomoClient(object):
 	Implements the MDP/Worker spec at http:#rfc.zeromq.org/spec:7.
 	"""
 	broker = None
+	brokers = None 			# static broker endpoints, skipping discovery
+	endpoints = None 			# known broker endpoints, best first, broker is in use
 	ctx = None
 	client = None
 	poller = None
 	timeout = 2500
+	failover_timeout = 500 	# msecs a silent broker has to answer a ping, before failover
+	request = None 			# frames of the request awaiting recv(), resent on failover
 	verbose = False
+	trace_rate = 0.0 			# fraction of requests traced, see set_tracing()
+	tracer = None 				# bolt_trace.TraceWriter of the traced requests
 
-	def __init__(self, verbose=False):
+	# correlation id header of the mmi.service pings asking a silent broker if it's there
+	PING = MDP.H_CORRELATION + "ping"
+
+	def __init__(self, verbose=False, brokers=None):
 		self.verbose = verbose
+		self.brokers = brokers
 		self.ctx = zmq.Context()
 		self.poller = zmq.Poller()
 		logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S",
@@ -48,18 +63,39 @@ class MajordomoClient(object):
 			return ""
 
 	def get_broker(self):
-		try:
-			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-			sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST,1)
-			sock.sendto("BDP01REQ", ("255.255.255.255",5555))
+		"""
+		Pick the broker: the first of the static brokers, else the best one
+		discovered or cached (see bolt_discovery.py). The others are kept
+		for failover. With none known, the default endpoint is tried, zmq
+		connects once a broker is up there.
+		"""
+		self.endpoints = bolt_discovery.discover(self.brokers)
+		if not self.endpoints:
+			logging.warn("W: no broker discovered, trying %s", bolt_discovery.DEFAULT_BROKER)
+			self.endpoints = [bolt_discovery.DEFAULT_BROKER]
+		self.broker = self.endpoints[0]
 
-			sock.settimeout(1.0)
-			data,address = sock.recvfrom(1024)
-			if data == "BDP01REP":
-				self.broker = "tcp://"+ address[0] + ":5555"
-		except:
-			self.broker = None
+	def next_broker(self):
+		"""
+		Move on from a silent broker to the next one known, dropping it from
+		the discovery cache. Returns False if there is no other.
+		"""
+		if len(self.endpoints) < 2:
+			return False
+		bolt_discovery.forget(self.broker)
+		silent = self.broker
+		self.broker = self.endpoints[(self.endpoints.index(silent) + 1) % len(self.endpoints)]
+		logging.warn("W: broker %s is silent, failing over to %s", silent, self.broker)
+		return True
+
+	def ping(self, socket):
+		"""
+		Ask the broker on socket if it is there, it answers any mmi query itself.
+		"""
+		socket.send_multipart(['', MDP.C_CLIENT_H, "mmi.service", self.PING, '', "mmi.service"])
+
+	def is_ping(self, msg):
+		return len(msg) > 3 and msg[3] == self.PING
 
 	def reconnect_to_broker(self):
 		"""
@@ -76,6 +112,32 @@ class MajordomoClient(object):
 		if self.verbose:
 			logging.info("I: connecting to broker at %s...", self.broker)
 
+	def set_tracing(self, path, rate=0.01):
+		"""
+		Trace a fraction rate of the requests, their spans are appended to
+		the file at path (see bolt_trace.py). rate 0 stops tracing.
+		"""
+		if self.tracer is None or self.tracer.path != path:
+			if self.tracer is not None:
+				self.tracer.close()
+			self.tracer = bolt_trace.TraceWriter(path)
+		self.trace_rate = rate
+
+	def trace_headers(self):
+		"""
+		[trace header] for a request picked for tracing, else [].
+		"""
+		if self.trace_rate and random.random() < self.trace_rate:
+			return [bolt_trace.new_trace()]
+		return []
+
+	def finish_trace(self, service, header):
+		"""
+		Export the trace header of a reply, timestamped at its arrival.
+		"""
+		if self.tracer is not None:
+			self.tracer.write(service, header + ";c%.6f" % time.time())
+
 	def send(self, service, request):
 		"""
 		Send request to broker
@@ -85,39 +147,533 @@ class MajordomoClient(object):
 
 		# Prefix request with protocol frames
 		# Frame 0: empty (REQ emulation)
-		# Frame 1: "MDPCxy" (six bytes, MDP/Client x.y)
+		# Frame 1: "MDPC01H" (MDP/Client with request headers)
 		# Frame 2: Service name (printable string)
+		# Frame 3: trace header, if this request is traced
+		# Frame 3/4: deadline header, we stop waiting after timeout
+		# Frame 4/5: empty, end of headers
 
-		request = ['', MDP.C_CLIENT, service] + request
+		deadline = "%.3f" % (time.time() + 1e-3*self.timeout)
+		request = (['', MDP.C_CLIENT_H, service] + self.trace_headers()
+				+ [MDP.H_DEADLINE + deadline, ''] + request)
 		if self.verbose:
 			logging.warn("I: send request to '%s' service: ", service)
 			dump(request)
-		self.client.send_multipart(request)
+		# payloads over zmq's copy_threshold are sent without a copy
+		self.client.send_multipart(request, copy=False)
+		self.request = request
 
 	def recv(self):
 		"""
 		Returns the reply message or None if there was no reply.
+
+		A broker silent for failover_timeout msecs is pinged. If it doesn't
+		answer within failover_timeout either, the request is resent to the
+		next broker. recv() gives up after timeout msecs.
+		"""
+		now = time.time()
+		deadline = now + 1e-3*self.timeout
+		heard_at = now
+		pinged = False
+		while True:
+			due = min(deadline, heard_at + 1e-3*self.failover_timeout)
+			try:
+				ready = self.client.poll(max(0, int(1e3*(due - now)) + 1), zmq.POLLIN)
+			except KeyboardInterrupt:
+				return # interrupted
+			now = time.time()
+			if ready:
+				msg = self.client.recv_multipart()
+				heard_at = now
+				pinged = False
+				if not self.is_ping(msg):
+					break
+			elif now >= deadline:
+				logging.warn("W: permanent error, abandoning request")
+				return None
+			elif now >= due:
+				if not pinged:
+					self.ping(self.client)
+					pinged = True
+				elif self.request is not None and self.next_broker():
+					self.reconnect_to_broker()
+					self.client.send_multipart(self.request, copy=False)
+					pinged = False
+				heard_at = now
+
+		# if we got a reply, process it
+		if self.verbose:
+			logging.info("I: received reply:")
+			dump(msg)
+
+		# Don't try to handle errors, just assert noisily
+		assert len(msg) >= 4
+
+		empty = msg.pop(0)
+		header = msg.pop(0)
+		assert header in (MDP.C_CLIENT, MDP.C_CLIENT_H)
+
+		service = msg.pop(0)
+		if MDP.C_CLIENT_H == header:
+			# strip the request headers
+			status = MDP.header(msg, MDP.H_STATUS)
+			trace = MDP.header(msg, MDP.H_TRACE)
+			if trace is not None:
+				self.finish_trace(service, MDP.H_TRACE + trace)
+			del msg[:msg.index('') + 1]
+			if status is not None:
+				logging.warn("W: request failed with status %s", status)
+				return None
+		return msg
+
+
+class ReplyFuture(object):
+	"""
+	The pending reply of a request sent by MajordomoAsyncClient.
+
+	result() pumps the owning client until this reply (or its timeout) is in,
+	so futures can be waited on in any order.
+	"""
+	client = None 			# owning MajordomoAsyncClient
+	correlation_id = None 	# matches the reply to this request
+	service = None 			# service the request went to
+	sent_at = None 			# time.time() the request was submitted
+	request = None 			# frames sent, sent again on failover or to hedge
+	links = None 				# BrokerLinks the request waits on a reply from
+	hedged = False 			# a duplicate was sent
+	reply = None 				# reply frames, None on timeout or error status
+	status = None 			# MDP status code if the broker answered itself
+	finished = False 			# reply arrived or request timed out
+	callbacks = None 			# called with this future once finished
+
+	def __init__(self, client, correlation_id, service):
+		self.client = client
+		self.correlation_id = correlation_id
+		self.service = service
+		self.sent_at = time.time()
+		self.links = []
+		self.callbacks = []
+
+	def done(self):
+		return self.finished
+
+	def result(self):
+		"""
+		Returns the reply frames, or None if the request timed out.
+		"""
+		while not self.finished:
+			self.client.pump(self.client.timeout)
+		return self.reply
+
+	def add_done_callback(self, fn):
+		if self.finished:
+			fn(self)
+		else:
+			self.callbacks.append(fn)
+
+	def set_result(self, reply, status=None):
+		self.reply = reply
+		self.status = status
+		self.finished = True
+		for fn in self.callbacks:
+			fn(self)
+		self.callbacks = None
+
+
+class BrokerLink(object):
+	"""
+	The connection of a MajordomoAsyncClient to one of its brokers.
+	"""
+	endpoint = None 			# broker endpoint
+	socket = None 			# DEALER connected to it
+	waiting = 0 				# requests waiting on a reply from it
+	heard_at = 0.0 			# when it last sent anything, or started being waited on
+	pinged_at = None 			# when it was pinged for being silent, None if it wasn't
+
+	def __init__(self, endpoint, socket):
+		self.endpoint = endpoint
+		self.socket = socket
+		self.heard_at = time.time()
+
+
+class MajordomoAsyncClient(MajordomoClient):
+	"""
+	Pipelined client: up to window requests in flight at once.
+
+	Each request carries a correlation id header (MDP.C_CLIENT_H), so
+	replies may arrive in any order. submit() returns a ReplyFuture;
+	replies are read by pump(), which submit() and ReplyFuture.result()
+	call as needed, so everything runs on the caller's thread.
+
+	The client backs off when the broker is overloaded: credit (the
+	requests allowed in flight) halves when a request is rejected or a
+	reply reports a full service queue, and grows back by one per
+	successful reply, up to window.
+
+	The client connects to every known broker and sends to the first. A
+	broker that leaves requests unanswered for failover_timeout msecs is
+	pinged, and if it stays silent as long, its requests are sent again to
+	the next broker, which is used from then on. With set_hedging(), a
+	request unanswered after a high quantile of the recent latencies is
+	sent again as well, and the first reply wins. Replies are matched by
+	correlation id, so the other is dropped.
+	"""
+	window = 8 				# max requests in flight
+	credit = 8 				# requests allowed in flight now, 1..window
+	in_flight = None 		# correlation id -> ReplyFuture, oldest first
+	next_id = 0 				# next correlation id
+	links = None 				# BrokerLink of each endpoint
+	link = None 				# BrokerLink of the broker in use
+	hedge_quantile = None 	# latency quantile after which requests are hedged, None for no hedging
+	hedge_after = None 		# secs, the hedge_quantile of latencies, None until measured
+	latencies = None 			# secs of the latest replies
+	observed = 0 				# latencies recorded since set_hedging()
+	hedged = 0 				# duplicates sent to hedge
+	failovers = 0 			# brokers given up on
+	dropped = 0 				# replies dropped as duplicates, or arriving too late
+	loop = None 				# bolt_loop.EventLoop the client runs on, see attach()
+	timer = None 				# loop Timer of the next pump()
+	backlog = None 			# ReplyFutures submitted on the loop past credit, oldest first
+
+	HEDGE_SAMPLES = 256 		# latencies hedge_after is taken from
+	HEDGE_EVERY = 16 			# replies between updates of hedge_after
+
+	def __init__(self, verbose=False, window=8, brokers=None):
+		assert window >= 1
+		self.window = self.credit = window
+		self.in_flight = OrderedDict()
+		self.backlog = deque()
+		self.links = []
+		self.latencies = deque(maxlen=self.HEDGE_SAMPLES)
+		super(MajordomoAsyncClient, self).__init__(verbose, brokers)
+
+	def reconnect_to_broker(self):
+		"""
+		Connect or reconnect to every broker, using the current one.
 		"""
+		for link in self.links:
+			self.unwatch(link.socket)
+			link.socket.close()
+		self.links = []
+		for endpoint in self.endpoints:
+			self.client = self.ctx.socket(zmq.DEALER)
+			self.client.linger = 0
+			self.client.connect(endpoint)
+			self.watch(self.client)
+			self.links.append(BrokerLink(endpoint, self.client))
+		self.link = self.links[self.endpoints.index(self.broker)]
+		self.client = self.link.socket
+		if self.verbose:
+			logging.info("I: connecting to brokers at %s, using %s...",
+					", ".join(self.endpoints), self.broker)
+
+	def watch(self, socket):
+		self.poller.register(socket, zmq.POLLIN)
+		if self.loop is not None:
+			self.loop.add_reader(socket, self.on_readable)
+
+	def unwatch(self, socket):
+		self.poller.unregister(socket)
+		if self.loop is not None:
+			self.loop.remove_reader(socket)
+
+	def attach(self, loop):
+		"""
+		Run on loop (see bolt_loop.py), next to the broker, workers and
+		servers attached to it. Replies are read as they arrive and pings,
+		failover, hedges and timeouts run on loop timers, so submit() never
+		blocks: requests past credit wait in backlog until replies free it.
+		In a coroutine, yield a ReplyFuture rather than call its result().
+		"""
+		self.loop = loop
+		for link in self.links:
+			loop.add_reader(link.socket, self.on_readable)
+		self.arm_timer()
+
+	def on_readable(self):
+		self.pump(0)
+		self.arm_timer()
+
+	def on_timer(self):
+		self.timer = None
+		self.pump(0)
+		self.arm_timer()
+
+	def arm_timer(self):
+		"""
+		Have the loop pump() when the next timeout, ping, failover or hedge
+		is due, unless it does already.
+		"""
+		if not self.in_flight:
+			return
+		oldest = next(self.in_flight.itervalues())
+		timeout = max(0, int(1e3*(oldest.sent_at - time.time())) + self.timeout)
+		due = time.time() + 1e-3*self.next_wakeup(timeout)
+		if self.timer is not None:
+			if self.timer.due <= due:
+				return
+			self.timer.cancel()
+		self.timer = self.loop.call_at(due, self.on_timer)
+
+	def set_hedging(self, quantile=0.95):
+		"""
+		Hedge requests still unanswered after the quantile of the latest
+		reply latencies: a duplicate goes to the next broker. With one
+		broker it queues behind the original at the same broker, and any
+		worker may take it, the one holding the original too if it has a
+		free slot. Only for idempotent services. None stops hedging.
+		"""
+		self.hedge_quantile = quantile
+		self.hedge_after = None
+		self.latencies.clear()
+		self.observed = 0
+
+	def submit(self, service, request):
+		"""
+		Send request to broker, returns its ReplyFuture.
+
+		Blocks (reading replies) while credit requests are in flight, unless
+		attached to a loop.
+		"""
+		while self.loop is None and len(self.in_flight) >= self.credit:
+			self.pump(self.timeout)
+
+		if not isinstance(request, list):
+			request = [request]
+
+		correlation_id = "%x" % self.next_id
+		self.next_id += 1
+		future = ReplyFuture(self, correlation_id, service)
+
+		# Frame 0: empty (REQ emulation)
+		# Frame 1: "MDPC01H" (MDP/Client with request headers)
+		# Frame 2: Service name (printable string)
+		# Frame 3: trace header, if this request is traced
+		# Frame 3/4: correlation id header
+		# Frame 4/5: deadline header, the request expires with the future
+		# Frame 5/6: empty, end of headers
+		deadline = "%.3f" % (future.sent_at + 1e-3*self.timeout)
+		future.request = (['', MDP.C_CLIENT_H, service] + self.trace_headers()
+				+ [MDP.H_CORRELATION + correlation_id, MDP.H_DEADLINE + deadline, ''] + request)
+		if self.verbose:
+			logging.info("I: send request %s to '%s' service: ", correlation_id, service)
+			dump(future.request)
+		if self.backlog or len(self.in_flight) >= self.credit:
+			self.backlog.append(future)
+		else:
+			self.in_flight[correlation_id] = future
+			self.send_to(self.link, future)
+			if self.loop is not None:
+				self.arm_timer()
+		return future
+
+	def send_to(self, link, future):
+		"""
+		Send the request of future to the broker of link, as one more
+		chance to get its reply.
+		"""
+		if not link.waiting:
+			link.heard_at = time.time() # silent from now on is worth noticing
+		link.waiting += 1
+		future.links.append(link)
+		# payloads over zmq's copy_threshold are sent without a copy
+		link.socket.send_multipart(future.request, copy=False)
+
+	def finish(self, future, reply, status=None):
+		"""
+		Finish future, no longer waiting on replies to it.
+		"""
+		del self.in_flight[future.correlation_id]
+		for link in future.links:
+			link.waiting -= 1
+		future.links = []
+		future.set_result(reply, status)
+
+	def pump(self, timeout=0):
+		"""
+		Wait up to timeout msecs for replies, then read all that are ready
+		and finish their futures. Requests older than self.timeout are
+		finished with None. Also pings silent brokers, fails over and
+		hedges as due, waking up early for it, and sends the backlog as
+		credit allows.
+
+		Returns the number of futures finished.
+		"""
+		finished = 0
 		try:
-			items = self.poller.poll(self.timeout)
+			items = dict(self.poller.poll(self.next_wakeup(timeout) if timeout else 0))
 		except KeyboardInterrupt:
-			return # interrupted
+			return finished # interrupted
 
-		if items:
-			# if we got a reply, process it
-			msg = self.client.recv_multipart()
+		for link in self.links:
+			if link.socket in items:
+				finished += self.read_replies(link)
+
+		# expire the oldest requests
+		now = time.time()
+		expired_at = now - 1e-3*self.timeout
+		while self.in_flight:
+			future = next(self.in_flight.itervalues())
+			if future.sent_at > expired_at:
+				break
+			logging.warn("W: no reply to request %s, abandoning it", future.correlation_id)
+			self.finish(future, None)
+			finished += 1
+
+		self.check_links(now)
+		if self.hedge_after is not None:
+			self.hedge(now)
+		while self.backlog and len(self.in_flight) < self.credit:
+			future = self.backlog.popleft()
+			self.in_flight[future.correlation_id] = future
+			if future.sent_at <= expired_at:
+				logging.warn("W: request %s timed out in the backlog", future.correlation_id)
+				self.finish(future, None)
+				finished += 1
+				continue
+			self.send_to(self.link, future)
+		return finished
+
+	def read_replies(self, link):
+		"""
+		Read the replies that are ready from the broker of link, returns
+		the number of futures finished.
+		"""
+		finished = 0
+		while True:
+			try:
+				msg = link.socket.recv_multipart(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			link.heard_at = time.time()
+			link.pinged_at = None
 			if self.verbose:
 				logging.info("I: received reply:")
 				dump(msg)
 
-			# Don't try to handle errors, just assert noisily
-			assert len(msg) >= 4
+			# ['', MDPC01H, service, header..., '', body]
+			if len(msg) < 5 or msg[1] != MDP.C_CLIENT_H or '' not in msg[3:] or self.is_ping(msg):
+				continue # not a pipelined reply
+			empty = msg.index('', 3)
+			future = status = None
+			overloaded = False
+			for frame in msg[3:empty]:
+				tag = frame[:1]
+				if tag == MDP.H_CORRELATION:
+					future = self.in_flight.get(frame[1:])
+				elif tag == MDP.H_STATUS:
+					status = frame[1:]
+					# not for S_SUPERSEDED: a newer request took its place, the queue had room
+					overloaded = status == MDP.S_OVERLOADED
+				elif tag == MDP.H_CREDIT:
+					overloaded = frame[1:] == "0"
+				elif tag == MDP.H_TRACE:
+					self.finish_trace(msg[2], frame)
+
+			if overloaded:
+				self.credit = max(1, self.credit // 2)
+			elif self.credit < self.window:
+				self.credit += 1
+
+			if future is None or link not in future.links:
+				self.dropped += 1
+				continue # a duplicate, timed out already, or not ours
+			if status and len(future.links) > 1:
+				# a failed copy, the other may still make it
+				future.links.remove(link)
+				link.waiting -= 1
+				continue
+			if not status:
+				self.observe_latency(time.time() - future.sent_at)
+			self.finish(future, None if status else msg[empty + 1:], status)
+			finished += 1
+		return finished
 
-			empty = msg.pop(0)
-			header = msg.pop(0)
-			assert MDP.C_CLIENT == header
+	def observe_latency(self, secs):
+		"""
+		Record the latency of a reply, updating hedge_after every HEDGE_EVERY.
+		"""
+		if self.hedge_quantile is None:
+			return
+		self.latencies.append(secs)
+		self.observed += 1
+		if self.observed % self.HEDGE_EVERY == 0:
+			ordered = sorted(self.latencies)
+			self.hedge_after = ordered[int(self.hedge_quantile*(len(ordered) - 1))]
+
+	def next_wakeup(self, timeout):
+		"""
+		msecs to poll for, timeout or less if a ping, failover or hedge is
+		due before.
+		"""
+		due = time.time() + 1e-3*timeout
+		for link in self.links:
+			if link.waiting:
+				due = min(due, (link.pinged_at or link.heard_at) + 1e-3*self.failover_timeout)
+		if self.hedge_after is not None:
+			for future in self.in_flight.itervalues():
+				if not future.hedged:
+					due = min(due, future.sent_at + self.hedge_after)
+					break
+		return max(0, int(1e3*(due - time.time())) + 1)
+
+	def check_links(self, now):
+		"""
+		Ping the brokers silent for failover_timeout while requests wait on
+		them, fail over from those that didn't answer the ping in as long.
+		"""
+		for link in self.links:
+			if not link.waiting or now - link.heard_at < 1e-3*self.failover_timeout:
+				continue
+			if link.pinged_at is None:
+				self.ping(link.socket)
+				link.pinged_at = now
+			elif now - link.pinged_at >= 1e-3*self.failover_timeout:
+				self.fail_over(link)
+
+	def fail_over(self, link):
+		"""
+		Give up on the broker of link: its socket is replaced, dropping what
+		it still queued, the next broker is used if it was in use, and the
+		requests waiting on it alone are sent again there.
+		"""
+		self.failovers += 1
+		if link is self.link and self.next_broker():
+			self.link = self.links[self.endpoints.index(self.broker)]
+			self.client = self.link.socket
+		else:
+			logging.warn("W: broker %s is silent, reconnecting", link.endpoint)
+		self.unwatch(link.socket)
+		link.socket.close()
+		link.socket = self.ctx.socket(zmq.DEALER)
+		link.socket.linger = 0
+		link.socket.connect(link.endpoint)
+		self.watch(link.socket)
+		if link is self.link:
+			self.client = link.socket
+		link.waiting = 0
+		link.pinged_at = None
 
-			service = msg.pop(0)
-			return msg
-		else:      
-			logging.warn("W: permanent error, abandoning request")
+		for future in self.in_flight.values():
+			if link in future.links:
+				future.links.remove(link)
+				if not future.links:
+					self.send_to(self.link, future)
+
+	def hedge(self, now):
+		"""
+		Send a duplicate of the requests unanswered after hedge_after secs,
+		to the broker after the one they went to. Not while the credit is
+		cut back for overload, duplicates would only add to it.
+		"""
+		if self.credit < self.window:
+			return
+		for future in self.in_flight.itervalues():
+			if now - future.sent_at < self.hedge_after:
+				break
+			if future.hedged or not future.links:
+				continue
+			future.hedged = True
+			self.hedged += 1
+			first = self.links.index(future.links[0])
+			self.send_to(self.links[(first + 1) % len(self.links)], future)
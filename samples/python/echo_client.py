@@ -6,7 +6,7 @@ fileDir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(fileDir, "../../bolt"))
 import MDP
 
-from client_api import MajordomoClient
+from client_api import MajordomoClient, MajordomoAsyncClient
 
 class EchoClient(MajordomoClient):
 
@@ -35,9 +35,40 @@ class EchoClient(MajordomoClient):
 		print "%i requests/replies processed" % (count+1)
 
 
+class PipelinedEchoClient(MajordomoAsyncClient):
+
+	def __init__(self,verbose=False,window=8):
+		super(PipelinedEchoClient,self).__init__(verbose,window)
+
+	def run_task(self):
+		requests = 10
+		count = 0
+
+		# keep up to window requests in flight, then collect the replies
+		try:
+			futures = [self.submit("echo", "Hello world %d" % i) for i in xrange(requests)]
+			for future in futures:
+				reply = future.result()
+				if reply is not None:
+					print reply
+					count += 1
+		except KeyboardInterrupt:
+			print "send interrupted, aborting"
+			return
+
+		print "%i requests/replies processed" % count
+
+
 def test():
 	bolt_client = EchoClient()
 	bolt_client.run_task()
+
+def test_pipelined():
+	bolt_client = PipelinedEchoClient()
+	bolt_client.run_task()
 	
 if __name__ == "__main__":
-	test()
+	if "--pipelined" in sys.argv:
+		test_pipelined()
+	else:
+		test()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+ Camera frame decoding for the openface service.
+
+ A JPEG/PNG frame of any resolution is decoded straight from the request
+ buffer (str or memoryview of the zmq frame), mirrored and turned into BGR,
+ into a buffer that is reused while the resolution stays the same.
+"""
+
+import io
+import numpy
+from PIL import Image
+
+try:
+	import cv2 # openface depends on it; decodes from the buffer, in BGR
+except ImportError:
+	cv2 = None
+
+def as_array(data):
+	"""
+	A uint8 numpy array over the bytes of a str or memoryview, not a copy.
+	"""
+	if isinstance(data, memoryview):
+		# python 2 numpy.frombuffer only takes the old buffer protocol
+		return numpy.asarray(data).view(numpy.uint8)
+	return numpy.frombuffer(data, dtype=numpy.uint8)
+
+class FrameDecoder(object):
+	"""
+	Decodes frames into one preallocated (height, width, 3) uint8 array.
+	Not thread safe, use one per thread.
+	"""
+	out = None 			# the decoded frame, reused between calls
+
+	def decode(self, data):
+		"""
+		Returns the mirrored BGR frame of encoded image data.
+
+		The array is overwritten by the next decode(), copy it to keep it.
+		"""
+		if cv2 is not None:
+			# imdecode reads the frame in place, no io.BytesIO copy
+			bgr = cv2.imdecode(as_array(data), cv2.IMREAD_COLOR)
+			if bgr is None:
+				raise IOError("cannot decode frame")
+			out = self.buffer(bgr.shape)
+			cv2.flip(bgr, 1, out)
+			return out
+
+		rgb = numpy.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+		out = self.buffer(rgb.shape)
+		# mirror and RGB -> BGR in one strided view, copied once
+		numpy.copyto(out, rgb[:, ::-1, ::-1])
+		return out
+
+	def buffer(self, shape):
+		"""
+		The output array for shape, reallocated only when the resolution changes.
+		"""
+		if self.out is None or self.out.shape != shape:
+			self.out = numpy.empty(shape, dtype=numpy.uint8)
+		return self.out
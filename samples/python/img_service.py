@@ -1,43 +1,77 @@
 #!/usr/bin/env python
 
+import errno
 import re
-import time
-import threading
-import Queue
+import socket
 
 from os import sep
 from os import curdir
 
-from BaseHTTPServer import BaseHTTPRequestHandler
-from SocketServer import ThreadingMixIn
-from BaseHTTPServer import HTTPServer
-
 import os
 import sys
 fileDir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(fileDir, "../../bolt"))
 import MDP
+import bolt_loop
+
+from worker_api import MajordomoLoopWorker
+
+class FrameBroadcaster(object):
+	'''
+	the latest frame of a stream, handed to any number of viewers.
+
+	publishing replaces the frame and wakes all viewers. a viewer always
+	gets the latest frame, frames published while it was still sending
+	are skipped, so memory stays at one frame per stream.
+	'''
+	frame = None 				# latest frame
+	seq = 0 					# number of frames published
+	watchers = None 			# called with this broadcaster on publish
+
+	def __init__(self):
+		self.watchers = []
+
+	def publish(self, frame):
+		self.frame = frame
+		self.seq += 1
+		for watcher in list(self.watchers):
+			watcher(self)
+
+	def watch(self, watcher):
+		self.watchers.append(watcher)
 
-from worker_api import MajordomoWorker
+	def unwatch(self, watcher):
+		self.watchers.remove(watcher)
 
-share_queue = Queue.Queue()
+DEFAULT_STREAM = "camera" 	# served as camera.mjpeg
+
+streams = {} 					# stream name -> FrameBroadcaster
+
+def get_stream(name):
+	'''
+	the broadcaster of a stream (created if necessary).
+	'''
+	stream = streams.get(name)
+	if stream is None:
+		stream = streams[name] = FrameBroadcaster()
+	return stream
 
 '''
 
 '''
-class EchoService(MajordomoWorker):
+class EchoService(MajordomoLoopWorker):
 
-	def __init__(self, service_name, broker="tcp://localhost:5555",verbose=False):
-		super(EchoService,self).__init__(broker,service_name,verbose)
+	def __init__(self, service_name, broker="tcp://localhost:5555",verbose=False, loop=None):
+		super(EchoService,self).__init__(broker,service_name,loop,slots=1,verbose=verbose)
 
 	def client_request_handler(self, request):
-		global share_queue
 		'''
-		this method should be derived by child class.
+		request: jpeg frame, optionally followed by the stream name.
 		'''
 		#msg = "%s returned." % request.pop(0)
 		msg = request.pop(0)
-		share_queue.put_nowait(msg)
+		name = request.pop(0) if request else DEFAULT_STREAM
+		get_stream(name).publish(msg)
 
 		#print msg
 		#f = open('test2.jpg','w')
@@ -48,84 +82,163 @@ class EchoService(MajordomoWorker):
 
 
 
-class MJPEGStreamHandler(BaseHTTPRequestHandler, object):
-	def do_GET(self):
-		global share_queue
-		self.data_queue = share_queue
+class LoopViewer(object):
+	'''
+	a connection to a LoopMJPEGServer: reads the request, then sends a file,
+	or the frames of a stream as they are published. frames published while
+	it was still sending are skipped.
+	'''
+	loop = None 				# bolt_loop.EventLoop of the server
+	conn = None 				# non-blocking socket to the viewer
+	request = '' 				# request head read so far
+	out = '' 					# bytes being sent
+	sent = 0 					# of them sent
+	stream = None 			# FrameBroadcaster being sent
+	seq = 0 					# of the last frame sent
+	closing = False 			# close once out is sent
 
-		try:
-			self.path = re.sub('[^.a-zA-Z0-9]', "", str(self.path))
-			if self.path== "" or self.path is None or self.path[:1] == ".":
-				return
-
-			if self.path.endswith(".html"):
-				f = open(curdir + sep + self.path)
-				self.send_response(200)
-				self.send_header('Content-type',	'text/html')
-				self.end_headers()
-				self.wfile.write(f.read())
-				f.close()
-				return
+	MAX_REQUEST = 8192 		# bytes of a request head
 
-			if self.path.endswith(".mjpeg"):
-				self.send_response(200)
-				self.wfile.write("Content-Type: multipart/x-mixed-replace; boundary=--aaboundary")
-				self.wfile.write("\r\n\r\n")
-
-				while 1:
-					if self.data_queue.empty() == False:
-						image_data = self.data_queue.get()
-						self.wfile.write("--aaboundary\r\n")
-						self.wfile.write("Content-Type: image/jpeg\r\n")
-						self.wfile.write("Content-length: " + str(len(image_data)) + "\r\n\r\n")
-						self.wfile.write(image_data)
-						self.wfile.write("\r\n\r\n\r\n")
-						time.sleep(0.001)
+	def __init__(self, loop, conn):
+		self.loop = loop
+		self.conn = conn
+		loop.add_reader(conn, self.on_readable)
 
-				return
+	def on_readable(self):
+		try:
+			data = self.conn.recv(4096)
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				self.close()
+			return
+		if not data:
+			self.close() # the viewer went away
+			return
+		if self.stream is not None or self.closing:
+			return # answered already
+		self.request += data
+		if "\r\n\r\n" not in self.request:
+			if len(self.request) > self.MAX_REQUEST:
+				self.close()
+			return
 
-			if self.path.endswith(".jpeg"):
-				f = open(curdir + sep + self.path)
-				self.send_response(200)
-				self.send_header('Content-type', 'image/jpeg')
-				self.end_headers()
-				self.wfile.write(f.read())
+		fields = self.request.split("\r\n", 1)[0].split()
+		path = re.sub('[^.a-zA-Z0-9]', "", fields[1]) if len(fields) > 1 else ""
+		if path == "" or path[:1] == ".":
+			self.close()
+		elif path.endswith(".mjpeg"):
+			self.write("HTTP/1.0 200 OK\r\n"
+					"Content-Type: multipart/x-mixed-replace; boundary=--aaboundary\r\n\r\n")
+			self.stream = get_stream(path[:-len(".mjpeg")])
+			self.stream.watch(self.on_frame)
+			if self.stream.seq:
+				self.on_frame(self.stream)
+		elif path.endswith(".html") or path.endswith(".jpeg"):
+			try:
+				f = open(curdir + sep + path)
+				body = f.read()
 				f.close()
+				content_type = "text/html" if path.endswith(".html") else "image/jpeg"
+				self.write("HTTP/1.0 200 OK\r\nContent-type: %s\r\n\r\n" % content_type + body)
+			except IOError:
+				self.write("HTTP/1.0 404 Not Found\r\n\r\nFile Not Found: %s" % path)
+			self.closing = True
+			self.flush()
+		else:
+			self.close()
+
+	def on_frame(self, stream):
+		if self.sent == len(self.out):
+			self.send_frame()
+		# else the latest frame goes once this one is sent
+
+	def send_frame(self):
+		self.seq = self.stream.seq
+		image_data = self.stream.frame
+		self.write("--aaboundary\r\n"
+				"Content-Type: image/jpeg\r\n"
+				"Content-length: " + str(len(image_data)) + "\r\n\r\n"
+				+ image_data + "\r\n\r\n\r\n")
+
+	def write(self, data):
+		if self.sent == len(self.out):
+			self.out = data
+			self.sent = 0
+		else:
+			self.out = self.out[self.sent:] + data
+			self.sent = 0
+		self.flush()
+
+	def flush(self):
+		'''
+		send what the socket takes, the rest once it's writable.
+		'''
+		try:
+			self.sent += self.conn.send(memoryview(self.out)[self.sent:])
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				self.close()
 				return
-
+		if self.sent < len(self.out):
+			self.loop.add_writer(self.conn, self.flush)
 			return
-		except IOError:
-			self.send_error(404,'File Not Found: %s' % self.path)
-
-
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-	stopped = False
-    
-	"""Handle requests in a separate thread."""
-	def serve_forever(self):
-		while not self.stopped:
-			self.handle_request()
+		self.loop.remove_writer(self.conn)
+		if self.closing:
+			self.close()
+		elif self.stream is not None and self.stream.seq != self.seq:
+			self.send_frame()
+
+	def close(self):
+		if self.conn is None:
+			return
+		if self.stream is not None:
+			self.stream.unwatch(self.on_frame)
+			self.stream = None
+		self.loop.remove_reader(self.conn)
+		self.loop.remove_writer(self.conn)
+		self.conn.close()
+		self.conn = None
+
+
+class LoopMJPEGServer(object):
+	'''
+	serves the html and jpeg files and the mjpeg streams on a
+	bolt_loop.EventLoop, next to the worker publishing the frames, with no
+	thread per viewer.
+	'''
+	loop = None 				# bolt_loop.EventLoop it runs on
+	listener = None 			# listening socket
+
+	def __init__(self, loop, address=('0.0.0.0', 8080)):
+		self.loop = loop
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(address)
+		self.listener.listen(16)
+		self.listener.setblocking(0)
+		loop.add_reader(self.listener, self.accept)
+
+	def accept(self):
+		try:
+			conn, address = self.listener.accept()
+		except socket.error:
+			return # taken back by the viewer already
+		conn.setblocking(0)
+		LoopViewer(self.loop, conn)
 
 	def terminate(self):
-		self.server_close()
-		self.stopped = True
-
-		# close all thread
-		if self.socket != -1:
-			self.socket.close()
+		self.loop.remove_reader(self.listener)
+		self.listener.close()
 
 if __name__ == "__main__":
 
-	http_server = ThreadedHTTPServer(('0.0.0.0', 8080), MJPEGStreamHandler)
-	http_server_thread = threading.Thread(target=http_server.serve_forever)
-	http_server_thread.daemon = True
-	http_server_thread.start()
+	# the worker and the viewers share one thread and loop
+	loop = bolt_loop.EventLoop()
+	http_server = LoopMJPEGServer(loop, ('0.0.0.0', 8080))
 
-	bolt_worker = EchoService("image")
+	bolt_worker = EchoService("image", loop=loop)
 	bolt_worker.serve_forever()
-	
-	while True:
-		time.sleep(1)
 
+	http_server.terminate()
 	bolt_worker.destroy()
 
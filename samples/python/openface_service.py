@@ -6,65 +6,172 @@ fileDir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(fileDir, "../../bolt"))
 import MDP
 
-from worker_api import MajordomoWorker
+from worker_api import MajordomoWorker, MajordomoBatchWorker
+from frame_decoder import FrameDecoder
 
 import time
+import uuid
 import numpy
 import pickle
-import StringIO
-from PIL import Image
+import cv2
 
 # openface settings
 import openface
 align = openface.AlignDlib("/usr/local/lib/python2.7/dist-packages/openface/models/dlib/shape_predictor_68_face_landmarks.dat")
 net = openface.TorchNeuralNet("/usr/local/lib/python2.7/dist-packages/openface/models/openface/nn4.small2.v1.t7", imgDim=96,cuda=False)
+CLASSIFIER = "/usr/local/lib/python2.7/dist-packages/openface/models/ronis_classifier.pkl"
 
-def getRep(data):
-	if data is not None:
-		imgF = StringIO.StringIO()
-		imgF.write(data)
-		imgF.seek(0)
-		img = Image.open(imgF)
+decoder = FrameDecoder()
 
-		buf = numpy.fliplr(numpy.asarray(img))
-		rgbFrame = numpy.zeros((240, 320, 3), dtype=numpy.uint8)
-		rgbFrame[:, :, 0] = buf[:, :, 2]
-		rgbFrame[:, :, 1] = buf[:, :, 1]
-		rgbFrame[:, :, 2] = buf[:, :, 0]
+def getFace(data):
+	if data is not None:
+		# data is a str, or a memoryview of the zmq frame (zero_copy);
+		# mirrored BGR at the camera's resolution, in a reused buffer.
+		rgbFrame = decoder.decode(data)
 
 		#		
 		bb = align.getLargestFaceBoundingBox(rgbFrame)
 		alignedFace = align.align(96, rgbFrame, bb,landmarkIndices=openface.AlignDlib.OUTER_EYES_AND_NOSE)
-
-		if alignedFace is not None:
-			rep = net.forward(alignedFace)
-			return (rep,bb)
+		return (alignedFace,bb)
 
 	return (None,None)
 
-def recognize(img):
-	with open("/usr/local/lib/python2.7/dist-packages/openface/models/ronis_classifier.pkl",'r') as f:
-		(le, clf) = pickle.load(f)
-		tmp,bb = getRep(img)
-		if tmp is not None:
-			rep = tmp.reshape(1, -1)
-		else:
-			return (None,None)	
+def getRep(data):
+	alignedFace,bb = getFace(data)
+	if alignedFace is not None:
+		rep = net.forward(alignedFace)
+		return (rep,bb)
 
-		predictions = clf.predict_proba(rep).ravel()
-		maxI = numpy.argmax(predictions)
-		person = le.inverse_transform(maxI)
-		confidence = predictions[maxI]
-		
-		return (person,bb)
+	return (None,None)
+
+def forwardBatch(faces):
+	'''
+	reps of several aligned faces in one pass of the torch process.
+
+	TorchNeuralNet.forward() writes a face to a png, sends its path to the
+	lua process and waits for the rep, once per face. here all the paths
+	go out in one write and the reps are read back in order, so the torch
+	process runs the faces back to back.
+	'''
+	if not hasattr(net, "p"):
+		return [net.forward(face) for face in faces]
+
+	paths = []
+	try:
+		for face in faces:
+			path = "/tmp/openface-batch-{}.png".format(uuid.uuid4())
+			cv2.imwrite(path, cv2.cvtColor(face, cv2.COLOR_RGB2BGR))
+			paths.append(path)
+		net.p.stdin.write("".join(path + "\n" for path in paths))
+		net.p.stdin.flush()
+		return [numpy.array([float(x) for x in net.p.stdout.readline().strip().split(',')])
+				for path in paths]
+	finally:
+		for path in paths:
+			os.remove(path)
+
+class Classifier(object):
+	'''
+	the pickled (label encoder, classifier), loaded once and reloaded
+	when the file's mtime changes.
+	'''
+	CHECK_INTERVAL = 1.0 	# secs between mtime checks
+
+	path = None 			# pickle file
+	mtime = None 			# mtime of the loaded pickle
+	checked_at = 0 		# time.time() of the last mtime check
+	le = None 				# label encoder
+	clf = None 				# classifier
+
+	def __init__(self, path):
+		self.path = path
+		self.load()
+
+	def load(self):
+		'''
+		(re)load the pickle, returns the secs it took.
+		'''
+		start = time.time()
+		mtime = os.path.getmtime(self.path)
+		with open(self.path,'r') as f:
+			(self.le, self.clf) = pickle.load(f)
+		self.mtime = mtime
+		self.checked_at = time.time()
+		return self.checked_at - start
+
+	def reload_if_changed(self):
+		'''
+		reload the pickle if it changed on disk, at most every CHECK_INTERVAL.
+		'''
+		now = time.time()
+		if now - self.checked_at < self.CHECK_INTERVAL:
+			return
+		self.checked_at = now
+		try:
+			if os.path.getmtime(self.path) == self.mtime:
+				return
+			print("reloaded {} in {} seconds.".format(self.path, self.load()))
+		except Exception as e:
+			# half written, removed or not a (le, clf) pickle, keep
+			# serving with the loaded one
+			print("reloading {} failed: {}".format(self.path, e))
+
+def recognizeBatch(imgs, classifier):
+	'''
+	(person,bb) of every img, with one forward pass and one classifier
+	call for all the faces found.
+	'''
+	found = [getFace(img) for img in imgs]
+	faces = [i for i, (alignedFace,bb) in enumerate(found) if alignedFace is not None]
+	results = [(None,None)] * len(imgs)
+	if not faces:
+		return results
+
+	reps = forwardBatch([found[i][0] for i in faces])
+	predictions = classifier.clf.predict_proba(numpy.vstack(reps))
+	people = classifier.le.inverse_transform(numpy.argmax(predictions, axis=1))
+	for i, person in zip(faces, people):
+		results[i] = (person, found[i][1])
+	return results
+
+def warm_up(classifier):
+	'''
+	run a dummy face through net.forward and the classifier, so the first
+	real request doesn't pay for the allocations. returns the secs it took.
+	'''
+	start = time.time()
+	rep = net.forward(numpy.zeros((96, 96, 3), dtype=numpy.uint8))
+	classifier.clf.predict_proba(rep.reshape(1, -1))
+	return time.time() - start
+
+def recognize(img, classifier):
+	tmp,bb = getRep(img)
+	if tmp is not None:
+		rep = tmp.reshape(1, -1)
+	else:
+		return (None,None)	
+
+	predictions = classifier.clf.predict_proba(rep).ravel()
+	maxI = numpy.argmax(predictions)
+	person = classifier.le.inverse_transform(maxI)
+	confidence = predictions[maxI]
+	
+	return (person,bb)
 
 '''
 
 '''
 class OpenfaceService(MajordomoWorker):
+	zero_copy = True # frames arrive as memoryview, read by getRep directly
+	classifier = None # Classifier, loaded before registering with the broker
 
 	def __init__(self, service_name, broker="tcp://localhost:5555",verbose=False):
-		
+		# models load before READY, so no request waits for them
+		start = time.time()
+		self.classifier = Classifier(CLASSIFIER)
+		warm = warm_up(self.classifier)
+		print("startup took {} seconds (warm-up {} seconds).".format(time.time()-start, warm))
+
 		super(OpenfaceService,self).__init__(broker,service_name,verbose)
 			
 	def client_request_handler(self, request):
@@ -79,7 +186,8 @@ class OpenfaceService(MajordomoWorker):
 		#f.close()
 
 		start = time.time()
-		person,bb = recognize(msg)
+		self.classifier.reload_if_changed()
+		person,bb = recognize(msg, self.classifier)
 
 		if person is not None:
 			ret = person
@@ -92,11 +200,47 @@ class OpenfaceService(MajordomoWorker):
 	
 
 
+class OpenfaceBatchService(MajordomoBatchWorker):
+	'''
+	OpenfaceService collecting up to batch_size frames, or what arrives
+	within batch_wait msecs, for one forward pass and classifier call.
+	'''
+	zero_copy = True # frames arrive as memoryview, read by getRep directly
+	classifier = None # Classifier, loaded before registering with the broker
+
+	def __init__(self, service_name, broker="tcp://localhost:5555", batch_size=8, batch_wait=10, verbose=False):
+		start = time.time()
+		self.classifier = Classifier(CLASSIFIER)
+		warm = warm_up(self.classifier)
+		print("startup took {} seconds (warm-up {} seconds).".format(time.time()-start, warm))
+
+		super(OpenfaceBatchService,self).__init__(broker,service_name,batch_size,batch_wait,verbose)
+
+	def batch_request_handler(self, requests):
+		start = time.time()
+		self.classifier.reload_if_changed()
+		results = recognizeBatch([request[0] for request in requests], self.classifier)
+
+		print("batch of {} took {} seconds.".format(len(requests), time.time()-start))
+		return [[person if person is not None else "unknown"] for person,bb in results]
+
+
+
 def test():
 	bolt_worker = OpenfaceService("openface")
 	bolt_worker.serve_forever()
 	bolt_worker.destroy()
+
+def test_batch(batch_size, batch_wait):
+	bolt_worker = OpenfaceBatchService("openface", batch_size=batch_size, batch_wait=batch_wait)
+	bolt_worker.serve_forever()
+	bolt_worker.destroy()
 	
 	
 if __name__ == "__main__":
-	test()
+	# --batch B [T]: batches of up to B frames, waiting up to T msecs
+	if "--batch" in sys.argv:
+		args = sys.argv[sys.argv.index("--batch") + 1:]
+		test_batch(int(args[0]) if args else 8, int(args[1]) if len(args) > 1 else 10)
+	else:
+		test()
@@ -10,9 +10,14 @@
 import zmq
 import time
 import logging
+import multiprocessing
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import MDP						# MajorDomo protocol constants
-from zhelpers import dump
+import bolt_loop
+import bolt_trace
+from zhelpers import dump, zpipe, unpack_frames
 
 class MajordomoWorker(object):
 	'''
@@ -35,7 +40,10 @@ class MajordomoWorker(object):
 	# Internal state
 	timeout = 2500 			# poller timeout
 	verbose = False 			# Print activity to stdout
-	reply_to = None			# Return address, if any
+	zero_copy = False 		# hand request frames over copy_threshold to the handler as memoryview
+	copy_threshold = zmq.COPY_THRESHOLD 	# bytes (64K), see zero_copy
+	reply_to = None			# Return envelope [client, header...], if any
+	expired = 0 				# requests dropped for a passed deadline
 	
 	
 	def __init__(self, broker, service, verbose=False):
@@ -65,10 +73,9 @@ class MajordomoWorker(object):
 		# Register service with broker
 		self.register_service(self.service)
 
-		# Reset liveness & heartbeat.
+		# Reset liveness, READY reset the heartbeat.
 		# If liveness hits zero, queue is considered disconnected
 		self.liveness = self.HEARTBEAT_LIVENESS
-		self.heartbeat_at = time.time() + 1e-3 * self.heartbeat
 		
 	def register_service(self, service_name):
 		"""
@@ -84,7 +91,7 @@ class MajordomoWorker(object):
 		"""
 		command : REPLY
 		msg : 
-			Frame 3 - the target of this reply.
+			Frame 3 - the target of this reply, followed by any request headers.
 			Frame 4 - empty
 			Frame 5 - the content of this reply.
 		"""
@@ -92,10 +99,29 @@ class MajordomoWorker(object):
 		
 		if not isinstance(reply, list):
 			reply = [reply]
+		if not isinstance(reply_to, list):
+			reply_to = [reply_to]
 		
-		msg = [reply_to, '', ] + reply
+		msg = reply_to + [''] + reply
 		self.send_to_broker(command, msg)
 		
+	def send_status(self, reply_to, status):
+		"""
+		Answer a request with a status code (in a status header) instead
+		of running the handler; frees the slot at the broker all the same.
+		"""
+		self.send_reply(reply_to + [MDP.H_STATUS + status], [])
+		
+	def is_expired(self, reply_to):
+		"""
+		True if the request headers in reply_to carry a deadline that passed.
+		"""
+		deadline = MDP.header(reply_to, MDP.H_DEADLINE, 1)
+		try:
+			return deadline is not None and float(deadline) < time.time()
+		except ValueError:
+			return False # malformed deadline, treat as none
+		
 	def send_heartbeat(self):
 		"""
 		command : HEARTBEAT
@@ -144,7 +170,20 @@ class MajordomoWorker(object):
 		
 		# finally, send the msg.	
 		#print msg
-		self.wsocket.send_multipart(msg)
+		self.wsocket.send_multipart(msg, copy=not self.zero_copy)
+		# the broker takes any msg as a heartbeat, a busy worker sends none
+		self.heartbeat_at = time.time() + 1e-3*self.heartbeat
+		
+	def recv_from_broker(self):
+		"""
+		Receive a msg from the broker.
+		
+		With zero_copy, frames over copy_threshold stay zmq.Frame (no copy
+		into a Python string) and reach the handler as memoryview.
+		"""
+		if not self.zero_copy:
+			return self.wsocket.recv_multipart()
+		return unpack_frames(self.wsocket.recv_multipart(copy=False), self.copy_threshold)
 		
 	def client_request_handler(self, request):
 		"""
@@ -152,6 +191,23 @@ class MajordomoWorker(object):
 		"""
 		pass
 		
+	def trace(self, reply_to, point):
+		"""
+		Timestamp a traced request (see bolt_trace.py). Its trace header is
+		the first request header, after the broker's dispatch tag if any.
+		"""
+		if len(reply_to) > 1:
+			bolt_trace.mark(reply_to, 2 if reply_to[1][:1] == MDP.H_DISPATCH else 1, point)
+		
+	def handle_request(self, reply_to, request):
+		"""
+		Run the handler on a request and send its reply.
+		"""
+		self.trace(reply_to, "w")
+		reply = self.client_request_handler(request)
+		self.trace(reply_to, "e")
+		self.send_reply(reply_to, reply)
+		
 	def msg_handler(self,msg):
 		"""
 		May receive 3 kinds of msg:
@@ -166,16 +222,35 @@ class MajordomoWorker(object):
 	
 		command = msg.pop(0)
 		if command == MDP.W_REQUEST:
-			# We should pop and save as many addresses as there are
-			# up to a null part, but for now, just save one...
-			self.reply_to = msg.pop(0)
-			
-			if self.reply_to == None or msg.pop(0) != '':
-				return # error msg
+			# Pop and save as many addresses (client + request headers)
+			# as there are up to a null part.
+			try:
+				empty = msg.index('')
+			except ValueError:
+				# error msg, but answer it so the broker frees its slot:
+				# [client, dispatch tag, ...] are all it needs to match it
+				if len(msg) >= 2:
+					self.send_status(msg[:2], MDP.S_BAD_REQUEST)
+				return
+			if empty == 0:
+				return # error msg, no client address
+
+			self.reply_to = msg[:empty]
+			del msg[:empty + 1]
+
+			if empty > 1 and self.is_expired(self.reply_to):
+				# nobody waits for this reply anymore, skip the handler
+				self.expired += 1
+				self.send_status(self.reply_to, MDP.S_EXPIRED)
+				return
+		
+			if self.zero_copy:
+				for i, frame in enumerate(msg):
+					if isinstance(frame, zmq.Frame):
+						msg[i] = frame.buffer
 		
 			# handle a valid request, then send to the target.
-			reply = self.client_request_handler(msg)
-			self.send_reply(self.reply_to, reply)
+			self.handle_request(self.reply_to, msg)
 		elif command == MDP.W_HEARTBEAT:
 			# Do nothing for heartbeats
 			pass
@@ -200,7 +275,7 @@ class MajordomoWorker(object):
 				break # Interrupted
 	
 			if items: # received a msg.
-				msg = self.wsocket.recv_multipart()
+				msg = self.recv_from_broker()
 				#if self.verbose:
 				#	logging.info("I: received message from broker: ")
 				#	dump(msg)
@@ -225,7 +300,6 @@ class MajordomoWorker(object):
 			# Send HEARTBEAT if it's time
 			if time.time() > self.heartbeat_at:
 				self.send_heartbeat()
-				self.heartbeat_at = time.time() + 1e-3*self.heartbeat
 					
 		#logging.warn("W: interrupt received, killing worker...")
 		return None
@@ -233,5 +307,380 @@ class MajordomoWorker(object):
 	def destroy(self):
 		# context.destroy depends on pyzmq >= 2.1.10
 		self.ctx.destroy(0)
+
+
+def run_handler(handler, request):
+	"""
+	Pool entry point: run handler on request, never raise.
+
+	Returns the reply, or None if the handler failed.
+	"""
+	try:
+		return handler(request)
+	except Exception:
+		logging.exception("E: request handler failed")
+		return None
+
+
+class MajordomoPoolWorker(MajordomoWorker):
+	'''
+	A worker running up to `slots` requests at once behind one broker connection.
+	
+	READY advertises the slots to the broker, which keeps one credit per free
+	slot. Handlers run on a thread pool (or a process pool), while this
+	thread keeps reading the broker socket and sending heartbeats. Finished
+	replies come back to this thread over an inproc pipe.
+	
+	With processes=True the handler is pickled to the pool, so pass a
+	module-level function as handler instead of overriding
+	client_request_handler.
+	'''
+	
+	slots = 1 				# concurrent requests
+	pool = None 				# ThreadPool or multiprocessing.Pool running the handlers
+	handler = None 			# callable(request) -> reply
+	busy = 0 					# requests running on the pool
+	results = None 			# pipe end read by this thread
+	results_in = None 		# pipe end written by the pool's result thread
+	
+	def __init__(self, broker, service, slots=4, handler=None, processes=False, verbose=False):
+		assert slots >= 1
+		assert handler is not None or not processes
+		self.slots = slots
+		self.handler = handler or self.client_request_handler
+		if processes:
+			# fork the pool before this process owns a zmq context.
+			self.pool = multiprocessing.Pool(slots)
+		else:
+			self.pool = ThreadPool(slots)
+		super(MajordomoPoolWorker, self).__init__(broker, service, verbose)
+		self.results, self.results_in = zpipe(self.ctx)
+		self.poller.register(self.results, zmq.POLLIN)
+		
+	def register_service(self, service_name):
+		"""
+		command : READY
+		msg : 
+			Frame 3 - name of this service.
+			Frame 4 - number of concurrent slots.
+		"""
+		self.send_to_broker(MDP.W_READY, [service_name, str(self.slots)])
+		
+	def handle_request(self, reply_to, request):
+		"""
+		Queue the request on the pool, the reply is sent when it finishes.
+		"""
+		self.busy += 1
+		self.trace(reply_to, "w")
+		self.pool.apply_async(run_handler, (self.handler, request),
+				callback=partial(self.request_done, reply_to))
+		
+	def request_done(self, reply_to, reply):
+		"""
+		Runs on the pool's result thread: hand the reply to the I/O thread.
+		"""
+		if reply is None:
+			# the handler failed, still free the slot
+			reply_to, reply = reply_to + [MDP.H_STATUS + MDP.S_FAILED], []
+		elif not isinstance(reply, list):
+			reply = [reply]
+		self.trace(reply_to, "e")
+		self.results_in.send_multipart(reply_to + [''] + reply, copy=not self.zero_copy)
+		
+	def send_results(self):
+		"""
+		Send every finished reply to the broker.
+		"""
+		while True:
+			try:
+				msg = self.results.recv_multipart(zmq.NOBLOCK, copy=not self.zero_copy)
+			except zmq.Again:
+				break
+			self.busy -= 1
+			self.send_to_broker(MDP.W_REPLY, msg)
+			
+	def serve_forever(self):
+		"""
+		Read requests and finished replies, heartbeat even while all slots are busy.
+		"""
+		logging.info("Service '%s' Registered with %d slots.", self.service, self.slots)
+		
+		while True:
+			try:
+				items = dict(self.poller.poll(self.timeout))
+			except KeyboardInterrupt:
+				break # Interrupted
+	
+			if self.results in items:
+				self.send_results()
+			
+			if self.wsocket in items: # received a msg.
+				msg = self.recv_from_broker()
+				self.msg_handler(msg)
+				self.liveness = self.HEARTBEAT_LIVENESS
+			elif self.busy:
+				# the broker doesn't heartbeat workers with no free slot,
+				# silence means we're busy, not that it is gone.
+				self.liveness = self.HEARTBEAT_LIVENESS
+			elif not items: # no msg or heartbeat received.
+				self.liveness -= 1
+				if self.liveness == 0:
+					try:
+						time.sleep(1e-3*self.reconnect)
+					except KeyboardInterrupt:
+						break
+					
+					# try to reconnect	
+					self.reconnect_to_broker()
+			
+			# Send HEARTBEAT if it's time
+			if time.time() > self.heartbeat_at:
+				self.send_heartbeat()
+				
+		return None
+		
+	def destroy(self):
+		self.pool.terminate()
+		super(MajordomoPoolWorker, self).destroy()
+
+
+class MajordomoBatchWorker(MajordomoWorker):
+	'''
+	A worker handling requests in batches: it collects up to batch_size
+	requests, or whatever arrived within batch_wait msecs of the first one,
+	runs batch_request_handler once on all of them, then sends each reply
+	to its own reply_to.
 	
+	READY advertises batch_size slots, so the broker keeps up to batch_size
+	requests in flight on this worker and a batch can fill up.
+	'''
+	
+	batch_size = 8 			# max requests per batch
+	batch_wait = 10 			# msecs a batch waits for more requests
+	batch = None 				# [(reply_to, request)] collected so far
+	batch_due = None 			# time.time() the collected batch runs at
+	batches = 0 				# batches run
+	
+	def __init__(self, broker, service, batch_size=8, batch_wait=10, verbose=False):
+		assert batch_size >= 1
+		self.batch_size = batch_size
+		self.batch_wait = batch_wait
+		self.batch = []
+		super(MajordomoBatchWorker, self).__init__(broker, service, verbose)
+		
+	def register_service(self, service_name):
+		"""
+		command : READY
+		msg : 
+			Frame 3 - name of this service.
+			Frame 4 - number of concurrent slots, the batch size.
+		"""
+		self.send_to_broker(MDP.W_READY, [service_name, str(self.batch_size)])
+		
+	def reconnect_to_broker(self):
+		# the new broker connection won't take replies to the old one's requests
+		self.batch = []
+		self.batch_due = None
+		super(MajordomoBatchWorker, self).reconnect_to_broker()
+		
+	def batch_request_handler(self, requests):
+		"""
+		Returns the list of replies to a list of requests, in order.
+		
+		Override to process a batch at once, by default it is
+		client_request_handler on each request.
+		"""
+		return [self.client_request_handler(request) for request in requests]
+		
+	def handle_request(self, reply_to, request):
+		"""
+		Add the request to the batch, run it once full.
+		"""
+		if not self.batch:
+			self.batch_due = time.time() + 1e-3*self.batch_wait
+		self.batch.append((reply_to, request))
+		if len(self.batch) >= self.batch_size:
+			self.run_batch()
+		
+	def run_batch(self):
+		"""
+		Run the handler on the collected batch and send every reply.
+		"""
+		batch, self.batch = self.batch, []
+		self.batch_due = None
+		for reply_to, request in batch:
+			self.trace(reply_to, "w")
+		try:
+			replies = list(self.batch_request_handler([request for reply_to, request in batch]))
+		except Exception:
+			logging.exception("E: batch handler failed")
+			replies = []
+		else:
+			if len(replies) != len(batch):
+				logging.error("E: batch handler returned %d replies to %d requests",
+						len(replies), len(batch))
+		self.batches += 1
+		for i, (reply_to, request) in enumerate(batch):
+			self.trace(reply_to, "e")
+			if i < len(replies):
+				self.send_reply(reply_to, replies[i])
+			else:
+				# failed or came up short, still free the slot
+				self.send_status(reply_to, MDP.S_FAILED)
+			
+	def serve_forever(self):
+		"""
+		Read requests, run a batch once it is full or batch_wait passed.
+		"""
+		logging.info("Service '%s' Registered, batches of %d within %d msecs.",
+				self.service, self.batch_size, self.batch_wait)
+		
+		while True:
+			timeout = self.timeout
+			if self.batch:
+				timeout = max(0, min(timeout, int(1e3*(self.batch_due - time.time()))))
+			try:
+				items = self.poller.poll(timeout)
+			except KeyboardInterrupt:
+				break # Interrupted
+	
+			if items: # received a msg.
+				# read all that is ready, so the batch fills before it runs
+				while self.wsocket.poll(0, zmq.POLLIN):
+					self.msg_handler(self.recv_from_broker())
+				self.liveness = self.HEARTBEAT_LIVENESS
+			elif self.batch:
+				pass # the batch timer, not silence from the broker
+			else: # no msg or heartbeat received.
+				self.liveness -= 1
+				if self.liveness == 0:
+					try:
+						time.sleep(1e-3*self.reconnect)
+					except KeyboardInterrupt:
+						break
+					
+					# try to reconnect	
+					self.reconnect_to_broker()
+			
+			if self.batch and time.time() >= self.batch_due:
+				self.run_batch()
+			
+			# Send HEARTBEAT if it's time
+			if time.time() > self.heartbeat_at:
+				self.send_heartbeat()
+				
+		return None
+
+
+class MajordomoLoopWorker(MajordomoWorker):
+	'''
+	A worker served on a bolt_loop.EventLoop, sharing its thread with the
+	broker, other workers, clients and servers attached to the loop.
 	
+	client_request_handler may be a coroutine (see bolt_loop.py): a
+	generator function yielding futures, such as loop.sleep() or the
+	ReplyFuture of a MajordomoAsyncClient on the same loop, and ending with
+	raise Return(reply). It may also return a Future, or just the reply.
+	While handlers wait, more requests come in, up to the slots advertised
+	in READY, so I/O-bound handlers overlap. Handlers must not block.
+	'''
+	
+	loop = None 				# bolt_loop.EventLoop the worker runs on
+	slots = 8 				# concurrent requests
+	busy = 0 					# requests being handled
+	heard = False 			# the broker sent something since the last tick
+	ticker = None 			# loop Timer of the next liveness & heartbeat tick
+	
+	def __init__(self, broker, service, loop=None, slots=8, verbose=False):
+		assert slots >= 1
+		self.loop = loop or bolt_loop.EventLoop()
+		self.slots = slots
+		super(MajordomoLoopWorker, self).__init__(broker, service, verbose)
+		self.ticker = self.loop.call_later(1e-3*self.timeout, self.tick)
+		
+	def register_service(self, service_name):
+		"""
+		command : READY
+		msg : 
+			Frame 3 - name of this service.
+			Frame 4 - number of concurrent slots.
+		"""
+		self.send_to_broker(MDP.W_READY, [service_name, str(self.slots)])
+		
+	def reconnect_to_broker(self):
+		if self.wsocket:
+			self.loop.remove_reader(self.wsocket)
+		super(MajordomoLoopWorker, self).reconnect_to_broker()
+		self.loop.add_reader(self.wsocket, self.on_readable)
+		
+	def on_readable(self):
+		"""
+		Handle every msg that is ready.
+		"""
+		while self.wsocket.poll(0, zmq.POLLIN):
+			self.msg_handler(self.recv_from_broker())
+		self.heard = True
+		
+	def handle_request(self, reply_to, request):
+		"""
+		Start the handler on the request, the reply is sent when it finishes.
+		"""
+		self.busy += 1
+		self.trace(reply_to, "w")
+		try:
+			future = bolt_loop.spawn(self.client_request_handler(request))
+		except Exception as e:
+			future = bolt_loop.Future()
+			future.set_exception(e)
+		future.add_done_callback(partial(self.request_done, self.wsocket, reply_to))
+		
+	def request_done(self, wsocket, reply_to, future):
+		self.busy -= 1
+		if wsocket is not self.wsocket:
+			return # the broker we reconnected to doesn't know this request
+		reply, error = bolt_loop.outcome(future)
+		if error is not None:
+			logging.error("E: request handler failed: %r", error)
+		self.trace(reply_to, "e")
+		if reply is None:
+			# the handler failed, still free the slot
+			self.send_status(reply_to, MDP.S_FAILED)
+		else:
+			self.send_reply(reply_to, reply)
+		
+	def tick(self):
+		"""
+		Every timeout msecs: count a silent broker down to a reconnect, and
+		send HEARTBEAT if it's time.
+		"""
+		if self.heard or self.busy:
+			# the broker doesn't heartbeat workers with no free slot,
+			# silence while busy doesn't mean it is gone.
+			self.liveness = self.HEARTBEAT_LIVENESS
+		else:
+			self.liveness -= 1
+			if self.liveness == 0:
+				# serve_forever() sleeps, the loop waits on a timer
+				self.ticker = self.loop.call_later(1e-3*self.reconnect, self.restart)
+				return
+		self.heard = False
+		
+		if time.time() > self.heartbeat_at:
+			self.send_heartbeat()
+		self.ticker = self.loop.call_later(1e-3*self.timeout, self.tick)
+		
+	def restart(self):
+		self.reconnect_to_broker()
+		self.ticker = self.loop.call_later(1e-3*self.timeout, self.tick)
+		
+	def serve_forever(self):
+		"""
+		Run the loop, for a worker alone on it.
+		"""
+		logging.info("Service '%s' Registered with %d slots.", self.service, self.slots)
+		self.loop.run_forever()
+		
+	def destroy(self):
+		self.ticker.cancel()
+		self.loop.remove_reader(self.wsocket)
+		super(MajordomoLoopWorker, self).destroy()